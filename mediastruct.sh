@@ -1,12 +1,16 @@
 #!/bin/bash
 
-# Check for -m flag
+# Check for -m flag, and -d to send commands to a running "mediastruct serve"
 ENABLE_MONITOR=""
-while getopts "m" opt; do
+USE_DAEMON=""
+while getopts "md" opt; do
     case $opt in
         m)
             ENABLE_MONITOR="-m"
             ;;
+        d)
+            USE_DAEMON="1"
+            ;;
         \?)
             echo "Invalid option: -$OPTARG" >&2
             exit 1
@@ -17,17 +21,25 @@ done
 # Remove the parsed options from the arguments
 shift $((OPTIND-1))
 
+run() {
+    if [ -n "$USE_DAEMON" ]; then
+        mediastruct-client "$1"
+    else
+        mediastruct $ENABLE_MONITOR "$1"
+    fi
+}
+
 # Run each command sequentially with or without the -m flag
 echo "Running ingest..."
-mediastruct $ENABLE_MONITOR ingest
+run ingest
 
 echo "Running crawl..."
-mediastruct $ENABLE_MONITOR crawl
+run crawl
 
 echo "Running dedupe..."
-mediastruct $ENABLE_MONITOR dedupe
+run dedupe
 
 echo "Running validate..."
-mediastruct $ENABLE_MONITOR validate
+run validate
 
 echo "All commands completed."
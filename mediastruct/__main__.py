@@ -1,12 +1,17 @@
 import os
-import time
 import sys
 import logging
 import argparse
+from functools import partial
 import configparser
 import logging.handlers
-from pathlib import Path
-from mediastruct import crawl, dedupe, ingest, validate
+from mediastruct import dedupe, ingest, validate, schedule, watch, service, archive, scrub, query, pipeline, cluster, estimate, replicate
+from mediastruct.utils import parse_size
+from mediastruct import throttle, locks, store
+from mediastruct.index import IndexCache, index_path
+from mediastruct.rules import PathRules, default_patterns
+from mediastruct.hashing import HashPolicy
+from mediastruct.budget import Budget, deadline_option, duration_option
 
 # Setup logging
 log = logging.getLogger(__name__)
@@ -38,7 +43,7 @@ def setup_logging(logdir):
     log.debug(f"Logging configured to write to {log_file_path}")
 
 class mediastruct:
-    def __init__(self):
+    def __init__(self, argv=None):
         print("Setting up sys.path")
         log.debug("Setting up sys.path")
         self.this_path = os.path.dirname(os.path.abspath(__file__))
@@ -61,6 +66,7 @@ class mediastruct:
             'archive_dir': '/data/archive',
             'duplicates_dir': '/data/media/duplicates',
             'validated_dir': '/data/media/validated',
+            'near_duplicates_dir': '/data/media/near_duplicates',
         }
 
         # Try to read the config file from /etc/mediastruct/config.ini
@@ -88,6 +94,18 @@ class mediastruct:
         self.archivedir = self.config['Paths']['archive_dir']
         self.duplicatedir = self.config['Paths']['duplicates_dir']
         self.validateddir = self.config['Paths']['validated_dir']
+        self.nearduplicatedir = self.config['Paths']['near_duplicates_dir']
+
+        # Compile crawl include/exclude rules once; unless [Crawl] sets them, the targets are the archive volumes
+        # and media years under the configured roots, and the non-indexed roots and content store are excluded
+        if not self.config.has_section('Crawl'):
+            self.config.add_section('Crawl')
+        defaults = default_patterns(self.archivedir, self.workingdir, [self.duplicatedir, self.validateddir, self.nearduplicatedir, self.ingestdir])
+        for key, patterns in zip(('include', 'exclude'), defaults):
+            if not self.config.has_option('Crawl', key):
+                self.config.set('Crawl', key, "\n".join(patterns))
+        self.rules = PathRules.from_config(self.config)
+        self.hash_policy = HashPolicy.from_config(self.config)
 
         print(f"Set up paths: this_path={self.this_path}, app_path={self.app_path}")
         log.debug(f"Set up paths: this_path={self.this_path}, app_path={self.app_path}")
@@ -97,10 +115,24 @@ class mediastruct:
 
         # Setup argument parser
         self.parser = argparse.ArgumentParser(description='MediaStruct')
-        self.parser.add_argument('command', choices=['ingest', 'crawl', 'dedupe', 'archive', 'validate'], help='Command to execute')
+        self.parser.add_argument('command', choices=['ingest', 'crawl', 'dedupe', 'archive', 'validate', 'watch', 'serve', 'scrub', 'query', 'run', 'worker', 'replicate'], help='Command to execute')
         self.parser.add_argument('-f', '--force', action='store_true', help='Force reprocessing')
         self.parser.add_argument('-m', '--monitor', action='store_true', help='Enable monitoring')
-        self.args = self.parser.parse_args()
+        self.parser.add_argument('-p', '--plan', action='store_true', help='Archive: write the volume plan without moving files; replicate: write the replication plan without copying')
+        self.parser.add_argument('--hash', action='append', default=[], help='Query: hash to look up (repeatable)')
+        self.parser.add_argument('--hashes-file', help="Query: file of hashes to look up, one per line ('-' for stdin)")
+        self.parser.add_argument('--path', action='append', default=[], help='Query: path to look up (repeatable); scrub --rebaseline: only rebaseline this path')
+        self.parser.add_argument('--year', help='Query: year or inclusive year range, e.g. 2019 or 2015-2019')
+        self.parser.add_argument('--size', help='Query: inclusive size range, e.g. 1G-4G or 100M-')
+        self.parser.add_argument('--estimate', action='store_true', help='Predict bytes read, files moved and wall time instead of running the command')
+        self.parser.add_argument('--deadline', type=deadline_option, help='Stop crawl, dedupe, validate or run cleanly at this time (HH:MM), leaving the rest for the next run')
+        self.parser.add_argument('--budget', type=duration_option, help='Stop crawl, dedupe, validate or run cleanly after this long, e.g. 45m or 2h30m')
+        self.parser.add_argument('--distributed', action='store_true', help='Crawl: hash target directories on the [Cluster] workers')
+        self.parser.add_argument('--target', help='Replicate: directory to mirror to (default: [Replicate] target)')
+        self.parser.add_argument('--rebaseline', action='store_true', help='Scrub: accept the indexed hashes of the archive (or --path files) as verified content, clearing their mismatches')
+        self.parser.add_argument('--listen', help='Worker: host:port to listen on (default: [Cluster] listen, else all interfaces with a token and 127.0.0.1 without)')
+        self.parser.add_argument('-o', '--output', help='Query: write JSON lines here instead of stdout; --estimate: write the estimate as JSON')
+        self.args = self.parser.parse_args(argv)
 
         print(f"Command: {self.args.command}")
         log.info(f"Command: {self.args.command}")
@@ -108,52 +140,284 @@ class mediastruct:
         # Set monitor flag
         self.monitor = self.args.monitor if hasattr(self.args, 'monitor') else None
 
-        # Execute the command
+        # Rate limits and I/O priority for this command, inherited by worker threads and processes
+        throttle.configure(self.config, self.args.command)
+
+        # Resident index cache, only set up by the long-running service
+        self.cache = None
+
+        # Wall-clock limit long commands stop at, most valuable work first
+        self.budget = Budget.from_options(deadline=self.args.deadline, budget=self.args.budget)
+        if self.budget:
+            print(f"Budget: {self.budget}")
+            log.info(f"Budget: {self.budget}")
+
+        # Execute the command, or only predict its cost
+        if self.args.estimate:
+            log.debug(f"Estimating command: {self.args.command}")
+            estimate.estimate(app=self, command=self.args.command, output=self.args.output)
+            return
         log.debug(f"Executing command: {self.args.command}")
         getattr(self, self.args.command)()
 
+    def data_files(self):
+        """Index files read by dedupe, validate and queries."""
+        # Built the way crawl names them, so a shared IndexCache sees the same paths crawl wrote
+        return [index_path(self.datadir, root) for root in self.roots()]
+
+    def catalog_path(self):
+        """SQLite catalog of per-file state kept between runs."""
+        return self.config.get('Paths', 'catalog', fallback=os.path.join(self.datadir, 'catalog.db'))
+
+    def hold(self, command, exclusive=(), shared=()):
+        """Advisory locks for a command on the roots it moves files in (exclusive) or only reads (shared)."""
+        return locks.hold(locks.lock_dir(self.datadir), exclusive=exclusive, shared=shared, command=command)
+
     def ingest(self):
         """Execute the ingest command."""
         log.debug("Ingest command starting")
-        ingest.ingest(source_dir=self.ingestdir, target_dir=self.workingdir, monitor=self.monitor)
+        with self.hold("ingest", exclusive=[self.ingestdir, self.workingdir, self.duplicatedir]):
+            ingest.ingest(
+                source_dir=self.ingestdir,
+                target_dir=self.workingdir,
+                monitor=self.monitor,
+                duplicates_dir=self.duplicatedir,
+                known_indexes=[(index_path(self.datadir, root), root) for root in (self.workingdir, self.archivedir)],
+                catalog_path=self.catalog_path(),
+                hash_policy=self.hash_policy,
+                cache=self.cache,
+                archive_store=store.BlobStore(self.archivedir) if store.is_store(self.archivedir) else None,
+            )
         log.debug("Ingest command completed")
 
-    def crawl(self):
-        """Execute the crawl command."""
+    def roots(self):
+        """Crawl roots, in the order their indexes are listed by data_files()."""
+        return [self.ingestdir, self.workingdir, self.archivedir]
+
+    def crawl(self, roots=None):
+        """Execute the crawl command, over every root unless given a subset."""
         log.debug("Crawl command starting")
-        crawl.crawl(force=self.args.force, rootdir=self.ingestdir, datadir=self.datadir, monitor=self.monitor)
-        crawl.crawl(force=self.args.force, rootdir=self.workingdir, datadir=self.datadir, monitor=self.monitor)
-        crawl.crawl(force=self.args.force, rootdir=self.archivedir, datadir=self.datadir, monitor=self.monitor)
+        if self.args.distributed:
+            self.cluster_crawl(roots or self.roots())
+            log.debug("Crawl command completed")
+            return
+        schedule.schedule(
+            roots=roots or self.roots(),
+            force=self.args.force,
+            datadir=self.datadir,
+            monitor=self.monitor,
+            rules=self.rules,
+            device_concurrency=self.config.getint('Crawl', 'device_concurrency', fallback=1),
+            device_workers=self.config.getint('Crawl', 'device_workers', fallback=0),
+            cache=self.cache,
+            hash_policy=self.hash_policy,
+            lock_dir=locks.lock_dir(self.datadir),
+            catalog_path=self.catalog_path(),
+            budget=self.budget,
+            media_dir=self.workingdir,
+            ingest_dir=self.ingestdir,
+        )
         log.debug("Crawl command completed")
 
+    def cluster_crawl(self, roots):
+        """Crawl each root in turn, its target directories hashed in parallel by the [Cluster] workers."""
+        workers = [cluster.parse_address(address) for address in self.config.get('Cluster', 'workers', fallback='').split()]
+        for root in roots:
+            with self.hold("crawl", shared=[root]):
+                cluster.cluster(
+                    force=self.args.force,
+                    rootdir=root,
+                    datadir=self.datadir,
+                    workers=workers,
+                    slots=self.config.getint('Cluster', 'slots', fallback=1),
+                    token=self.config.get('Cluster', 'token', fallback=None),
+                    timeout=self.config.getfloat('Cluster', 'timeout', fallback=cluster.DEFAULT_TIMEOUT) or None,
+                    monitor=self.monitor,
+                    rules=self.rules,
+                    cache=self.cache,
+                    hash_policy=self.hash_policy,
+                    catalog_path=self.catalog_path(),
+                    budget=self.budget,
+                    media_dir=self.workingdir,
+                    ingest_dir=self.ingestdir,
+                )
+
+    def worker(self):
+        """Execute the worker command, hashing target directories for a distributed crawl until interrupted."""
+        log.debug("Worker command starting")
+        # Hashing on a worker is crawl work, so it runs under crawl's throttle and I/O priority
+        throttle.configure(self.config, 'crawl')
+        token = self.config.get('Cluster', 'token', fallback=None)
+        cluster.worker(
+            address=cluster.parse_address(self.args.listen or self.config.get('Cluster', 'listen', fallback='') or cluster.default_listen(token)),
+            roots=self.roots(),
+            rules=self.rules,
+            hash_policy=self.hash_policy,
+            max_workers=self.config.getint('Cluster', 'worker_processes', fallback=0) or None,
+            token=token,
+        )
+        log.debug("Worker command completed")
+
     def dedupe(self):
         """Execute the dedupe command."""
         log.debug("Starting dedupe command")
-        data_files = [
-            os.path.join(self.datadir, 'ingest_index.json'),
-            os.path.join(self.datadir, 'media_index.json'),
-            os.path.join(self.datadir, 'archive_index.json')
-        ]
-        dedupe.dedupe(data_files, self.duplicatedir, self.archivedir, self.ingestdir, monitor=self.monitor)
+        dedupe.dedupe(self.data_files(), self.duplicatedir, self.archivedir, self.ingestdir, monitor=self.monitor, cache=self.cache, catalog_path=self.catalog_path(),
+                      move_lock=partial(locks.hold, locks.lock_dir(self.datadir), exclusive=[self.ingestdir, self.workingdir, self.duplicatedir, self.nearduplicatedir],
+                                        shared=[self.archivedir], command="dedupe"),
+                      budget=self.budget,
+                      check_sizes=self.config.getboolean('Dedupe', 'check_sizes', fallback=False),
+                      **self.near_duplicate_options())
         log.debug("Dedupe command completed")
 
+    def near_duplicate_options(self):
+        """Perceptual near-duplicate settings for dedupe from [Dedupe]; 'off' (the default) skips grouping."""
+        action = self.config.get('Dedupe', 'near_duplicates', fallback='off')
+        if action == 'off':
+            return {}
+        return {
+            'near_duplicates': os.path.join(self.datadir, 'near_duplicates.json'),
+            'near_action': action,
+            'near_distance': self.config.getint('Dedupe', 'near_distance', fallback=6),
+            'near_duplicates_dir': self.nearduplicatedir,
+        }
+
     def archive(self):
         """Execute the archive command."""
         log.debug("Archive command starting")
-        # Placeholder for archive functionality
+        # A plan only reads the media index; moving the files locks both ends
+        exclusive = [] if self.args.plan else [self.workingdir, self.archivedir]
+        with self.hold("archive", exclusive=exclusive, shared=[self.workingdir]):
+            archive.archive(
+                archive_dir=self.archivedir,
+                data_dir=self.datadir,
+                media_dir=self.workingdir,
+                mediasize=self.config.getint('Archive', 'mediasize', fallback=25),
+                monitor=self.monitor,
+                plan_only=self.args.plan,
+                writers=self.config.getint('Archive', 'writers', fallback=4),
+                archive_layout=self.config.get('Archive', 'layout', fallback='volumes'),
+            )
         log.debug("Archive command completed")
 
     def validate(self):
         """Execute the validate command."""
         log.debug("Validate command starting")
-        data_files = [
-            os.path.join(self.datadir, 'ingest_index.json'),
-            os.path.join(self.datadir, 'media_index.json'),
-            os.path.join(self.datadir, 'archive_index.json')
-        ]
-        validate.validate(data_files, self.duplicatedir, self.archivedir, self.ingestdir, monitor=self.monitor)
+        with self.hold("validate", exclusive=[self.duplicatedir, self.validateddir]):
+            validate.validate(
+                self.data_files(), self.duplicatedir, self.archivedir, self.ingestdir,
+                monitor=self.monitor,
+                cache=self.cache,
+                sample_rate=self.config.getfloat('Validate', 'sample_rate', fallback=0.01),
+                hash_policy=self.hash_policy,
+                validated_dir=self.validateddir,
+                budget=self.budget,
+            )
         log.debug("Validate command completed")
 
+    def watch(self):
+        """Execute the watch command, keeping the indexes fresh until interrupted."""
+        log.debug("Watch command starting")
+        watch.watch(
+            roots=self.roots(),
+            ingest_dir=self.ingestdir,
+            datadir=self.datadir,
+            rules=self.rules,
+            on_ingest=self.ingest,
+            on_dedupe=self.dedupe,
+            settle=self.config.getfloat('Watch', 'settle', fallback=5.0),
+            debounce=self.config.getfloat('Watch', 'debounce', fallback=30.0),
+            poll_interval=self.config.getfloat('Watch', 'poll_interval', fallback=10.0),
+            use_inotify=self.config.getboolean('Watch', 'inotify', fallback=True),
+            hash_policy=self.hash_policy,
+            monitor=self.monitor,
+            lock_dir=locks.lock_dir(self.datadir),
+        )
+        log.debug("Watch command completed")
+
+    def scrub(self):
+        """Execute the scrub command, reverifying the least recently verified archive files within the budget."""
+        log.debug("Scrub command starting")
+        with self.hold("scrub", shared=[self.archivedir]):
+            scrub.scrub(
+                archive_dir=self.archivedir,
+                datadir=self.datadir,
+                catalog_path=self.catalog_path(),
+                byte_budget=parse_size(self.config.get('Scrub', 'bytes', fallback='0')),
+                time_budget=self.config.getfloat('Scrub', 'seconds', fallback=0) or None,
+                monitor=self.monitor,
+                rebaseline=self.args.rebaseline,
+                paths=self.args.path,
+            )
+        log.debug("Scrub command completed")
+
+    def replicate(self):
+        """Execute the replicate command, mirroring the archive (or [Replicate] source) to the target from the indexes."""
+        log.debug("Replicate command starting")
+        source = self.config.get('Replicate', 'source', fallback=None) or self.archivedir
+        target = self.args.target or self.config.get('Replicate', 'target', fallback=None)
+        if not target:
+            self.parser.error("replicate needs a target: pass --target or set [Replicate] target")
+        # Planning only reads the indexes and the target
+        exclusive = [] if self.args.plan else [target]
+        with self.hold("replicate", exclusive=exclusive, shared=[source]):
+            replicate.replicate(
+                source_dir=source,
+                target_dir=target,
+                datadir=self.datadir,
+                force=self.args.force,
+                delete=self.config.getboolean('Replicate', 'delete', fallback=False),
+                verify=self.config.getboolean('Replicate', 'verify', fallback=True),
+                plan_only=self.args.plan,
+                workers=self.config.getint('Replicate', 'workers', fallback=4),
+                monitor=self.monitor,
+                budget=self.budget,
+            )
+        log.debug("Replicate command completed")
+
+    @staticmethod
+    def _range(value):
+        """Split 'a-b', 'a-', '-b' or 'a' into (a, b), either side None when open."""
+        if not value:
+            return None, None
+        low, sep, high = value.partition('-')
+        return (low or None, high or None) if sep else (low, low)
+
+    def query_options(self, hashes=(), hashes_file=None, paths=(), year=None, size=None):
+        """Arguments of query.query for the query command's options, shared with the service's queries."""
+        year_from, year_to = self._range(year)
+        min_size, max_size = self._range(size)
+        return dict(
+            catalog_path=self.catalog_path(),
+            indexes=[(index_path(self.datadir, root), root) for root in self.roots()],
+            hashes=[h.lower() for h in hashes],
+            hashes_file=hashes_file,
+            paths=list(paths),
+            year_from=year_from,
+            year_to=year_to,
+            min_size=parse_size(min_size) if min_size else None,
+            max_size=parse_size(max_size) if max_size else None,
+        )
+
+    def query(self):
+        """Execute the query command, answering lookups from the catalog's indexes by hash, path, year and size."""
+        log.debug("Query command starting")
+        query.query(output=self.args.output, **self.query_options(self.args.hash, self.args.hashes_file, self.args.path, self.args.year, self.args.size))
+        log.debug("Query command completed")
+
+    def run(self):
+        """Execute the run command: ingest, crawl, dedupe and validate in one process with shared indexes."""
+        log.debug("Run command starting")
+        pipeline.pipeline(app=self, force=self.args.force)
+        log.debug("Run command completed")
+
+    def serve(self):
+        """Execute the serve command, answering client requests with config and indexes kept resident."""
+        log.debug("Serve command starting")
+        self.cache = IndexCache()
+        socket_path = self.config.get('Service', 'socket', fallback=os.path.join(self.datadir, 'mediastruct.sock'))
+        service.service(app=self, socket_path=socket_path)
+        log.debug("Serve command completed")
+
 def main():
     log.debug("Entering main function")
     mediastruct_instance = mediastruct()
@@ -3,101 +3,329 @@ import sys
 import time
 import shutil
 import json
+import datetime
+import threading
 from glob import glob
 from os import walk, remove, stat
 from mediastruct.utils import *
+from mediastruct.index import iter_index
+from mediastruct.hashing import new_hasher, record_algorithm, same_content
+from mediastruct.store import BlobStore
+from mediastruct import throttle
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+
+class VolumeTree:
+    '''Max segment tree over the free space of each volume, so first-fit is O(log volumes) per file.'''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self.size = 1
+        self.tree = [0, 0]
+
+    def _grow(self):
+        leaves = self.tree[self.size:]
+        self.size *= 2
+        self.tree = [0] * (2 * self.size)
+        self.tree[self.size:self.size + len(leaves)] = leaves
+        for i in range(self.size - 1, 0, -1):
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+
+    def _set(self, volume, free):
+        i = self.size + volume
+        self.tree[i] = free
+        i //= 2
+        while i:
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+            i //= 2
+
+    def open_volume(self):
+        if self.count == self.size:
+            self._grow()
+        self.count += 1
+        self._set(self.count - 1, self.capacity)
+        return self.count - 1
+
+    def first_fit(self, filesize):
+        '''Place filesize in the lowest numbered volume with room, opening a new one if none has.'''
+        if self.tree[1] < filesize:
+            volume = self.open_volume()
+        else:
+            i = 1
+            while i < self.size:
+                i = 2 * i if self.tree[2 * i] >= filesize else 2 * i + 1
+            volume = i - self.size
+        self._set(volume, self.tree[self.size + volume] - filesize)
+        return volume
+
+    def pack(self, sizes):
+        '''first_fit over a whole sequence with the tree walk inlined; returns the volume of each size.'''
+        placements = []
+        append = placements.append
+        for filesize in sizes:
+            tree = self.tree
+            if tree[1] < filesize:
+                volume = self.open_volume()
+                tree = self.tree
+                i = self.size + volume
+            else:
+                i = 1
+                size = self.size
+                while i < size:
+                    i <<= 1
+                    if tree[i] < filesize:
+                        i += 1
+                volume = i - self.size
+            tree[i] -= filesize
+            i >>= 1
+            while i:
+                left = tree[2 * i]
+                right = tree[2 * i + 1]
+                tree[i] = left if left > right else right
+                i >>= 1
+            append(volume)
+        return placements
 
 class archive:
-    '''The archive function forms a volume-grouped collection of data based on the size you specify for your volumes.'''
+    '''The archive function forms a volume-grouped collection of data based on the size you specify for your volumes.
 
-    def __init__(self, archive_dir, data_dir, media_dir, mediasize, monitor=None):
+    With the 'content' layout each file's content is stored once as a blob under
+    its hash and a volume is only a manifest of path -> hash, so content already
+    in the archive is not stored again.
+    '''
+    PLAN_FILE = 'archive_plan.json'
+    COPY_BUFFER_SIZE = 4 * 1024 * 1024
+    LAYOUTS = ('volumes', 'content')
+    BLOB_LOCKS = 64
+
+    def __init__(self, archive_dir, data_dir, media_dir, mediasize, monitor=None, plan_only=False, writers=4, archive_layout='volumes'):
+        if archive_layout not in self.LAYOUTS:
+            raise ValueError("Unknown archive layout: %s (expected volumes or content)" % (archive_layout))
         self.monitor = monitor
+        self.writers = writers
+        self.store = BlobStore(archive_dir) if archive_layout == 'content' else None
+        # Writers of different volumes storing the same content take turns on its blob
+        self.blob_locks = [threading.Lock() for _ in range(self.BLOB_LOCKS)]
         if self.monitor:
             self.monitor.update_progress("archive", status="Running", processed=0, total=0, current="Initializing")
         totalmedia = 0
-        next_volume = self.dirstruct(archive_dir, media_dir)
-        files_to_archive = self.assembleVolume(archive_dir, data_dir, media_dir, mediasize, next_volume)
-        self.archive_files(files_to_archive, mediasize, media_dir, next_volume, archive_dir)
+        next_volume = self.store_volume_number(archive_dir) if self.store else self.dirstruct(archive_dir, media_dir)
+        plan = self.plan_volumes(archive_dir, data_dir, media_dir, mediasize, next_volume)
+        if plan_only:
+            log.info("Archive - Plan only, no files moved")
+            return
+        self.archive_files(plan, mediasize, media_dir, next_volume, archive_dir)
 
     def dirstruct(self, archive_dir, media_dir):
-        '''Builds the volume directory structure based on what is already there'''
+        '''Next volume number based on what is already there; volume directories are only created as files are moved into them'''
         folders = 0
         vol_size = 0
-        folders += len([name for name in os.listdir(archive_dir)])
+        if os.path.isdir(archive_dir):
+            folders += len([name for name in os.listdir(archive_dir)])
         print("Folders:", folders)
         next_volume = folders + 1
         print("Next Volume Number: ", next_volume)
-        utils.mkdir_p(self, (archive_dir + '/' + str(next_volume)))
         totalmedia = 0
         return next_volume
 
-    def assembleVolume(self, archive_dir, data_dir, media_dir, mediasize, next_volume):
-        '''Loop through the contents of the working directory and build a recordset for files to be moved'''
+    def store_volume_number(self, archive_dir):
+        '''Next volume number of a content-addressed archive, after its manifests and any volume directories from before.'''
+        names = os.listdir(archive_dir) if os.path.isdir(archive_dir) else []
+        numbered = [int(name) for name in names if name.isdigit()] + self.store.volumes()
+        next_volume = max(numbered, default=0) + 1
+        print("Next Volume Number: ", next_volume)
+        return next_volume
+
+    def plan_volumes(self, archive_dir, data_dir, media_dir, mediasize, next_volume):
+        '''Pack the indexed files into volumes and write the plan before anything moves.
+
+        Files are streamed from the index, grouped by year and packed first-fit
+        decreasing within each year, years in ascending order. Later years only
+        top up the free space left at the end of earlier volumes, so each volume
+        still covers a short, contiguous run of years.
+        '''
         dirname = re.split(r"\/", media_dir)
         dirname_len = len(dirname) - 1
+        capacity = int(mediasize) * 1000 * 1000 * 1000
         log.info("Archive - Target Volume Size: %s" % (mediasize))
-        archivefiles = []
-        array = {}
-        mediatotal = 0
-        print("archive_dir: ", archive_dir)
-        print("data_dir: ", data_dir)
-        print("media_dir: ", media_dir)
-        print("dirname: ", dirname[dirname_len])
-        if os.path.isfile('%s/%s_index.json' % (data_dir, dirname[dirname_len])):
-            with open('%s/%s_index.json' % (data_dir, dirname[dirname_len]), 'r') as f:
-                array = json.load(f)
-                total_files = sum(1 for g in array if g != 'du')
-                if self.monitor:
-                    self.monitor.update_progress("archive", total=total_files, current="Assembling volume")
-                processed = 0
-                for g in array:
-                    if g != 'du':
-                        this_year = str(array[g]['year'])
-                        archivefiles.append([{"year": this_year, "path": array[g]['path'], "filesize": array[g]['filesize']}])
-                        processed += 1
-                        if self.monitor:
-                            self.monitor.update_progress("archive", processed=processed, current=array[g]['path'])
-            sortedarchive = sorted(archivefiles, key=lambda x: x[0]['year'])
-        return sortedarchive
-
-    def archive_files(self, files_to_archive, mediasize, media_dir, next_volume, archive_dir):
-        mediasize = int(mediasize) * 1000 * 1000 * 1000
-        log.info("Archive - Mediasize: %s" % (mediasize))
-        mediatotal = 0
-        arraylen = len(files_to_archive)
+        index_file = '%s/%s_index.json' % (data_dir, dirname[dirname_len])
+        plan = {"created": datetime.datetime.now().isoformat(), "mediasize": capacity, "first_volume": next_volume, "volumes": [], "oversize": []}
+        if not os.path.isfile(index_file):
+            log.warning("Archive - Index file %s not found, nothing to plan" % (index_file))
+            return plan
+
+        start_time = time.time()
+        files = []
+        for file_id, record in iter_index(index_file):
+            if file_id == 'du':
+                continue
+            entry = (str(record['year']), record['filesize'], record['path'], record.get('filehash'), record_algorithm(record))
+            if entry[1] > capacity:
+                plan["oversize"].append(entry)
+                continue
+            files.append(entry)
         if self.monitor:
-            self.monitor.update_progress("archive", total=arraylen, current="Archiving files")
-        for h in range(arraylen):
-            log.info("===================%s==================" % (h))
-            fullpath = re.split(r"\/", files_to_archive[h][0]['path'])
+            self.monitor.update_progress("archive", status="Running", processed=0, total=len(files), current="Planning volumes")
+        # Two stable sorts give year ascending, size descending without building key tuples
+        files.sort(key=itemgetter(1), reverse=True)
+        files.sort(key=itemgetter(0))
+
+        placements = VolumeTree(capacity).pack([entry[1] for entry in files])
+        volumes = [{"volume": next_volume + v, "bytes": 0, "files": []} for v in range(max(placements, default=-1) + 1)]
+        for entry, volume in zip(files, placements):
+            volumes[volume]["bytes"] += entry[1]
+            volumes[volume]["files"].append(entry)
+        plan["volumes"] = volumes
+
+        for volume in volumes:
+            log.info("Archive - Volume %s: %s files, %s / %s bytes (%.1f%%)" % (volume["volume"], len(volume["files"]), volume["bytes"], capacity, volume["bytes"] * 100.0 / capacity))
+        for entry in plan["oversize"]:
+            log.warning("Archive - %s is larger than the volume size and will not be archived" % (entry[2]))
+        log.info("Archive - Planned %s files into %s volumes in %.2f seconds" % (len(files), len(volumes), time.time() - start_time))
+
+        plan_path = os.path.join(data_dir, self.PLAN_FILE)
+        with open(plan_path, 'w') as f:
+            f.write(json.dumps(plan))
+        log.info("Archive - Wrote plan to %s" % (plan_path))
+        return plan
+
+    def transfer_file(self, from_path, dest_path, filehash, filesize, hashalg=None):
+        '''Move one file into the archive, verifying its content against the indexed hash.
+
+        Within a filesystem this is a rename and no data is read. Across devices the
+        file is hashed from the same buffers it is copied with, so each byte is read
+        once; the source is only removed after the copy matches filehash under hashalg.
+        '''
+        if os.stat(from_path).st_dev == os.stat(os.path.dirname(dest_path)).st_dev:
+            throttle.acquire(0)
+            os.rename(from_path, dest_path)
+            return True
+        part_path = dest_path + '.part'
+        hasher = new_hasher(hashalg)
+        buf = bytearray(self.COPY_BUFFER_SIZE)
+        view = memoryview(buf)
+        copied = 0
+        with open(from_path, 'rb') as src, open(part_path, 'wb') as dst:
+            while True:
+                n = src.readinto(buf)
+                if not n:
+                    break
+                throttle.acquire(n)
+                hasher.update(view[:n])
+                dst.write(view[:n])
+                copied += n
+            dst.flush()
+            os.fsync(dst.fileno())
+        computed = hasher.hexdigest()
+        if copied != filesize or (filehash and computed != filehash):
+            log.error("Archive - Verification failed for %s (size %s/%s, hash %s/%s), source kept" % (from_path, copied, filesize, computed, filehash))
+            os.remove(part_path)
+            return False
+        if not filehash:
+            log.warning("Archive - No indexed hash for %s, verified by size only" % (from_path))
+        shutil.copystat(from_path, part_path)
+        os.replace(part_path, dest_path)
+        os.remove(from_path)
+        return True
+
+    def store_file(self, volume, path, from_path, filehash, filesize, hashalg):
+        '''Add one file to a volume manifest of the content-addressed archive, storing its blob unless the content is there already.
+
+        An existing blob is compared by strong digest before the file is dropped,
+        so a fast-hash collision can never lose content.
+        '''
+        blob_path = self.store.blob_path(filehash, hashalg)
+        with self.blob_locks[hash((hashalg, filehash)) % self.BLOB_LOCKS]:
+            if os.path.isfile(blob_path):
+                if not same_content(from_path, [blob_path]):
+                    log.error("Archive - %s has the same hash as blob %s but different content, not archived" % (from_path, blob_path))
+                    return False
+                log.info("Archive - Content of %s is already stored as %s" % (from_path, blob_path))
+                self.store.add(volume, path, filehash, hashalg, from_path)
+                throttle.acquire(0)
+                os.remove(from_path)
+                return True
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            if not self.transfer_file(from_path, blob_path, filehash, filesize, hashalg):
+                return False
+        self.store.add(volume, path, filehash, hashalg, from_path)
+        return True
+
+    def _store_volume(self, volume, progress):
+        '''Store the files of one volume as blobs listed in its manifest, returning (moved, failed).'''
+        moved = failed = 0
+        for year, thisfilesize, from_path, filehash, hashalg in volume["files"]:
+            fullpath = re.split(r"\/", from_path)
+            path = year + '/' + fullpath[len(fullpath)-2] + '/' + fullpath[len(fullpath)-1]
+            if not filehash:
+                log.warning("Archive - No indexed hash for %s, it cannot be stored by content" % (from_path))
+                failed += 1
+            elif os.path.isfile(from_path):
+                log.info("Archive - Storing: %s as %s/%s" % (from_path, volume["volume"], path))
+                try:
+                    if self.store_file(volume["volume"], path, from_path, filehash, thisfilesize, hashalg):
+                        moved += 1
+                    else:
+                        failed += 1
+                except OSError as e:
+                    log.error("Archive - Error storing %s: %s" % (from_path, e))
+                    failed += 1
+            progress(from_path)
+        return moved, failed
+
+    def _archive_volume(self, volume, archive_dir, progress):
+        '''Transfer the files of one volume in order, returning (moved, failed).'''
+        log.info("==================================VOLUME %s ======================" % (volume["volume"]))
+        if self.store:
+            return self._store_volume(volume, progress)
+        utils.mkdir_p(self, archive_dir + '/' + str(volume["volume"]))
+        moved = failed = 0
+        for year, thisfilesize, from_path, filehash, hashalg in volume["files"]:
+            fullpath = re.split(r"\/", from_path)
             fpath_len = len(fullpath)
-            year = files_to_archive[h][0]['year']
-            dest_dir = archive_dir + '/' + str(next_volume) + '/' + year + '/' + fullpath[fpath_len-2]
-            dest_path = archive_dir + '/' + str(next_volume) + '/' + year + '/' + fullpath[fpath_len-2] + '/' + fullpath[fpath_len-1]
-            from_path = files_to_archive[h][0]['path']
-            thisfilesize = files_to_archive[h][0]['filesize']
-            log.info("Archive - FileSize: %s" % (thisfilesize))
-            mediatotal = thisfilesize + int(mediatotal)
-            log.info(("Archive: %s - Mediatotal: %s / MediaSize: %s") % (next_volume, mediatotal, mediasize))
-            if mediatotal <= mediasize:
-                if not os.path.isdir(dest_dir):
-                    utils.mkdir_p(self, dest_dir)
-                if os.path.isfile(files_to_archive[h][0]['path']):
-                    log.info("Archive - Moving: %s to %s" % (files_to_archive[h][0]['path'], dest_path))
-                    dest_file_size = 0
-                    while dest_file_size != thisfilesize:
-                        try:
-                            shutil.move(files_to_archive[h][0]['path'], dest_path)
-                        except:
-                            sys.exit("Error Moving File")
-                        dest_file_size = os.path.getsize(dest_path)
-            else:
-                log.info("==================================NEXT ARCHIVE ======================")
-                next_volume = self.dirstruct(archive_dir, media_dir)
-                mediatotal = 0
-            log.info("Total Volume Size: %sGB" % (mediatotal))
-            if self.monitor:
-                self.monitor.update_progress("archive", processed=h + 1, current=from_path)
+            dest_dir = archive_dir + '/' + str(volume["volume"]) + '/' + year + '/' + fullpath[fpath_len-2]
+            dest_path = dest_dir + '/' + fullpath[fpath_len-1]
+            if not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir, exist_ok=True)
+            if os.path.isfile(from_path):
+                log.info("Archive - Moving: %s to %s" % (from_path, dest_path))
+                try:
+                    if self.transfer_file(from_path, dest_path, filehash, thisfilesize, hashalg):
+                        moved += 1
+                    else:
+                        failed += 1
+                except OSError as e:
+                    log.error("Archive - Error moving %s to %s: %s" % (from_path, dest_path, e))
+                    failed += 1
+            progress(from_path)
+        log.info("Total Volume Size: %s bytes" % (volume["bytes"]))
+        return moved, failed
+
+    def archive_files(self, plan, mediasize, media_dir, next_volume, archive_dir):
+        '''Move files into their planned volume directories, one writer thread per volume.'''
+        if self.store:
+            self.store.create()
+        arraylen = sum(len(volume["files"]) for volume in plan["volumes"])
+        if self.monitor:
+            self.monitor.update_progress("archive", status="Running", processed=0, total=arraylen, current="Archiving files")
+        lock = threading.Lock()
+        done = [0]
+
+        def progress(from_path):
+            with lock:
+                done[0] += 1
+                if self.monitor:
+                    self.monitor.update_progress("archive", status="Running", processed=done[0], total=arraylen, current=from_path)
+
+        moved = failed = 0
+        with ThreadPoolExecutor(max_workers=max(1, min(self.writers, len(plan["volumes"])))) as executor:
+            futures = [executor.submit(self._archive_volume, volume, archive_dir, progress) for volume in plan["volumes"]]
+            for future in futures:
+                volume_moved, volume_failed = future.result()
+                moved += volume_moved
+                failed += volume_failed
+        log.info("Archive - Archived %s files, %s failed verification or could not be moved" % (moved, failed))
         if self.monitor:
             self.monitor.update_progress("archive", status="Completed", processed=arraylen, total=arraylen, current="")
@@ -0,0 +1,79 @@
+"""Time budget for a command run, from --budget (a duration) and/or --deadline (a time of day)."""
+import re
+import time
+import argparse
+import datetime
+import logging
+
+log = logging.getLogger(__name__)
+
+_DURATION = re.compile(r"^\s*(?:(\d+(?:\.\d+)?)\s*h)?\s*(?:(\d+(?:\.\d+)?)\s*m)?\s*(?:(\d+(?:\.\d+)?)\s*s?)?\s*$", re.IGNORECASE)
+
+def parse_duration(value):
+    """Seconds in a duration such as '90m', '2h30m' or '3600'."""
+    match = _DURATION.match(str(value))
+    if not match or not any(match.groups()):
+        raise ValueError(f"Invalid duration: {value} (expected e.g. 45m, 2h30m or 3600)")
+    hours, minutes, seconds = (float(group or 0) for group in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+def parse_deadline(value, now=None):
+    """Timestamp of the next HH:MM (or HHMM) after now, or of an ISO date and time."""
+    now = now or datetime.datetime.now()
+    match = re.match(r"^\s*(\d{1,2}):?(\d{2})\s*$", str(value))
+    if not match:
+        try:
+            return datetime.datetime.fromisoformat(str(value).strip()).timestamp()
+        except ValueError:
+            raise ValueError(f"Invalid deadline: {value} (expected HH:MM or an ISO date and time)")
+    try:
+        deadline = now.replace(hour=int(match.group(1)), minute=int(match.group(2)), second=0, microsecond=0)
+    except ValueError:
+        raise ValueError(f"Invalid deadline: {value} (expected HH:MM or an ISO date and time)")
+    if deadline <= now:
+        deadline += datetime.timedelta(days=1)
+    return deadline.timestamp()
+
+def _option(parse):
+    """argparse type that checks a value with parse but keeps the string, so a deadline resolves when the command starts."""
+    def check(value):
+        try:
+            parse(value)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+        return value
+    check.__name__ = parse.__name__
+    return check
+
+duration_option = _option(parse_duration)
+deadline_option = _option(parse_deadline)
+
+class Budget:
+    """Wall-clock end of a run; long commands check it between units of work and stop cleanly once it passes.
+
+    Work left over is picked up by the next run from the state the command
+    already keeps: crawl's .mediastruct caches, the duplicates directory and
+    its manifest.
+    """
+
+    def __init__(self, end):
+        self.end = end
+
+    @classmethod
+    def from_options(cls, deadline=None, budget=None):
+        """Budget ending at the earlier of the deadline and now plus the budget, or None if neither is given."""
+        ends = []
+        if deadline:
+            ends.append(parse_deadline(deadline))
+        if budget:
+            ends.append(time.time() + parse_duration(budget))
+        return cls(min(ends)) if ends else None
+
+    def remaining(self):
+        return max(0.0, self.end - time.time())
+
+    def expired(self):
+        return time.time() >= self.end
+
+    def __str__(self):
+        return f"until {datetime.datetime.fromtimestamp(self.end).strftime('%Y-%m-%d %H:%M:%S')} ({self.remaining():.0f}s left)"
@@ -0,0 +1,286 @@
+"""Persistent per-file catalog kept alongside the JSON indexes."""
+import os
+import time
+import sqlite3
+import logging
+import threading
+from mediastruct.index import iter_index, load_index, delta_path, generation
+from mediastruct.hashing import record_algorithm
+
+log = logging.getLogger(__name__)
+
+class Catalog:
+    """SQLite catalog of file state that has to survive between index generations,
+    such as when a file's content was last verified against its recorded hash.
+
+    The hash a file was first verified against is kept as its baseline: a later
+    crawl that rehashes rotted content changes the index hash, not the baseline,
+    so scrub keeps reporting the mismatch until the file is rebaselined.
+
+    Synced index records are also indexed by hash, year and size, so lookups do
+    not have to load the JSON indexes.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            filehash TEXT,
+            hashalg TEXT,
+            filesize INTEGER,
+            year TEXT,
+            source TEXT,
+            last_verified REAL NOT NULL DEFAULT 0,
+            verify_status TEXT,
+            synced INTEGER NOT NULL DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS files_last_verified ON files (last_verified, path)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+        """CREATE TABLE IF NOT EXISTS strong_hashes (
+            path TEXT PRIMARY KEY,
+            filesize INTEGER,
+            mtime_ns INTEGER,
+            algorithm TEXT,
+            digest TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS throughput (
+            mount TEXT,
+            kind TEXT,
+            bytes REAL NOT NULL DEFAULT 0,
+            files REAL NOT NULL DEFAULT 0,
+            seconds REAL NOT NULL DEFAULT 0,
+            updated REAL,
+            PRIMARY KEY (mount, kind)
+        )""",
+    ]
+    # Columns added after the first release, as (table, column, definition)
+    MIGRATIONS = [
+        ("files", "hashalg", "TEXT"),
+        ("files", "year", "TEXT"),
+        ("files", "source", "TEXT"),
+        ("files", "verified_hash", "TEXT"),
+        ("files", "verified_hashalg", "TEXT"),
+    ]
+    # Secondary indexes, created once the migrations have added their columns
+    INDEXES = [
+        "CREATE INDEX IF NOT EXISTS files_filehash ON files (filehash)",
+        "CREATE INDEX IF NOT EXISTS files_year ON files (year, path)",
+        "CREATE INDEX IF NOT EXISTS files_filesize ON files (filesize)",
+        "CREATE INDEX IF NOT EXISTS files_source ON files (source, synced)",
+    ]
+    RECORD_COLUMNS = ("path", "filehash", "hashalg", "filesize", "year", "source")
+    BATCH_SIZE = 500  # bound parameters per IN (...) lookup
+    THROUGHPUT_DECAY = 0.5  # weight left on earlier runs each time a new measurement is recorded
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            for statement in self.SCHEMA:
+                self.conn.execute(statement)
+            for table, column, definition in self.MIGRATIONS:
+                columns = {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                    # Rows synced before the column existed lack it, so every index is synced again
+                    self.conn.execute("DELETE FROM meta WHERE key LIKE 'synced:%'")
+            for statement in self.INDEXES:
+                self.conn.execute(statement)
+
+    def close(self):
+        self.conn.close()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, str(value)))
+
+    UPSERT = """INSERT INTO files (path, filehash, hashalg, filesize, year, source, synced) VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(path) DO UPDATE SET
+                       last_verified = CASE WHEN files.filehash = excluded.filehash THEN files.last_verified ELSE 0 END,
+                       verify_status = CASE WHEN files.filehash = excluded.filehash OR files.verify_status = 'mismatch' THEN files.verify_status ELSE NULL END,
+                       filehash = excluded.filehash,
+                       hashalg = excluded.hashalg,
+                       filesize = excluded.filesize,
+                       year = excluded.year,
+                       source = excluded.source,
+                       synced = excluded.synced"""
+
+    @staticmethod
+    def _rows(records, source, token):
+        return ((record['path'], record['filehash'], record_algorithm(record), record['filesize'], str(record.get('year') or ''), source, token)
+                for file_id, record in records if file_id != 'du')
+
+    def sync_index(self, index_file, rootdir):
+        """Bring the catalog rows under rootdir in line with an index file.
+
+        Rows keep their verification state while the hash is unchanged; a changed
+        hash is scrubbed again first, but keeps its baseline and any mismatch. Rows for
+        files that left the index are removed. The sync is skipped when the index
+        has not changed since the last one, and when crawl left a delta from the
+        generation last synced only the delta is applied. rootdir only scopes rows
+        synced before they were tagged with their source index.
+        """
+        if not os.path.isfile(index_file):
+            log.warning(f"Catalog - Index file {index_file} not found, not syncing")
+            return False
+        signature = generation(index_file)
+        meta_key = f"synced:{index_file}"
+        synced = self.get_meta(meta_key)
+        if synced == signature:
+            log.debug(f"Catalog - {index_file} unchanged since last sync")
+            return False
+        token = time.time_ns()
+        prefix = rootdir.rstrip('/') + '/'
+        source = os.path.basename(index_file)
+        start_time = time.time()
+        if synced and self._apply_delta(index_file, synced, signature, source, token):
+            self.set_meta(meta_key, signature)
+            log.info(f"Catalog - Applied the delta of {index_file} in {time.time() - start_time:.2f} seconds")
+            return True
+        with self.lock, self.conn:
+            self.conn.executemany(self.UPSERT, self._rows(iter_index(index_file), source, token))
+            removed = self.conn.execute("DELETE FROM files WHERE source = ? AND synced != ?", (source, token)).rowcount
+            removed += self.conn.execute("DELETE FROM files WHERE source IS NULL AND path >= ? AND path < ?",
+                                         (prefix, prefix[:-1] + '0')).rowcount
+        self.set_meta(meta_key, signature)
+        log.info(f"Catalog - Synced {index_file} in {time.time() - start_time:.2f} seconds, removed {removed} stale rows")
+        return True
+
+    def _apply_delta(self, index_file, base, signature, source, token):
+        """Apply the delta crawl wrote with the index if it leads from base to signature; False if there is none that does."""
+        try:
+            delta = load_index(delta_path(index_file))
+        except ValueError:
+            return False
+        if delta.get('base') != base or delta.get('generation') != signature:
+            return False
+        with self.lock, self.conn:
+            self.conn.executemany(self.UPSERT, self._rows(list(delta['added'].items()) + list(delta['changed'].items()), source, token))
+            self.conn.executemany("DELETE FROM files WHERE path = ? AND source = ?",
+                                  ((record['path'], source) for record in delta['removed'].values()))
+        return True
+
+    def least_recently_verified(self, rootdir, after=None, before=None, limit=1000):
+        """Return (path, filehash, filesize, last_verified, hashalg) rows under rootdir, oldest verification first.
+
+        filehash and hashalg are the baseline once a file has been verified, else the
+        indexed ones. after is an exclusive (last_verified, path) cursor; before excludes
+        rows verified since then, so rows marked during a pass are not picked up again by it.
+        """
+        prefix = rootdir.rstrip('/') + '/'
+        query = ("SELECT path, COALESCE(verified_hash, filehash), filesize, last_verified, COALESCE(verified_hashalg, hashalg)"
+                 " FROM files WHERE path >= ? AND path < ?")
+        params = [prefix, prefix[:-1] + '0']
+        if before is not None:
+            query += " AND last_verified < ?"
+            params.append(before)
+        if after is not None:
+            query += " AND (last_verified, path) > (?, ?)"
+            params.extend(after)
+        query += " ORDER BY last_verified, path LIMIT ?"
+        params.append(limit)
+        return self.conn.execute(query, params).fetchall()
+
+    def mark_verified(self, path, status, verified_at=None, filehash=None, hashalg=None):
+        """Record a verification of path against filehash, which becomes its baseline if it has none yet."""
+        with self.lock, self.conn:
+            self.conn.execute("""UPDATE files SET last_verified = ?, verify_status = ?,
+                                     verified_hash = COALESCE(verified_hash, ?), verified_hashalg = COALESCE(verified_hashalg, ?)
+                                 WHERE path = ?""",
+                              (verified_at or time.time(), status, filehash, hashalg if filehash else None, path))
+
+    def rebaseline(self, rootdir, paths=None):
+        """Forget the baselines and verification state under rootdir (or of the given paths only),
+        so scrub accepts the indexed hashes as the new baselines. Returns the rows reset."""
+        prefix = rootdir.rstrip('/') + '/'
+        reset = "UPDATE files SET verified_hash = NULL, verified_hashalg = NULL, verify_status = NULL, last_verified = 0"
+        with self.lock, self.conn:
+            if paths:
+                return sum(self.conn.execute(f"{reset} WHERE path = ?", (path,)).rowcount for path in paths)
+            return self.conn.execute(f"{reset} WHERE path >= ? AND path < ?", (prefix, prefix[:-1] + '0')).rowcount
+
+    def strong_hash(self, path, st, algorithm):
+        """Cached strong digest of path, or None if missing or recorded for a different size or mtime."""
+        with self.lock:
+            row = self.conn.execute("SELECT digest FROM strong_hashes WHERE path = ? AND filesize = ? AND mtime_ns = ? AND algorithm = ?",
+                                    (path, st.st_size, st.st_mtime_ns, algorithm)).fetchone()
+        return row[0] if row else None
+
+    def set_strong_hash(self, path, st, algorithm, digest):
+        with self.lock, self.conn:
+            self.conn.execute("""INSERT INTO strong_hashes (path, filesize, mtime_ns, algorithm, digest) VALUES (?, ?, ?, ?, ?)
+                                 ON CONFLICT(path) DO UPDATE SET filesize = excluded.filesize, mtime_ns = excluded.mtime_ns,
+                                     algorithm = excluded.algorithm, digest = excluded.digest""",
+                              (path, st.st_size, st.st_mtime_ns, algorithm, digest))
+
+    def _records(self, cursor):
+        for row in cursor:
+            yield dict(zip(self.RECORD_COLUMNS, row))
+
+    def lookup_hashes(self, hashes):
+        """Yield the records of every file with one of the given hashes, in batches of BATCH_SIZE."""
+        hashes = list(hashes)
+        columns = ", ".join(self.RECORD_COLUMNS)
+        for start in range(0, len(hashes), self.BATCH_SIZE):
+            batch = hashes[start:start + self.BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            yield from self._records(self.conn.execute(f"SELECT {columns} FROM files WHERE filehash IN ({placeholders})", batch))
+
+    def lookup_path(self, path):
+        """Record for path, or None if it is not in any synced index."""
+        return next(self._records(self.conn.execute(f"SELECT {', '.join(self.RECORD_COLUMNS)} FROM files WHERE path = ?", (path,))), None)
+
+    def range_records(self, year_from=None, year_to=None, min_size=None, max_size=None):
+        """Stream records within inclusive year and size ranges, by year then path."""
+        query = f"SELECT {', '.join(self.RECORD_COLUMNS)} FROM files WHERE source IS NOT NULL"
+        params = []
+        for clause, value in (("year >= ?", year_from), ("year <= ?", year_to), ("filesize >= ?", min_size), ("filesize <= ?", max_size)):
+            if value is not None:
+                query += f" AND {clause}"
+                params.append(value)
+        query += " ORDER BY year, path"
+        return self._records(self.conn.execute(query, params))
+
+    def with_status(self, rootdir, status):
+        prefix = rootdir.rstrip('/') + '/'
+        return self.conn.execute("SELECT path, filehash, filesize, last_verified FROM files WHERE path >= ? AND path < ? AND verify_status = ? ORDER BY path",
+                                 (prefix, prefix[:-1] + '0', status)).fetchall()
+
+    def totals(self, rootdir):
+        """(file count, total bytes) of the synced records under rootdir."""
+        prefix = rootdir.rstrip('/') + '/'
+        count, size = self.conn.execute("SELECT COUNT(*), SUM(filesize) FROM files WHERE path >= ? AND path < ?",
+                                        (prefix, prefix[:-1] + '0')).fetchone()
+        return count, size or 0
+
+    def has_strong_hash(self, path):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM strong_hashes WHERE path = ?", (path,)).fetchone() is not None
+
+    def record_throughput(self, mount, kind, nbytes, files, seconds):
+        """Fold a measured run into the decayed totals kept per mount point and kind of work ('hash', 'move')."""
+        if seconds <= 0:
+            return
+        with self.lock, self.conn:
+            self.conn.execute("""INSERT INTO throughput (mount, kind, bytes, files, seconds, updated) VALUES (?, ?, ?, ?, ?, ?)
+                                 ON CONFLICT(mount, kind) DO UPDATE SET
+                                     bytes = throughput.bytes * ? + excluded.bytes,
+                                     files = throughput.files * ? + excluded.files,
+                                     seconds = throughput.seconds * ? + excluded.seconds,
+                                     updated = excluded.updated""",
+                              (mount, kind, nbytes, files, seconds, time.time(),
+                               self.THROUGHPUT_DECAY, self.THROUGHPUT_DECAY, self.THROUGHPUT_DECAY))
+
+    def throughput(self, mount, kind):
+        """Measured (bytes per second, files per second) for a mount point and kind of work, or None."""
+        row = self.conn.execute("SELECT bytes, files, seconds FROM throughput WHERE mount = ? AND kind = ?", (mount, kind)).fetchone()
+        if not row or not row[2]:
+            return None
+        return row[0] / row[2], row[1] / row[2]
@@ -0,0 +1,70 @@
+"""Thin client for the mediastruct service.
+
+Only the standard library and mediastruct.budget (itself standard library only)
+are imported here so a request costs a socket round trip rather than
+interpreter start-up plus psutil/yaml/xxhash imports.
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+import configparser
+from mediastruct.budget import deadline_option, duration_option
+
+CONFIG_PATH = "/etc/mediastruct/config.ini"
+DEFAULT_DATADIR = "/opt/mediastruct/data"
+
+def socket_path(config_path=CONFIG_PATH):
+    """Resolve the service socket from config.ini the same way the service does."""
+    config = configparser.ConfigParser()
+    if os.path.isfile(config_path):
+        config.read(config_path)
+    datadir = config.get('Paths', 'datadir', fallback=DEFAULT_DATADIR)
+    return config.get('Service', 'socket', fallback=os.path.join(datadir, 'mediastruct.sock'))
+
+def request(payload, path=None, timeout=None):
+    """Send one request to the service and return its decoded response."""
+    path = path or socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall((json.dumps(payload) + "\n").encode())
+        with sock.makefile('rb') as response:
+            return json.loads(response.readline())
+
+def main():
+    parser = argparse.ArgumentParser(description='MediaStruct service client')
+    parser.add_argument('command', choices=['ingest', 'crawl', 'dedupe', 'validate', 'query'], help='Command to send to the service')
+    parser.add_argument('-f', '--force', action='store_true', help='Force reprocessing')
+    parser.add_argument('--deadline', type=deadline_option, help='Stop the command cleanly at this time (HH:MM)')
+    parser.add_argument('--budget', type=duration_option, help='Stop the command cleanly after this long, e.g. 45m or 2h30m')
+    parser.add_argument('--hash', action='append', default=[], help='Hash to look up (query)')
+    parser.add_argument('--hashes-file', help="File of hashes to look up, one per line ('-' for stdin) (query)")
+    parser.add_argument('--path', action='append', default=[], help='Path to look up (query)')
+    parser.add_argument('--year', help='Year or inclusive year range, e.g. 2019 or 2015-2019 (query)')
+    parser.add_argument('--size', help='Inclusive size range, e.g. 1G-4G or 100M- (query)')
+    parser.add_argument('-s', '--socket', help='Service socket path')
+    args = parser.parse_args()
+
+    payload = {"command": args.command, "force": args.force, "deadline": args.deadline, "budget": args.budget}
+    if args.command == 'query':
+        # The file is read here, so the service needs no access to it; the service parses the lines
+        hash_lines = []
+        if args.hashes_file == '-':
+            hash_lines = sys.stdin.read().splitlines()
+        elif args.hashes_file:
+            with open(args.hashes_file, 'r') as f:
+                hash_lines = f.read().splitlines()
+        payload.update(hashes=args.hash, hash_lines=hash_lines, paths=[os.path.abspath(path) for path in args.path],
+                       year=args.year, size=args.size)
+    try:
+        response = request(payload, path=args.socket)
+    except OSError as e:
+        print(f"Client - Could not reach mediastruct service: {e}", file=sys.stderr)
+        sys.exit(2)
+    print(json.dumps(response, indent=2))
+    sys.exit(0 if response.get('ok') else 1)
+
+if __name__ == "__main__":
+    main()
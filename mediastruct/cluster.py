@@ -0,0 +1,214 @@
+"""Crawl across several nodes: workers hash target directories next to their disks, a coordinator merges the index."""
+import os
+import json
+import hmac
+import queue
+import socket
+import logging
+import threading
+import socketserver
+from mediastruct import crawl
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 7878
+DEFAULT_TIMEOUT = 300  # seconds a worker may go silent, connecting or mid-target, before its target is hashed locally
+HEARTBEAT = 30  # seconds between the lines a worker sends while it hashes, so a long target is not taken for a hung one
+LOOPBACK = ('127.0.0.1', 'localhost', '::1')
+
+def default_listen(token=None):
+    """Address a worker listens on when none is configured: every interface with a token, else only this host."""
+    return f"{'0.0.0.0' if token else '127.0.0.1'}:{DEFAULT_PORT}"
+
+def parse_address(value, default_port=DEFAULT_PORT):
+    """Split 'host:port' (or a bare host) into (host, port)."""
+    host, sep, port = value.strip().rpartition(':')
+    if not sep:
+        return value.strip(), default_port
+    return host.strip('[]') or '0.0.0.0', int(port)
+
+def _within(path, roots):
+    path = os.path.realpath(path)
+    return any(os.path.commonpath([path, os.path.realpath(root)]) == os.path.realpath(root) for root in roots)
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _Handler(socketserver.StreamRequestHandler):
+    """One JSON request line in; alive lines while the target is hashed, one JSON line per record, then a done (or error) line."""
+
+    def _send(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode())
+
+    def _hashed_records(self, request):
+        """Hash the target in a thread, sending an alive line every HEARTBEAT seconds until its records are ready."""
+        result = {}
+
+        def run():
+            try:
+                result['records'] = list(self.server.worker.records(request))
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(HEARTBEAT)
+        while thread.is_alive():
+            self._send({"alive": True})
+            thread.join(HEARTBEAT)
+        if 'error' in result:
+            raise result['error']
+        return result['records']
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            count = 0
+            for record in self._hashed_records(request):
+                self._send({"record": record})
+                count += 1
+            self._send({"done": True, "count": count})
+        except (BrokenPipeError, ConnectionResetError):
+            log.warning(f"Cluster - Coordinator {self.client_address} went away mid-target")
+        except Exception as e:
+            log.error(f"Cluster - Request from {self.client_address} failed: {e}")
+            self._send({"error": str(e)})
+
+class worker:
+    """Hash target directories on request and stream their index records back.
+
+    Only targets inside the configured roots are accepted, and when a token is
+    configured every request must carry it; without one the worker only
+    listens on a loopback address. The .mediastruct caches on this node are
+    used and updated as in a local crawl, so re-crawls stay cheap.
+    """
+
+    def __init__(self, address, roots, rules=None, hash_policy=None, max_workers=None, token=None):
+        self.address = address
+        self.roots = roots
+        self.rules = rules
+        self.hash_policy = hash_policy
+        self.max_workers = max_workers
+        self.token = token or None
+        if not self.token and address[0] not in LOOPBACK:
+            raise ValueError(f"Refusing to listen on {address[0]} without a [Cluster] token; any host that could reach it could request hashes")
+        self._log_progress(f"Initialized worker on {address[0]}:{address[1]} for roots {roots}")
+        self.run()
+
+    def _log_progress(self, message, level="info"):
+        """Log progress messages and print to console."""
+        print(f"Cluster - {message}")
+        getattr(log, level)(message)
+
+    def records(self, request: dict):
+        """Records of the requested target, after checking the token and that the target is ours to hash."""
+        if self.token and not hmac.compare_digest(str(request.get('token') or ''), self.token):
+            raise PermissionError("Bad or missing token")
+        target = request.get('target') or ''
+        if not os.path.isdir(target) or not _within(target, self.roots):
+            raise ValueError(f"Not a target directory under this worker's roots: {target}")
+        self._log_progress(f"Hashing {target}")
+        crawler = crawl.crawl(force=bool(request.get('force')), rootdir=target, datadir=None, rules=self.rules,
+                              max_workers=self.max_workers, hash_policy=self.hash_policy, run=False)
+        return crawler.target_records(target)
+
+    def run(self):
+        """Serve requests until interrupted."""
+        server = _Server(self.address, _Handler)
+        server.worker = self
+        self._log_progress(f"Listening on {self.address[0]}:{self.address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self._log_progress("Interrupted, shutting down")
+        finally:
+            server.server_close()
+
+class cluster(crawl.crawl):
+    """Crawl a root by handing its target directories to workers and merging their records into the usual index.
+
+    Each worker address gets slots concurrent targets. A target whose worker
+    fails, refuses it or stays silent for timeout seconds is hashed locally once
+    the workers are done, so an unreachable or hung node slows the crawl down
+    rather than leaving a hole in the index.
+    """
+
+    def __init__(self, force, rootdir, datadir, workers, slots=1, token=None, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.workers = list(workers)
+        self.slots = max(1, int(slots or 1))
+        self.token = token or None
+        self.timeout = timeout
+        super().__init__(force, rootdir, datadir, **kwargs)
+
+    def _log_progress(self, message, level="info"):
+        """Log progress messages and print to console."""
+        print(f"Cluster - {message}")
+        getattr(log, level)(message)
+
+    def _remote_records(self, address, target):
+        """Ask one worker for a target's records, returning them only once the whole target has arrived."""
+        # The worker does not know this host's [Paths], so it is told whether this target is forced
+        request = {"target": target, "force": bool(self._should_force_rehash(target)), "token": self.token}
+        records = []
+        with socket.create_connection(address, timeout=self.timeout) as sock:
+            sock.sendall((json.dumps(request) + "\n").encode())
+            with sock.makefile('rb') as response:
+                for line in response:
+                    message = json.loads(line)
+                    if 'record' in message:
+                        records.append(message['record'])
+                    elif message.get('alive'):
+                        continue
+                    elif message.get('done'):
+                        return records
+                    else:
+                        raise RuntimeError(message.get('error', 'unknown worker error'))
+        raise ConnectionError("Worker closed the connection before finishing the target")
+
+    def _index_targets(self, targets, sum_dict, processed_file_paths, total_files):
+        pending = queue.Queue()
+        for target in targets:
+            pending.put(target)
+        lock = threading.Lock()
+        local = []
+        done = []
+
+        def drive(address):
+            # Once the budget is spent, targets still queued fall through to the local pass, which defers them
+            while not (self.budget and self.budget.expired()):
+                try:
+                    target = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    records = self._remote_records(address, target)
+                except (OSError, ValueError, RuntimeError) as e:
+                    self._log_progress(f"Worker {address[0]}:{address[1]} failed on {target}, hashing it locally: {e}", "warning")
+                    with lock:
+                        local.append(target)
+                    if isinstance(e, OSError):
+                        return  # the node is unreachable; leave its share to the other workers
+                    continue
+                with lock:
+                    added = sum(self.add_record(sum_dict, processed_file_paths, record) for record in records)
+                    done.append(target)
+                    self._log_progress(f"Merged {added} records for {target} from {address[0]}:{address[1]} ({len(done)}/{len(targets)} targets)")
+                    if self.monitor:
+                        self.monitor.update_progress("crawl", status="Running", processed=len(done), total=len(targets), current=f"Merged {target}")
+
+        if not self.workers:
+            self._log_progress("No workers configured, hashing every target locally", "warning")
+        threads = [threading.Thread(target=drive, args=(address,), daemon=True) for address in self.workers for _ in range(self.slots)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        while not pending.empty():
+            local.append(pending.get_nowait())
+        if local:
+            super()._index_targets(local, sum_dict, processed_file_paths, total_files)
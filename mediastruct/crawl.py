@@ -2,18 +2,20 @@
 import os
 import re
 import logging
-import xxhash
-import json
 import yaml
-import uuid
 import time
 import datetime
 from datetime import timedelta
 from pathlib import Path
 from concurrent.futures import ProcessPoolExecutor
 from mediastruct.utils import *
+from mediastruct.rules import PathRules
+from mediastruct.index import index_path, load_index, write_index, write_delta, generation, record_id
+from mediastruct.hashing import HashPolicy, FLAT_ALGORITHM, record_algorithm
+from mediastruct.store import BlobStore, is_store
+from mediastruct.catalog import Catalog
+from mediastruct import throttle
 from os import walk, stat
-from os.path import join as joinpath
 import psutil
 
 # Setup logging from the parent class
@@ -21,24 +23,44 @@ log = logging.getLogger(__name__)
 log.info("Crawl - Loaded crawl.py module")
 
 # Function to hash a file in chunks (must be defined at the module level for ProcessPoolExecutor)
-def hash_file(file_path: str) -> tuple[str, str]:
-    """Hash a single file using xxhash, reading in chunks to reduce memory usage."""
+def hash_file(file_path: str, policy: HashPolicy = None) -> tuple[str, str, dict]:
+    """Hash a single file, flat or as a tree hash per policy, returning (path, hash, extra record fields)."""
     try:
-        file_path = Path(file_path)
-        hasher = xxhash.xxh64()
-        with file_path.open('rb') as f:
-            # Read in 1 MB chunks to limit memory usage
-            chunk_size = 1024 * 1024  # 1 MB
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-                hasher.update(chunk)
-        file_hash = hasher.hexdigest()
-        return str(file_path), file_hash
+        file_hash, extra = (policy or HashPolicy()).hash_file(str(file_path))
+        return str(file_path), file_hash, extra
     except Exception as e:
         log.error(f"Crawl - Failed to hash file {file_path}: {e}")
-        return str(file_path), None
+        return str(file_path), None, {}
+
+def cache_entry(file_hash: str, extra: dict):
+    """Value stored in a .mediastruct hash cache: the bare hash for flat hashes, a dict for tree hashes."""
+    return dict(extra, filehash=file_hash) if extra else file_hash
+
+def read_cache_entry(entry) -> tuple[str, dict]:
+    """Split a .mediastruct hash cache value back into (hash, extra record fields)."""
+    if isinstance(entry, dict):
+        extra = dict(entry)
+        return extra.pop('filehash'), extra
+    return entry, {}
+
+def _within(path: str, root: str) -> bool:
+    """True if path is root or lies beneath it."""
+    path, root = os.path.normpath(path), os.path.normpath(root)
+    return path == root or path.startswith(root.rstrip('/') + '/')
+
+def build_record(file_path: str, file_hash: str, extra: dict = None) -> dict:
+    """Build the index entry for a hashed file; raises FileNotFoundError if it has gone."""
+    filesize = stat(file_path).st_size
+    this_year = str(datetime.datetime.fromtimestamp(os.path.getmtime(file_path))).split('-')[0]
+    record = {
+        'filehash': file_hash,
+        'path': file_path,
+        'filesize': filesize,
+        'year': this_year
+    }
+    if extra:
+        record.update(extra)
+    return record
 
 class crawl:
     """Iterate a dir tree and build a sum index with memory usage capping."""
@@ -48,11 +70,25 @@ class crawl:
     BASE_MAX_PROCESSES = os.cpu_count() or 4  # Base number of processes
     BATCH_SIZE = 1000  # Process files in batches of 1000 to limit memory usage
 
-    def __init__(self, force, rootdir, datadir, monitor=None):
+    def __init__(self, force, rootdir, datadir, monitor=None, rules=None, max_workers=None, cache=None, hash_policy=None, run=True, catalog_path=None, budget=None,
+                 media_dir=None, ingest_dir=None):
         self.monitor = monitor
+        # Configured [Paths]: media targets are always rehashed, the ingest root is sized but not hashed
+        self.media_dir = media_dir
+        self.ingest_dir = ingest_dir
+        # Once the budget is spent, hashing stops between batches and the rest is left for the next crawl
+        self.budget = budget
+        # Hashing throughput per mount point, stored in the catalog for --estimate
+        self.catalog_path = catalog_path
+        self.measured = {}
+        self.hash_policy = hash_policy if hash_policy is not None else HashPolicy()
+        self.cache = cache
         self.force = force
         self.datadir = datadir
         self.rootdir = rootdir
+        self.rules = rules if rules is not None else PathRules()
+        # Upper bound on hashing processes, set by the device scheduler to share cores between disks
+        self.max_workers = max_workers or self.BASE_MAX_PROCESSES
         # Get total system memory
         self.total_memory = psutil.virtual_memory().total
         self.memory_limit = self.total_memory * self.MEMORY_LIMIT_PERCENT
@@ -61,7 +97,8 @@ class crawl:
         dirname_len = len(dirname) - 1
         print('dirname_len: ', dirname_len)
         log.info("Crawl - Crawling %s" % (rootdir))
-        if os.path.isdir(rootdir):
+        # run=False only sets up the crawler, for a cluster worker hashing single targets
+        if run and os.path.isdir(rootdir):
             log.info('Crawl - Indexing %s' % (rootdir))
             index = self.index_sum()
 
@@ -77,6 +114,13 @@ class crawl:
             if not metadata or 'timestamp' not in metadata:
                 log.error(f"Crawl - Metadata file {metadata_path} is missing 'timestamp' key")
                 return False
+            if metadata.get('partial'):
+                log.debug(f"Crawl - Metadata file {metadata_path} is from a crawl stopped by its budget")
+                return False
+            foreign = self._foreign_algorithms(metadata)
+            if foreign:
+                log.info(f"Crawl - Metadata file {metadata_path} holds {', '.join(sorted(foreign))} hashes, rehashing with {self.hash_policy.algorithm}")
+                return False
             timestamp = datetime.datetime.fromisoformat(metadata["timestamp"])
             age = datetime.datetime.now() - timestamp
             is_current = age <= timedelta(days=self.MAX_AGE_DAYS)
@@ -86,36 +130,18 @@ class crawl:
             log.error(f"Crawl - Failed to read metadata file {metadata_path}: {e}")
             return False
 
-    def _is_target_subdirectory(self, path_str: str) -> bool:
-        """Determine if a directory is a target subdirectory to process (one level down from parent)."""
-        # Skip duplicates, validated, and ingest directories
-        if any(path_str.startswith(prefix) for prefix in ["/data/media/duplicates", "/data/media/validated", "/data/media/ingest"]):
-            log.debug(f"Crawl - Skipping directory (excluded): {path_str}")
-            return False
-        # Skip parent directories
-        if path_str in ["/data/archive", "/data/media/media"]:
-            log.debug(f"Crawl - Skipping parent directory: {path_str}")
-            return False
-        # For /data/archive, match /data/archive/\d+ (e.g., /data/archive/01)
-        if path_str.startswith("/data/archive"):
-            match = bool(re.match(r"^/data/archive/\d+$", path_str))
-            log.debug(f"Crawl - Directory {path_str} {'is' if match else 'is not'} a target archive subdirectory")
-            return match
-        # For /data/media/media, match /data/media/media/\d{4} (e.g., /data/media/2024)
-        if path_str.startswith("/data/media/media"):
-            match = bool(re.match(r"^/data/media/media/\d{4}$", path_str))
-            log.debug(f"Crawl - Directory {path_str} {'is' if match else 'is not'} a target media subdirectory")
-            return match
-        log.debug(f"Crawl - Skipping directory not under /data/archive or /data/media/media: {path_str}")
-        return False
+    def _foreign_algorithms(self, metadata: dict) -> set:
+        """Algorithms of cached hashes the hash policy would not produce, which cannot be compared with its hashes."""
+        algorithms = {record_algorithm(read_cache_entry(entry)[1]) for entry in (metadata.get('files') or {}).values()}
+        return algorithms - self.hash_policy.algorithms()
 
     def _should_force_rehash(self, path_str: str) -> bool:
         """Determine if rehashing should be forced for a directory."""
-        # Always force rehash for /data/media/media subdirectories
-        if path_str.startswith("/data/media/media"):
+        # Always force rehash for subdirectories of the media directory
+        if self.media_dir and _within(path_str, self.media_dir):
             log.debug(f"Crawl - Forcing rehash for media directory: {path_str}")
             return True
-        # Respect force flag for other directories (e.g., /data/archive subdirectories)
+        # Respect force flag for other directories (e.g., archive subdirectories)
         return self.force
 
     def _estimate_file_size(self, file_path: str) -> int:
@@ -142,10 +168,19 @@ class crawl:
         # Add 2x buffer to account for Python overhead
         memory_per_file = avg_file_size * 2
         max_concurrent_files = int(self.memory_limit / memory_per_file)
-        max_concurrent_files = max(1, min(max_concurrent_files, self.BASE_MAX_PROCESSES))
+        max_concurrent_files = max(1, min(max_concurrent_files, self.max_workers))
         log.debug(f"Crawl - Estimated avg file size: {avg_file_size / (1024**2):.2f} MB, max concurrent files: {max_concurrent_files}")
         return max_concurrent_files
 
+    def _load_metadata(self, metadata_path) -> dict:
+        """Existing .mediastruct metadata, or None if it is missing or unreadable."""
+        try:
+            with Path(metadata_path).open("r") as f:
+                metadata = yaml.safe_load(f)
+        except (OSError, yaml.YAMLError) as e:
+            return None
+        return metadata if isinstance(metadata, dict) and isinstance(metadata.get('files'), dict) else None
+
     def _create_or_update_metadata(self, directory: str) -> dict:
         """Create or update the .mediastruct metadata file in the given directory."""
         directory = Path(directory)
@@ -171,6 +206,9 @@ class crawl:
             self.monitor.update_progress("crawl", status="Running", processed=0, total=total_files, current=f"Hashing files in {directory}")
         log.debug(f"Crawl - Hashing {total_files} files in {directory}")
 
+        # A crawl stopped by its budget left the files it hashed; only the rest are hashed now
+        previous = self._load_metadata(metadata_path)
+        resumed = previous['files'] if previous and previous.get('partial') else {}
         file_paths = []
         for root, _, files in walk(directory):
             relative_root = Path(root).relative_to(directory)
@@ -180,7 +218,12 @@ class crawl:
                     continue
                 file_path = Path(root) / filename
                 relative_path = str(relative_root / filename)
+                if relative_path in resumed:
+                    metadata["files"][relative_path] = resumed[relative_path]
+                    continue
                 file_paths.append((str(file_path), relative_path))
+        if resumed:
+            log.info(f"Crawl - Resuming {directory}: {len(metadata['files'])} files hashed by the previous crawl, {len(file_paths)} left")
 
         log.debug(f"Crawl - Found {len(file_paths)} files to hash in {directory}")
 
@@ -189,16 +232,22 @@ class crawl:
         log.debug(f"Crawl - Using {max_workers} workers for directory {directory}")
 
         # Process files in batches to limit memory usage
+        start_time = time.time()
+        hashed_bytes = 0
         for batch_start in range(0, len(file_paths), self.BATCH_SIZE):
+            if self.budget and self.budget.expired():
+                self._defer(metadata, previous, file_paths[batch_start:])
+                break
             batch = file_paths[batch_start:batch_start + self.BATCH_SIZE]
-            with ProcessPoolExecutor(max_workers=max_workers) as executor:
-                futures = {executor.submit(hash_file, file_path): (file_path, relative_path) for file_path, relative_path in batch}
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=throttle.CONTEXT, initializer=throttle.install, initargs=(throttle.current(),)) as executor:
+                futures = {executor.submit(hash_file, file_path, self.hash_policy): (file_path, relative_path) for file_path, relative_path in batch}
                 for future in futures:
                     file_path, relative_path = futures[future]
                     try:
-                        _, file_hash = future.result()
+                        _, file_hash, extra = future.result()
                         if file_hash:
-                            metadata["files"][relative_path] = file_hash
+                            metadata["files"][relative_path] = cache_entry(file_hash, extra)
+                            hashed_bytes += self._estimate_file_size(file_path)
                             log.debug(f"Crawl - Hashed file {file_path} with hash {file_hash}")
                         else:
                             log.warning(f"Crawl - No hash generated for file {file_path}")
@@ -210,6 +259,10 @@ class crawl:
                         log.error(f"Crawl - Failed to process file {file_path}: {e}")
 
         log.info(f"Crawl - Generated metadata with {len(metadata['files'])} file entries for {directory}")
+        measured = self.measured.setdefault(mount_point(str(directory)), [0, 0, 0.0])
+        measured[0] += hashed_bytes
+        measured[1] += processed_files
+        measured[2] += time.time() - start_time
 
         try:
             with metadata_path.open("w") as f:
@@ -220,32 +273,94 @@ class crawl:
 
         return metadata
 
+    def _defer(self, metadata, previous, remaining):
+        """Mark metadata as partial when the budget runs out, keeping earlier hashes of the unhashed files for the index."""
+        metadata["partial"] = True
+        earlier = (previous.get('stale', {}) if previous.get('partial') else previous['files']) if previous else {}
+        metadata["stale"] = {relative_path: earlier[relative_path] for _, relative_path in remaining if relative_path in earlier}
+        log.warning(f"Crawl - Budget spent, {len(remaining)} files left unhashed for the next crawl ({len(metadata['stale'])} indexed from their earlier hashes)")
+
+    def _metadata_records(self, directory: str, metadata: dict):
+        """Yield index records for the cached entries in metadata, including earlier hashes of deferred files."""
+        entries = dict(metadata.get("stale") or {})
+        entries.update(metadata["files"])
+        for relative_path, entry in entries.items():
+            file_hash, extra = read_cache_entry(entry)
+            file_path = os.path.join(directory, relative_path)
+            try:
+                yield build_record(file_path, file_hash, extra)
+            except FileNotFoundError as e:
+                log.error(f"Crawl - Skipping file {file_path}: {e}")
+
+    def target_records(self, directory: str):
+        """Yield the index record of every file in a target directory, hashing only what its cache lacks."""
+        return self._metadata_records(directory, self._create_or_update_metadata(directory))
+
+    def _needs_hashing(self, directory: str) -> bool:
+        return self._should_force_rehash(directory) or not self._is_metadata_current(os.path.join(directory, self.METADATA_FILE))
+
+    def _target_priority(self, directory: str):
+        """Sort key putting never-hashed targets first, then forced or stale ones (oldest cache first), then current ones.
+
+        Staleness is judged from the cache file's mtime so ordering needs no YAML parsing.
+        """
+        try:
+            age = time.time() - os.stat(os.path.join(directory, self.METADATA_FILE)).st_mtime
+        except OSError:
+            return (0, 0)
+        if self._should_force_rehash(directory) or age > self.MAX_AGE_DAYS * 86400:
+            return (1, -age)
+        return (2, 0)
+
+    def add_record(self, sum_dict: dict, processed_file_paths: set, record: dict) -> bool:
+        """Add a record to sum_dict under its path's stable id unless its path is already indexed."""
+        if record['path'] in processed_file_paths:
+            log.debug(f"Crawl - Skipping already processed file: {record['path']}")
+            return False
+        processed_file_paths.add(record['path'])
+        sum_dict[record_id(record['path'])] = record
+        return True
+
     def _index_files(self, directory: str, sum_dict: dict, processed_file_paths: set) -> int:
         """Index files in a directory and add to sum_dict, returning the number of files processed."""
-        metadata = self._create_or_update_metadata(directory)
+        return sum(self.add_record(sum_dict, processed_file_paths, record) for record in self.target_records(directory))
+
+    def _index_targets(self, targets: list, sum_dict: dict, processed_file_paths: set, total_files: int):
+        """Index every target directory in turn, most valuable first; overridden by the cluster coordinator to farm them out.
+
+        Once the budget is spent, targets needing a rehash are indexed from whatever
+        their cache already holds and left for the next crawl.
+        """
         processed_files = 0
-        for relative_path, file_hash in metadata["files"].items():
-            file_path = os.path.join(directory, relative_path)
-            if file_path in processed_file_paths:
-                log.debug(f"Crawl - Skipping already processed file: {file_path}")
+        deferred = 0
+        for path_str in sorted(targets, key=self._target_priority):
+            log.debug(f"Crawl - Processing target subdirectory: {path_str}")
+            if self.budget and self.budget.expired() and self._needs_hashing(path_str):
+                metadata = self._load_metadata(os.path.join(path_str, self.METADATA_FILE))
+                records = self._metadata_records(path_str, metadata) if metadata else ()
+                processed_files += sum(self.add_record(sum_dict, processed_file_paths, record) for record in records)
+                deferred += 1
                 continue
-            processed_file_paths.add(file_path)
-            fileid = str(uuid.uuid1())
+            processed_files += self._index_files(path_str, sum_dict, processed_file_paths)
+            if self.monitor and total_files > 0:
+                self.monitor.update_progress("crawl", status="Running", processed=processed_files, total=total_files, current=f"Processed directory: {path_str}")
+            if total_files > 0:
+                log.debug(f"Crawl - Indexed {processed_files}/{total_files} files ({(processed_files/total_files)*100:.1f}%)")
+        if deferred:
+            log.warning(f"Crawl - Budget spent, {deferred} targets indexed from their existing caches and left for the next crawl")
+
+    def _index_store(self, rootdir: str, sum_dict: dict, processed_file_paths: set) -> int:
+        """Index the blobs of a content-addressed archive from their names; they are reread only by scrub."""
+        count = 0
+        for blob_path, file_hash, hashalg in BlobStore(rootdir).blobs():
             try:
-                filesize = stat(file_path).st_size
-                this_year = str(datetime.datetime.fromtimestamp(os.path.getmtime(file_path))).split('-')[0]
+                record = build_record(blob_path, file_hash, {'hashalg': hashalg} if hashalg != FLAT_ALGORITHM else {})
             except FileNotFoundError as e:
-                log.error(f"Crawl - Skipping file {file_path}: {e}")
+                log.error(f"Crawl - Skipping blob {blob_path}: {e}")
                 continue
-            index_line = {
-                'filehash': file_hash,
-                'path': file_path,
-                'filesize': filesize,
-                'year': this_year
-            }
-            sum_dict[fileid] = index_line
-            processed_files += 1
-        return processed_files
+            count += self.add_record(sum_dict, processed_file_paths, record)
+        log.info(f"Crawl - Indexed {count} blobs of the content-addressed archive in {rootdir}")
+        return count
 
     def index_sum(self):
         """Index hash sum of all files in a directory tree and write to Json file"""
@@ -268,46 +383,59 @@ class crawl:
                 log.error(f"Crawl - Failed to create data directory {datadir}: {e}")
                 return sum_dict  # Return empty dict if directory creation fails
 
-        # Walk the structure of the target dir tree
-        total_files = sum(len(files) for path, dirs, files in walk(rootdir))
-        processed_files = 0
+        # Collect target directories; excluded subtrees are pruned before they are listed
+        is_ingest = bool(self.ingest_dir) and os.path.normpath(rootdir) == os.path.normpath(self.ingest_dir)
+        targets = [] if is_ingest else list(self.rules.targets(rootdir))
+        total_files = sum(len(files) for target in targets for _, _, files in walk(target))
 
         if self.monitor:
             self.monitor.update_progress("crawl", status="Running", processed=0, total=total_files, current=f"Indexing files in {rootdir}")
         log.debug(f"Crawl - Indexing {total_files} files in {rootdir}")
 
-        # Process the root directory for /data/media/ingest
-        if rootdir == "/data/media/ingest":
+        # Process the root directory for the ingest directory
+        if is_ingest:
             log.debug(f"Crawl - Skipping ingest directory: {rootdir} (excluded)")
             # Ingest is not hashed, so we skip it but still need to create an index file
             sum_dict['du'] = utils.getFolderSize(self, rootdir)
         else:
-            # Process subdirectories for /data/media/media and /data/archive
-            for path, dirs, files in walk(rootdir):
-                path_str = str(Path(path).as_posix())  # Normalize path
-                log.debug(f"Crawl - Checking directory: {path_str}")
-                # Process only target subdirectories (one level down)
-                if not self._is_target_subdirectory(path_str):
-                    continue
-                log.debug(f"Crawl - Processing target subdirectory: {path_str}")
-                processed_files += self._index_files(path_str, sum_dict, processed_file_paths)
-                if self.monitor and total_files > 0:
-                    self.monitor.update_progress("crawl", status="Running", processed=processed_files, total=total_files, current=f"Processed directory: {path_str}")
-                log.debug(f"Crawl - Indexed {processed_files}/{total_files} files ({(processed_files/total_files)*100:.1f}%)")
+            # Process target subdirectories for the media and archive directories
+            self._index_targets(targets, sum_dict, processed_file_paths, total_files)
+            if is_store(rootdir):
+                self._index_store(rootdir, sum_dict, processed_file_paths)
 
         log.info(f"Crawl - Populated sum_dict with {len(sum_dict)} entries for {rootdir}")
 
         # Always write the index file, even if empty (e.g., for ingest)
         if 'du' not in sum_dict:
-            sum_dict['du'] = utils.getFolderSize(self, rootdir)
-        indexfilepath = f'{datadir}/{dirname[dirname_len]}_index.json'
+            sum_dict['du'] = utils.getFolderSize(self, rootdir, rules=self.rules)
+        indexfilepath = index_path(datadir, rootdir)
         try:
-            with open(indexfilepath, "w") as indexfile:
-                jsonoutput = json.dumps(sum_dict)
-                indexfile.write(jsonoutput)
+            # The generation being replaced, for the delta consumers can apply instead of rereading the index
+            base = generation(indexfilepath)
+            previous = (self.cache.get(indexfilepath) if self.cache is not None else load_index(indexfilepath)) if base else {}
+            write_index(indexfilepath, sum_dict)
+            if self.cache is not None:
+                self.cache.put(indexfilepath, sum_dict)
             log.debug(f"Crawl - Wrote index file: {indexfilepath}")
+            delta = write_delta(indexfilepath, previous, base, sum_dict)
+            log.info(f"Crawl - Delta for {rootdir}: {len(delta['added'])} added, {len(delta['removed'])} removed, {len(delta['changed'])} changed")
         except Exception as e:
             log.error(f"Crawl - Failed to write index file {indexfilepath}: {e}")
 
+        self.record_throughput()
         log.info("Crawl - Completed crawl of %s" % (rootdir))
         return sum_dict
+
+    def record_throughput(self):
+        """Store the hashing throughput measured on each mount point in the catalog."""
+        if not self.catalog_path or not self.measured:
+            return
+        catalog = Catalog(self.catalog_path)
+        try:
+            for mount, (nbytes, files, seconds) in self.measured.items():
+                catalog.record_throughput(mount, 'hash', nbytes, files, seconds)
+                log.info(f"Crawl - Hashed {nbytes / (1024 ** 2):.1f} MB in {seconds:.1f}s on {mount}")
+        except Exception as e:
+            log.error(f"Crawl - Failed to record throughput: {e}")
+        finally:
+            catalog.close()
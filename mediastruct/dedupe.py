@@ -1,23 +1,57 @@
 import os
-import sys
 import logging
 import json
 import shutil
 import time
 import timeout_decorator
+from contextlib import nullcontext
 from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from mediastruct import throttle
+from mediastruct.hashing import record_algorithm, same_content
+from mediastruct.perceptual import near_duplicate_groups, hamming
+from mediastruct.catalog import Catalog
+from mediastruct.listing import DirectoryListing
+from mediastruct import layout
+from mediastruct.index import generation
+from mediastruct.utils import mount_point
 
 log = logging.getLogger(__name__)
 print("Dedupe - Initializing logging")
 log.info('Dedupe - Launching the Dedupe Class')
 
 class dedupe:
-    def __init__(self, data_files, duplicates_dir, archive_dir, ingest_dir, monitor=None):
+    def __init__(self, data_files, duplicates_dir, archive_dir, ingest_dir, monitor=None, cache=None, catalog_path=None,
+                 near_duplicates=None, near_action='report', near_distance=6, near_duplicates_dir=None, move_lock=None, budget=None, check_sizes=False):
         self.monitor = monitor
+        # Existence is checked against directory listings; comparing sizes with the index costs a stat per file
+        self.check_sizes = check_sizes
+        # Moves stop once the budget is spent; what is left is found again by the next dedupe
+        self.budget = budget
+        # Locks held only while files are moved, so planning overlaps other commands; the plan is
+        # dropped if an index it was built from is rewritten before the locks are granted
+        self.move_lock = move_lock or nullcontext
+        self.generations = {}
+        self.cache = cache
+        # Strong digests confirming each fast-hash match are cached here between runs
+        self.catalog_path = catalog_path
+        self.strong_hashes = {}
+        # Moves are recorded in the duplicates manifest, which validate reads to confirm them by stat instead of rehashing
         self.duplicates_dir = duplicates_dir
+        self.manifest = layout.manifest(duplicates_dir)
         self.archive_dir = archive_dir
         self.ingest_dir = ingest_dir
+        # Images whose perceptual hashes are within near_distance bits are reported here for review ('report')
+        # or, with 'move', their lesser copies are also sent to near_duplicates_dir; they are not identical,
+        # so they never go to the duplicates directory, whose files validate confirms by hash
+        if near_action not in ('report', 'move'):
+            raise ValueError(f"Unknown near-duplicate action: {near_action} (expected report or move)")
+        if near_action == 'move' and not near_duplicates_dir:
+            raise ValueError("Moving near-duplicates needs a near_duplicates_dir")
+        self.near_duplicates = near_duplicates
+        self.near_action = near_action
+        self.near_distance = near_distance
+        self.near_duplicates_dir = near_duplicates_dir
         self.max_threads = os.cpu_count() or 4
         self.max_processes = os.cpu_count() or 4
         self._log_progress(f"Initialized with data_files: {data_files}, duplicates_dir: {duplicates_dir}, archive_dir: {archive_dir}, ingest_dir: {ingest_dir}")
@@ -63,7 +97,8 @@ class dedupe:
                 continue
             try:
                 start_time = time.time()
-                array = self._load_json_file(file_path)
+                self.generations[file_path] = generation(file_path)
+                array = self.cache.get(file_path) if self.cache is not None else self._load_json_file(file_path)
                 combined_array.update(array)
                 self._log_progress(f"Loaded file {file_path} in {time.time() - start_time:.2f} seconds")
             except TimeoutError:
@@ -78,51 +113,65 @@ class dedupe:
         return combined_array
 
     def _identify_duplicates(self, chunk, archive_hashes, media_hashes, archive_dir_name, media_dir):
-        """Identify duplicates in a chunk of files using precomputed hashes."""
+        """Identify duplicates in a chunk of files using precomputed (algorithm, hash) keys."""
         process_id = os.getpid()
         self._log_progress(f"Process {process_id} starting to identify duplicates for chunk of size {len(chunk)}")
         duplicates = []
-        for file_id, file_hash, file_path in chunk:
+        for file_id, hash_key, file_path in chunk:
             # Normalize paths for consistent comparison
             normalized_path = Path(file_path).as_posix().lower()
             self._log_progress(f"Process {process_id} processing file: {normalized_path}")
             if archive_dir_name.lower() in normalized_path:
                 self._log_progress(f"Process {process_id} skipping archive file: {normalized_path}")
                 continue
-            if file_hash in archive_hashes:
-                duplicates.append((file_id, file_hash, file_path))
+            if hash_key in archive_hashes:
+                duplicates.append((file_id, hash_key, file_path))
                 self._log_progress(f"Process {process_id} found duplicate against archive: {normalized_path}")
                 continue
             if media_dir.lower() in normalized_path:
-                media_hashes.setdefault(file_hash, []).append((file_id, file_hash, file_path))
-                self._log_progress(f"Process {process_id} processed media file: {normalized_path}, using precomputed hash: {file_hash}")
+                media_hashes.setdefault(hash_key, []).append((file_id, hash_key, file_path))
+                self._log_progress(f"Process {process_id} processed media file: {normalized_path}, using precomputed {hash_key[0]} hash: {hash_key[1]}")
             else:
                 self._log_progress(f"Process {process_id} keeping non-media, non-archive file (e.g., ingest): {normalized_path}")
         self._log_progress(f"Process {process_id} identified {len(duplicates)} duplicates in chunk")
         return duplicates, media_hashes
 
-    def _move_file(self, file_entry, array, archive_dir_name):
-        """Move a file to the duplicates directory."""
+    def _confirm_duplicate(self, from_path, keepers, catalog):
+        """Confirm a fast-hash match with a strong digest before the file is moved."""
+        try:
+            if same_content(from_path, keepers, catalog, self.strong_hashes):
+                return True
+        except OSError as e:
+            self._log_progress(f"Could not compute strong digest for {from_path}: {e}", "error")
+            return False
+        self._log_progress(f"Fast hash matched but content differs from every kept copy, not moving: {from_path} (kept: {keepers})", "error")
+        return False
+
+    def _move_file(self, file_entry, array, archive_dir_name, keepers=(), catalog=None, listing=None):
+        """Move a file to the duplicates directory once its content is confirmed to match a kept copy."""
         file_id, _, file_path = file_entry
+        file_hash = array[file_id]['filehash']
+        if self.budget and self.budget.expired():
+            return None
         from_path = array[file_id]['path']
-        if not os.path.isfile(from_path):
+        if not (listing.isfile(from_path) if listing else os.path.isfile(from_path)):
             self._log_progress(f"File not found, cannot move: {from_path}", "warning")
-            return
-        filename = os.path.basename(from_path)
-        dest_path = os.path.join(self.duplicates_dir, filename)
-        if os.path.isfile(dest_path):
-            ext = os.path.splitext(from_path)[1][1:]
-            newfile = os.path.splitext(filename)[0]
-            millis = int(round(time.time() * 1000))
-            newfilename = f"{newfile}.{millis}.{ext}"
-            dest_path = os.path.join(self.duplicates_dir, newfilename)
-            self._log_progress(f"Destination path already exists, renamed to: {dest_path}")
+            return False
+        dest_path = layout.shard_path(self.duplicates_dir, file_hash, os.path.basename(from_path))
 
         if archive_dir_name.lower() not in Path(from_path).as_posix().lower():
+            if not self._confirm_duplicate(from_path, keepers, catalog):
+                return False
             self._log_progress(f"Moving duplicate to duplicates directory: {from_path} -> {dest_path}")
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            throttle.acquire_move(from_path, self.duplicates_dir)
             shutil.move(from_path, dest_path)
-        else:
-            self._log_progress(f"File {from_path} is in archive directory and will not be moved (safety check)", "warning")
+            if listing:
+                listing.discard(from_path)
+            self.manifest.append(dest_path, file_hash, from_path, record_algorithm(array[file_id]))
+            return True
+        self._log_progress(f"File {from_path} is in archive directory and will not be moved (safety check)", "warning")
+        return False
 
     def dups(self, array):
         """Deduplicate files using precomputed hashes."""
@@ -131,7 +180,9 @@ class dedupe:
         # Step 1: Build list of all files and archive hashes
         self._log_progress("Building list of all files and archive hashes")
         all_files = []
-        archive_hashes = set()
+        # (algorithm, hash) -> archive copies, the kept side of archive duplicates; hashes only
+        # compare under the same algorithm, so xxh64, xxh3 and tree hashes are never matched across
+        archive_paths = {}
         archive_dir_name = Path(self.archive_dir).name
         media_dir = "/data/media"
         total_entries = len(array)
@@ -139,22 +190,32 @@ class dedupe:
         if self.monitor:
             self.monitor.update_progress("dedupe", status="Running", processed=0, total=total_entries, current="Building file lists")
 
+        # One scandir per parent directory rather than a stat per entry; the listings serve every later check
+        start_time = time.time()
+        listing = DirectoryListing().load((data['path'] for d, data in array.items() if d != 'du'), workers=self.max_threads)
+        self._log_progress(f"Listed {len(listing.listings)} directories in {time.time() - start_time:.2f} seconds")
+
         for i, (d, data) in enumerate(array.items(), 1):
             if d == 'du':
                 continue
             file_path = data['path']
-            if not os.path.isfile(file_path):
+            if not listing.isfile(file_path):
                 self._log_progress(f"File {file_path} not found on disk, skipping", "warning")
                 continue
-            file_entry = (d, data['filehash'], file_path)
+            size = listing.size(file_path) if self.check_sizes and data.get('filesize') is not None else None
+            if size is not None and size != data['filesize']:
+                self._log_progress(f"File {file_path} changed since it was indexed ({data['filesize']} -> {size} bytes), skipping", "warning")
+                continue
+            file_entry = (d, (record_algorithm(data), data['filehash']), file_path)
             all_files.append(file_entry)
             if archive_dir_name.lower() in Path(file_path).as_posix().lower():
-                archive_hashes.add(data['filehash'])
+                archive_paths.setdefault(file_entry[1], []).append(file_path)
             if i % 10000 == 0:
                 self._log_progress(f"Processed {i}/{total_entries} entries ({(i/total_entries)*100:.1f}%)")
             if self.monitor:
                 self.monitor.update_progress("dedupe", status="Running", processed=i, total=total_entries, current=f"Processing entry: {d}")
 
+        archive_hashes = set(archive_paths)
         self._log_progress(f"Total files after filtering: {len(all_files)}, archive hashes: {len(archive_hashes)}")
 
         # Step 2: Identify duplicates using multi-processing
@@ -176,8 +237,8 @@ class dedupe:
         # Combine media hashes from all chunks
         media_hashes = {}
         for chunk_hashes in media_hashes_per_chunk:
-            for file_hash, entries in chunk_hashes.items():
-                media_hashes.setdefault(file_hash, []).extend(entries)
+            for hash_key, entries in chunk_hashes.items():
+                media_hashes.setdefault(hash_key, []).extend(entries)
                 media_files_count += len(entries)
         self._log_progress(f"Loaded {media_files_count} media files into media_hashes")
         self._log_progress(f"Identified {len(to_delete)} duplicates against archive (including ingest files)")
@@ -185,44 +246,145 @@ class dedupe:
         # Step 3: Deduplicate within media directory
         self._log_progress("Deduplicating within media directory")
         media_to_keep = []
-        for file_hash, entries in media_hashes.items():
+        keepers = {}  # file id -> kept copies it must match before it is moved
+        for (hashalg, file_hash), entries in media_hashes.items():
             if len(entries) <= 1:
                 media_to_keep.extend(entry[0] for entry in entries)
-                self._log_progress(f"Keeping media file (unique hash {file_hash}): {entries[0][2]}")
+                self._log_progress(f"Keeping media file (unique {hashalg} hash {file_hash}): {entries[0][2]}")
                 continue
             entries.sort(key=lambda x: x[2])  # Sort by filepath
             media_to_keep.append(entries[0][0])
-            self._log_progress(f"Keeping media file (first instance of hash {file_hash}): {entries[0][2]}")
+            self._log_progress(f"Keeping media file (first instance of {hashalg} hash {file_hash}): {entries[0][2]}")
             to_delete.extend(entries[1:])
             for entry in entries[1:]:
+                keepers[entry[0]] = [entries[0][2]]
                 self._log_progress(f"Media duplicate will be moved: {entry[2]} (hash: {file_hash})")
 
         self._log_progress(f"Total duplicates after media deduplication: {len(to_delete)}")
 
-        # Step 4: Move duplicates using multi-threading
+        # Step 4: Move duplicates using multi-threading, largest savings first in case the budget runs out
+        to_delete.sort(key=lambda entry: array[entry[0]].get('filesize') or 0, reverse=True)
         total_to_delete = len(to_delete)
         self._log_progress(f"Moving {total_to_delete} duplicate files")
         if self.monitor:
             self.monitor.update_progress("dedupe", status="Running", processed=0, total=total_to_delete, current="Moving duplicates")
 
-        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            futures = [executor.submit(self._move_file, entry, array, archive_dir_name) for entry in to_delete]
-            for i, future in enumerate(futures, 1):
-                future.result()
-                if i % 100 == 0:
-                    self._log_progress(f"Moved {i}/{total_to_delete} duplicates ({(i/total_to_delete)*100:.1f}%)")
-                if self.monitor:
-                    self.monitor.update_progress("dedupe", status="Running", processed=i, total=total_to_delete, current=f"Moved {i}/{total_to_delete} duplicates")
+        catalog = Catalog(self.catalog_path) if self.catalog_path else None
+        moved_files = 0
+        deferred_files = 0
+        try:
+            with self.move_lock():
+                stale = [path for path, seen in self.generations.items() if generation(path) != seen]
+                if stale:
+                    self._log_progress(f"Indexes rewritten since they were loaded, not moving anything; rerun dedupe: {stale}", "warning")
+                    self._log_progress("Exiting dups")
+                    return
+                start_time = time.time()
+                with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+                    futures = [executor.submit(self._move_file, entry, array, archive_dir_name, keepers.get(entry[0]) or archive_paths.get(entry[1], []), catalog, listing) for entry in to_delete]
+                    for i, future in enumerate(futures, 1):
+                        result = future.result()
+                        if result:
+                            moved_files += 1
+                        elif result is None:
+                            deferred_files += 1
+                        if i % 100 == 0:
+                            self._log_progress(f"Moved {i}/{total_to_delete} duplicates ({(i/total_to_delete)*100:.1f}%)")
+                        if self.monitor:
+                            self.monitor.update_progress("dedupe", status="Running", processed=i, total=total_to_delete, current=f"Moved {i}/{total_to_delete} duplicates")
+                # Per-file cost of the move phase (strong digests included), for --estimate
+                if catalog and moved_files:
+                    catalog.record_throughput(mount_point(self.duplicates_dir), 'move', 0, moved_files, time.time() - start_time)
+
+                # Step 5: Group the remaining images by perceptual hash
+                if self.budget and self.budget.expired():
+                    self._log_progress(f"Budget spent, {deferred_files} duplicates left for the next dedupe" + (", near-duplicate grouping skipped" if self.near_duplicates else ""), "warning")
+                elif self.near_duplicates:
+                    removed = {entry[0] for entry in to_delete}
+                    self.near_dups(array, [entry for entry in all_files if entry[0] not in removed], archive_dir_name, media_dir, listing)
+        finally:
+            if catalog:
+                catalog.close()
 
         # Log summary statistics
         total_files = len(all_files)
         archive_files = len(archive_hashes)
         non_archive_files = total_files - archive_files
         kept_non_archive = len(media_to_keep)
-        moved_files = total_to_delete
 
         self._log_progress(f"Summary: Total files processed: {total_files}")
         self._log_progress(f"{archive_files} archive files were kept (not moved)")
         self._log_progress(f"{kept_non_archive} non-archive files were kept (first instance of hash)")
-        self._log_progress(f"{moved_files} files were moved to duplicates directory")
+        self._log_progress(f"{moved_files} files were moved to duplicates directory, {deferred_files} were deferred by the budget, {total_to_delete - moved_files - deferred_files} were not (missing, unconfirmed by strong digest, or in the archive)")
+
         self._log_progress("Exiting dups")
+
+    def _near_keeper(self, members, array, archive_dir_name):
+        """Copy a near-duplicate group keeps: an archived copy if there is one, else the largest file."""
+        def rank(file_id):
+            path = array[file_id]['path']
+            return (archive_dir_name.lower() not in Path(path).as_posix().lower(), -array[file_id].get('filesize', 0), path)
+        return min(members, key=rank)
+
+    def near_dups(self, array, candidates, archive_dir_name, media_dir, listing=None):
+        """Group kept archive and media images whose dHash values are close, and report or move the lesser copies.
+
+        Near-duplicates (resized, re-encoded or lightly edited images) are not
+        byte-identical, so no strong digest can confirm them; the report lists
+        every group with each copy's distance from the kept one for review.
+        """
+        self._log_progress(f"Grouping near-duplicate images within {self.near_distance} bits")
+        start_time = time.time()
+        hashes = {}
+        for file_id, _, file_path in candidates:
+            normalized_path = Path(file_path).as_posix().lower()
+            if array[file_id].get('dhash') and (archive_dir_name.lower() in normalized_path or media_dir.lower() in normalized_path):
+                hashes[file_id] = array[file_id]['dhash']
+        groups = near_duplicate_groups(hashes, self.near_distance)
+        self._log_progress(f"Found {len(groups)} near-duplicate groups among {len(hashes)} images in {time.time() - start_time:.2f} seconds")
+
+        report = []
+        moved_files = 0
+        for members in groups:
+            keeper = self._near_keeper(members, array, archive_dir_name)
+            keeper_hash = int(hashes[keeper], 16)
+            similar = []
+            for file_id in sorted(members, key=lambda member: array[member]['path']):
+                if file_id == keeper:
+                    continue
+                record = array[file_id]
+                # Groups are chained (A~B~C), so a member can be far from the keeper; those are only reported
+                distance = hamming(int(hashes[file_id], 16), keeper_hash)
+                moved = False
+                if self.near_action == 'move' and distance <= self.near_distance and (listing.isfile(array[keeper]['path']) if listing else os.path.isfile(array[keeper]['path'])):
+                    moved = self._move_near_duplicate(file_id, array, archive_dir_name, array[keeper]['path'], listing)
+                    moved_files += moved
+                similar.append({"path": record['path'], "filesize": record.get('filesize'),
+                                "distance": distance, "moved": moved})
+            report.append({"keep": array[keeper]['path'], "filesize": array[keeper].get('filesize'), "similar": similar})
+
+        tmp_path = f"{self.near_duplicates}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(tmp_path, self.near_duplicates)
+        self._log_progress(f"Wrote {len(report)} near-duplicate groups to {self.near_duplicates}, moved {moved_files} files")
+
+    def _move_near_duplicate(self, file_id, array, archive_dir_name, keeper_path, listing=None):
+        """Move a near-duplicate media image to the near-duplicates directory for review; archived copies are never moved.
+
+        It stays out of the duplicates directory and its manifest, which validate confirms
+        files from: no identical copy exists, so only the near-duplicates manifest records where it came from.
+        """
+        from_path = array[file_id]['path']
+        if archive_dir_name.lower() in Path(from_path).as_posix().lower() or not (listing.isfile(from_path) if listing else os.path.isfile(from_path)):
+            return False
+        file_hash = array[file_id]['filehash']
+        dest_path = layout.shard_path(self.near_duplicates_dir, file_hash, os.path.basename(from_path))
+        self._log_progress(f"Moving near-duplicate of {keeper_path} to near-duplicates directory: {from_path} -> {dest_path}")
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        throttle.acquire_move(from_path, self.near_duplicates_dir)
+        shutil.move(from_path, dest_path)
+        if listing:
+            listing.discard(from_path)
+        layout.manifest(self.near_duplicates_dir).append(dest_path, file_hash, from_path, record_algorithm(array[file_id]))
+        return True
@@ -0,0 +1,231 @@
+"""Predict what a command would read, move and how long it would take, without reading any file contents."""
+import os
+import json
+import math
+import logging
+from mediastruct import crawl, layout
+from mediastruct.catalog import Catalog
+from mediastruct.index import iter_index, index_path
+from mediastruct.hashing import record_algorithm
+from mediastruct.throttle import ThrottlePolicy
+from mediastruct.utils import mount_point, parse_size
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HASH_RATE = 100 * 1024 ** 2  # bytes/s assumed for a mount with no measured runs
+DEFAULT_MOVE_RATE = 20.0  # files/s assumed for a mount with no measured dedupe moves
+
+def format_size(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if abs(nbytes) < 1024 or unit == 'TB':
+            return f"{nbytes:.1f} {unit}" if unit != 'B' else f"{int(nbytes)} B"
+        nbytes /= 1024
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+class estimate:
+    """Estimate each stage of a command from stat walks, the indexes and the catalog.
+
+    Wall time uses the hashing and move throughput measured per mount point on
+    earlier runs (crawl and scrub record hashing, dedupe records moves), capped by
+    the command's [Throttle] limits in force now, and defaults where nothing has
+    been measured yet.
+    """
+    COMMANDS = ('ingest', 'crawl', 'dedupe', 'validate', 'archive', 'scrub', 'run')
+
+    def __init__(self, app, command, output=None):
+        self.app = app
+        self.command = command
+        self.bytes_limit, self.iops_limit = ThrottlePolicy.from_config(app.config, command).limits()
+        self.catalog = Catalog(app.catalog_path())
+        try:
+            if command not in self.COMMANDS:
+                self._log_progress(f"Nothing to estimate for {command}")
+                return
+            stages = getattr(self, f"estimate_{command}")()
+        finally:
+            self.catalog.close()
+        self.report(stages, output)
+
+    def _log_progress(self, message, level="info"):
+        """Log progress messages and print to console."""
+        print(f"Estimate - {message}")
+        getattr(log, level)(message)
+
+    def _rates(self, read_mount, move_mount):
+        """(bytes/s hashed on read_mount, files/s moved on move_mount, basis) with the throttle applied."""
+        hashing = self.catalog.throughput(read_mount, 'hash') if read_mount else None
+        moving = self.catalog.throughput(move_mount, 'move') if move_mount else None
+        hash_rate = hashing[0] if hashing and hashing[0] else DEFAULT_HASH_RATE
+        move_rate = moving[1] if moving and moving[1] else DEFAULT_MOVE_RATE
+        if self.bytes_limit:
+            hash_rate = min(hash_rate, self.bytes_limit)
+        if self.iops_limit:
+            move_rate = min(move_rate, self.iops_limit)
+        basis = {"hash": "measured" if hashing else "default", "move": "measured" if moving else "default"}
+        return hash_rate, move_rate, basis
+
+    def _stage(self, name, read_root=None, files_to_hash=0, bytes_to_read=0, move_root=None, files_to_move=0, bytes_to_copy=0):
+        read_mount = mount_point(read_root) if read_root else None
+        move_mount = mount_point(move_root) if move_root else None
+        hash_rate, move_rate, basis = self._rates(read_mount, move_mount)
+        # Copies across devices read and hash every byte, like a crawl of the destination mount
+        seconds = (bytes_to_read + bytes_to_copy) / hash_rate + files_to_move / move_rate
+        return {
+            "stage": name,
+            "files_to_hash": files_to_hash,
+            "bytes_to_read": bytes_to_read,
+            "files_to_move": files_to_move,
+            "bytes_to_copy": bytes_to_copy,
+            "seconds": seconds,
+            "hash_rate": hash_rate,
+            "move_rate": move_rate,
+            "basis": basis,
+        }
+
+    @staticmethod
+    def _walk_totals(root, walker=os.walk):
+        files = size = 0
+        for dirpath, _, filenames in walker(root):
+            for filename in filenames:
+                if filename == crawl.crawl.METADATA_FILE or filename.startswith("._"):
+                    continue
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                files += 1
+        return files, size
+
+    @staticmethod
+    def _cross_device(source, dest):
+        try:
+            return os.stat(source).st_dev != os.stat(dest).st_dev
+        except OSError:
+            return False
+
+    def estimate_crawl(self, roots=None):
+        """Bytes crawl would hash: every file of a target whose .mediastruct cache would be rebuilt."""
+        stages = []
+        for root in roots or self.app.roots():
+            files = size = 0
+            if os.path.isdir(root) and root != self.app.ingestdir:
+                crawler = crawl.crawl(force=self.app.args.force, rootdir=root, datadir=self.app.datadir, rules=self.app.rules,
+                                      hash_policy=self.app.hash_policy, run=False, media_dir=self.app.workingdir, ingest_dir=self.app.ingestdir)
+                for target in crawler.rules.targets(root):
+                    metadata_path = os.path.join(target, crawl.crawl.METADATA_FILE)
+                    if crawler._should_force_rehash(target) or not crawler._is_metadata_current(metadata_path):
+                        target_files, target_size = self._walk_totals(target)
+                        files += target_files
+                        size += target_size
+            stages.append(self._stage(f"crawl {root}", read_root=root, files_to_hash=files, bytes_to_read=size))
+        return stages
+
+    def estimate_ingest(self):
+        """Ingest hashes every file in the ingest directory and moves each into media or duplicates."""
+        files, size = self._walk_totals(self.app.ingestdir) if os.path.isdir(self.app.ingestdir) else (0, 0)
+        copy = size if self._cross_device(self.app.ingestdir, self.app.workingdir) else 0
+        return [self._stage("ingest", read_root=self.app.ingestdir, files_to_hash=files, bytes_to_read=size,
+                            move_root=self.app.workingdir, files_to_move=files, bytes_to_copy=copy)]
+
+    def estimate_dedupe(self):
+        """Duplicates dedupe would move, and the strong digests it would compute to confirm them."""
+        archive_name = os.path.basename(self.app.archivedir.rstrip('/')).lower()
+        media_dir = self.app.workingdir.rstrip('/').lower()
+        archive_hashes = set()
+        candidates = []
+        for data_file in self.app.data_files():
+            if not os.path.isfile(data_file):
+                continue
+            for file_id, record in iter_index(data_file):
+                if file_id == 'du':
+                    continue
+                path = record['path'].lower()
+                hash_key = (record_algorithm(record), record['filehash'])
+                if archive_name in path:
+                    archive_hashes.add(hash_key)
+                else:
+                    candidates.append((hash_key, record['path'], record.get('filesize') or 0, path.startswith(media_dir)))
+        seen_media = set()
+        files = size = 0
+        for file_hash, path, filesize, in_media in sorted(candidates, key=lambda candidate: candidate[1]):
+            if file_hash in archive_hashes:
+                duplicate = True
+            elif in_media:
+                duplicate = file_hash in seen_media
+                seen_media.add(file_hash)
+            else:
+                duplicate = False
+            if duplicate:
+                files += 1
+                # Confirming reads the duplicate and its kept copy unless their digests are already cached
+                if not self.catalog.has_strong_hash(path):
+                    size += filesize * 2
+        return [self._stage("dedupe", read_root=self.app.workingdir, files_to_hash=files, bytes_to_read=size,
+                            move_root=self.app.duplicatedir, files_to_move=files)]
+
+    def estimate_validate(self):
+        """Validate rehashes duplicates the manifest cannot vouch for, plus a sample of those it can."""
+        if not os.path.isdir(self.app.duplicatedir):
+            return [self._stage("validate", read_root=self.app.duplicatedir)]
+        manifest = layout.manifest(self.app.duplicatedir).load()
+        sample_rate = self.app.config.getfloat('Validate', 'sample_rate', fallback=0.01)
+        files = hashed = size = 0
+        for path in layout.walk_files(self.app.duplicatedir):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files += 1
+            entry = manifest.get(path)
+            weight = sample_rate if entry and entry.get('filesize') == st.st_size and entry.get('mtime_ns') == st.st_mtime_ns else 1.0
+            hashed += weight
+            size += st.st_size * weight
+        return [self._stage("validate", read_root=self.app.duplicatedir, files_to_hash=int(round(hashed)), bytes_to_read=int(size),
+                            move_root=self.app.duplicatedir, files_to_move=files)]
+
+    def estimate_archive(self):
+        """Archive moves every indexed media file that fits a volume; only copies across devices read and hash data."""
+        capacity = self.app.config.getint('Archive', 'mediasize', fallback=25) * 1000 ** 3
+        files = size = 0
+        media_index = index_path(self.app.datadir, self.app.workingdir)
+        if os.path.isfile(media_index):
+            for file_id, record in iter_index(media_index):
+                if file_id != 'du' and (record.get('filesize') or 0) <= capacity:
+                    files += 1
+                    size += record.get('filesize') or 0
+        copy = size if self._cross_device(self.app.workingdir, self.app.archivedir) else 0
+        return [self._stage("archive", read_root=self.app.archivedir, files_to_hash=files if copy else 0,
+                            move_root=self.app.archivedir, files_to_move=files, bytes_to_copy=copy)]
+
+    def estimate_scrub(self):
+        """Scrub reads archive files oldest-verified first until its byte or time budget runs out."""
+        self.catalog.sync_index(index_path(self.app.datadir, self.app.archivedir), self.app.archivedir)
+        files, size = self.catalog.totals(self.app.archivedir)
+        byte_budget = parse_size(self.app.config.get('Scrub', 'bytes', fallback='0'))
+        time_budget = self.app.config.getfloat('Scrub', 'seconds', fallback=0) or None
+        hash_rate, _, _ = self._rates(mount_point(self.app.archivedir), None)
+        budget = min(filter(None, (size, byte_budget, time_budget * hash_rate if time_budget else None)), default=0)
+        return [self._stage("scrub", read_root=self.app.archivedir, files_to_hash=math.ceil(files * budget / size) if size else 0, bytes_to_read=int(budget))]
+
+    def estimate_run(self):
+        """The run pipeline's stages in order, as if none were skipped."""
+        return self.estimate_ingest() + self.estimate_crawl() + self.estimate_dedupe() + self.estimate_validate()
+
+    def report(self, stages, output=None):
+        total = 0
+        for stage in stages:
+            total += stage["seconds"]
+            self._log_progress(
+                f"{stage['stage']}: hash {stage['files_to_hash']} files / read {format_size(stage['bytes_to_read'])}, "
+                f"move {stage['files_to_move']} files / copy {format_size(stage['bytes_to_copy'])}, "
+                f"~{format_duration(stage['seconds'])} (hashing {format_size(stage['hash_rate'])}/s {stage['basis']['hash']}, "
+                f"moves {stage['move_rate']:.1f}/s {stage['basis']['move']})")
+        self._log_progress(f"{self.command} total: ~{format_duration(total)}")
+        if output:
+            with open(output, 'w') as f:
+                json.dump({"command": self.command, "seconds": total, "stages": stages}, f, indent=2)
+            self._log_progress(f"Wrote estimate to {output}")
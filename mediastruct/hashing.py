@@ -0,0 +1,286 @@
+"""File hashing shared by crawl, watch, validate, archive, dedupe and scrub.
+
+Fast non-cryptographic hashes (xxh64, xxh3, flat or as chunked tree hashes) are
+used for indexing and grouping; the strong BLAKE2b digest is only computed for
+files about to be moved.
+
+Sparse files are read extent by extent: holes found with SEEK_DATA/SEEK_HOLE
+are hashed as the zeros they read as without being read, so digests match those
+of the dense content.
+"""
+import os
+import re
+import errno
+import functools
+import hashlib
+import struct
+import logging
+import xxhash
+from concurrent.futures import ThreadPoolExecutor
+from mediastruct import throttle, perceptual as perceptual_hash
+from mediastruct.utils import parse_size
+
+log = logging.getLogger(__name__)
+
+FLAT_ALGORITHM = 'xxh64'  # what untagged records were hashed with
+BASE_ALGORITHMS = {'xxh64': xxhash.xxh64, 'xxh3': xxhash.xxh3_64}
+STRONG_ALGORITHM = 'blake2b'
+READ_SIZE = 1024 * 1024  # 1 MB reads, as the flat hash has always used
+_TREE_PATTERN = re.compile(r"^(xxh64|xxh3)-tree-(\d+)$")
+_ZEROS = memoryview(bytes(READ_SIZE))
+
+def tree_algorithm(chunk_size: int, base: str = FLAT_ALGORITHM) -> str:
+    """Name of the tree hash over chunk_size chunks, e.g. 'xxh64-tree-67108864'."""
+    return f"{base}-tree-{chunk_size}"
+
+def split_algorithm(algorithm: str):
+    """Split an algorithm name into (base algorithm, tree chunk size or None)."""
+    match = _TREE_PATTERN.match(algorithm or '')
+    if match:
+        return match.group(1), int(match.group(2))
+    algorithm = algorithm or FLAT_ALGORITHM
+    if algorithm not in BASE_ALGORITHMS:
+        raise ValueError(f"Unknown hash algorithm: {algorithm}")
+    return algorithm, None
+
+def tree_chunk_size(algorithm: str):
+    """Chunk size of a tree algorithm name, or None for a flat hash."""
+    return split_algorithm(algorithm)[1]
+
+def record_algorithm(record: dict) -> str:
+    """Algorithm behind a record's filehash; records written before the tag existed are flat."""
+    return record.get('hashalg') or FLAT_ALGORITHM
+
+def is_sparse(st) -> bool:
+    """True if fewer blocks are allocated than the file's size needs, i.e. it may have holes."""
+    return getattr(st, 'st_blocks', None) is not None and st.st_blocks * 512 < st.st_size
+
+def extents(fd, offset, end):
+    """Yield (offset, length, is_data) runs covering offset..end, holes found with SEEK_DATA/SEEK_HOLE.
+
+    Where the platform or filesystem cannot report holes the whole range is data.
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        yield offset, end - offset, True
+        return
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            # ENXIO: nothing but hole from offset to the end of the file
+            yield offset, end - offset, e.errno != errno.ENXIO
+            return
+        if data >= end:
+            yield offset, end - offset, False
+            return
+        if data > offset:
+            yield offset, data - offset, False
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+        yield data, hole - data, True
+        offset = hole
+
+def _feed_zeros(hasher, length):
+    """Update hasher with length zero bytes: no I/O, but the hasher still processes every byte."""
+    while length > 0:
+        hasher.update(_ZEROS[:min(length, READ_SIZE)])
+        length -= READ_SIZE
+
+def _feed(hasher, fd, runs):
+    """Update hasher with (offset, length, is_data) runs of fd: data with positioned reads, holes as zeros without reading."""
+    for start, run, is_data in runs:
+        if not is_data:
+            _feed_zeros(hasher, run)
+            continue
+        while run > 0:
+            chunk = os.pread(fd, min(READ_SIZE, run), start)
+            if not chunk:
+                return
+            throttle.acquire(len(chunk))
+            hasher.update(chunk)
+            start += len(chunk)
+            run -= len(chunk)
+
+@functools.lru_cache(maxsize=16)
+def _zero_digest(base, length):
+    """Digest of length zero bytes, shared by every tree chunk that lies wholly in a hole."""
+    hasher = BASE_ALGORITHMS[base]()
+    _feed_zeros(hasher, length)
+    return hasher.digest()
+
+def _hash_range(fd, offset, length, base=FLAT_ALGORITHM, sparse=False):
+    """Digest length bytes of fd from offset with positioned reads, so ranges can be hashed concurrently."""
+    runs = list(extents(fd, offset, offset + length)) if sparse else [(offset, length, True)]
+    if len(runs) == 1 and not runs[0][2]:
+        return _zero_digest(base, length)
+    hasher = BASE_ALGORITHMS[base]()
+    _feed(hasher, fd, runs)
+    return hasher.digest()
+
+def _hash_stream(file_path, hasher):
+    """Hash a whole file into one streaming state; holes of sparse files are not read but are still hashed as zeros."""
+    with open(file_path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if is_sparse(st):
+            _feed(hasher, f.fileno(), extents(f.fileno(), 0, st.st_size))
+            return hasher.hexdigest()
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            throttle.acquire(len(chunk))
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def hash_flat(file_path, base=FLAT_ALGORITHM) -> str:
+    """Hash a whole file sequentially into one fast hash state."""
+    return _hash_stream(file_path, BASE_ALGORITHMS[base]())
+
+def hash_strong(file_path) -> str:
+    """BLAKE2b-256 of a whole file, for confirming a fast-hash match before a destructive action."""
+    return _hash_stream(file_path, hashlib.blake2b(digest_size=32))
+
+def strong_hash(path, catalog=None, memo=None) -> str:
+    """BLAKE2b digest of path, reused from memo or the catalog while the file's size and mtime are unchanged."""
+    st = os.stat(path)
+    signature = (st.st_size, st.st_mtime_ns)
+    cached = memo.get(path) if memo is not None else None
+    if cached and cached[0] == signature:
+        return cached[1]
+    digest = catalog.strong_hash(path, st, STRONG_ALGORITHM) if catalog else None
+    if digest is None:
+        digest = hash_strong(path)
+        if catalog:
+            catalog.set_strong_hash(path, st, STRONG_ALGORITHM, digest)
+    if memo is not None:
+        memo[path] = (signature, digest)
+    return digest
+
+def same_content(path, keepers, catalog=None, memo=None) -> bool:
+    """True if path has the same strong digest as any existing file in keepers."""
+    digest = strong_hash(path, catalog, memo)
+    return any(keeper != path and os.path.isfile(keeper) and strong_hash(keeper, catalog, memo) == digest
+               for keeper in keepers)
+
+def hash_tree(file_path, chunk_size, workers=None, base=FLAT_ALGORITHM):
+    """Hash fixed-size chunks of a file in parallel and combine them.
+
+    Returns (root, chunks): chunks are the per-chunk xxh64 hex digests in file
+    order, and root is the base hash of the file length followed by the chunk digests.
+    """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        st = os.fstat(fd)
+        filesize = st.st_size
+        sparse = is_sparse(st)
+        offsets = range(0, filesize, chunk_size)
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4) as executor:
+            digests = list(executor.map(lambda offset: _hash_range(fd, offset, min(chunk_size, filesize - offset), base, sparse), offsets))
+    finally:
+        os.close(fd)
+    root = BASE_ALGORITHMS[base](struct.pack('<Q', filesize))
+    for digest in digests:
+        root.update(digest)
+    return root.hexdigest(), [digest.hex() for digest in digests]
+
+class TreeHasher:
+    """Incremental form of hash_tree for data that arrives as a stream, such as a copy."""
+
+    def __init__(self, chunk_size, base=FLAT_ALGORITHM):
+        self.chunk_size = chunk_size
+        self.hasher = BASE_ALGORITHMS[base]
+        self.length = 0
+        self.digests = []
+        self.current = self.hasher()
+        self.filled = 0
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            take = min(len(data), self.chunk_size - self.filled)
+            self.current.update(data[:take])
+            self.filled += take
+            self.length += take
+            data = data[take:]
+            if self.filled == self.chunk_size:
+                self.digests.append(self.current.digest())
+                self.current = self.hasher()
+                self.filled = 0
+
+    def hexdigest(self):
+        digests = self.digests + ([self.current.digest()] if self.filled else [])
+        root = self.hasher(struct.pack('<Q', self.length))
+        for digest in digests:
+            root.update(digest)
+        return root.hexdigest()
+
+def new_hasher(algorithm=FLAT_ALGORITHM):
+    """Streaming hasher for the named algorithm, with update() and hexdigest()."""
+    base, chunk_size = split_algorithm(algorithm)
+    return BASE_ALGORITHMS[base]() if chunk_size is None else TreeHasher(chunk_size, base)
+
+def hash_path(file_path, algorithm=FLAT_ALGORITHM, workers=None):
+    """Hash a file with the named algorithm, returning (hexdigest, chunk digests or None)."""
+    base, chunk_size = split_algorithm(algorithm)
+    if chunk_size is None:
+        return hash_flat(file_path, base), None
+    return hash_tree(file_path, chunk_size, workers, base)
+
+class HashPolicy:
+    """Pick the hash algorithm for a file: flat, or a tree hash for files at or over the threshold.
+
+    Configured in [Crawl] with hash_algorithm (xxh64 or xxh3), hash_mode (flat or
+    tree), tree_threshold, tree_chunk_size and tree_workers. With perceptual = yes
+    images also get a dHash fingerprint for near-duplicate grouping.
+    """
+    DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+    DEFAULT_THRESHOLD = 1024 ** 3
+
+    def __init__(self, mode='flat', chunk_size=None, threshold=None, workers=None, algorithm=FLAT_ALGORITHM,
+                 perceptual=False):
+        if mode not in ('flat', 'tree'):
+            raise ValueError(f"Unknown hash mode: {mode} (expected flat or tree)")
+        if algorithm not in BASE_ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm: {algorithm} (expected one of {', '.join(BASE_ALGORITHMS)})")
+        self.mode = mode
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size or self.DEFAULT_CHUNK_SIZE
+        self.threshold = threshold or self.DEFAULT_THRESHOLD
+        self.workers = workers
+        self.perceptual = perceptual
+        if perceptual and not perceptual_hash.AVAILABLE:
+            log.warning("Hashing - perceptual hashing needs numpy and Pillow; images will get no dHash")
+
+    @classmethod
+    def from_config(cls, config, section='Crawl'):
+        if config is None or not config.has_section(section):
+            return cls()
+        return cls(mode=config.get(section, 'hash_mode', fallback='flat'),
+                   chunk_size=parse_size(config.get(section, 'tree_chunk_size', fallback='')),
+                   threshold=parse_size(config.get(section, 'tree_threshold', fallback='')),
+                   workers=config.getint(section, 'tree_workers', fallback=0) or None,
+                   algorithm=config.get(section, 'hash_algorithm', fallback=FLAT_ALGORITHM),
+                   perceptual=config.getboolean(section, 'perceptual', fallback=False))
+
+    def algorithms(self) -> set:
+        """Every algorithm this policy can pick, for filtering index records it can be compared with."""
+        return {self.algorithm} | ({tree_algorithm(self.chunk_size, self.algorithm)} if self.mode == 'tree' else set())
+
+    def algorithm_for(self, filesize: int) -> str:
+        if self.mode == 'tree' and filesize >= self.threshold:
+            return tree_algorithm(self.chunk_size, self.algorithm)
+        return self.algorithm
+
+    def hash_file(self, file_path):
+        """Hash file_path as this policy dictates, returning (hexdigest, extra record fields)."""
+        algorithm = self.algorithm_for(os.path.getsize(file_path))
+        file_hash, chunks = hash_path(file_path, algorithm, self.workers)
+        extra = {}
+        if algorithm != FLAT_ALGORITHM:
+            extra['hashalg'] = algorithm
+        if chunks is not None:
+            extra['chunks'] = chunks
+        if self.perceptual:
+            dhash = perceptual_hash.dhash(file_path)
+            if dhash:
+                extra['dhash'] = dhash
+        return file_hash, extra
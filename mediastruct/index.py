@@ -0,0 +1,202 @@
+"""Helpers for reading and writing the <name>_index.json files produced by crawl."""
+import os
+import re
+import json
+import logging
+import datetime
+import threading
+import xxhash
+from array import array
+from bisect import bisect_left
+from mediastruct.hashing import record_algorithm
+
+log = logging.getLogger(__name__)
+
+def index_name(rootdir: str) -> str:
+    """Name of the index for a root, matching crawl's <last path component>_index.json convention."""
+    return re.split(r"\/", rootdir)[-1]
+
+def index_path(datadir: str, rootdir: str) -> str:
+    """Full path of the index file for a crawl root."""
+    return f'{datadir}/{index_name(rootdir)}_index.json'
+
+def delta_path(index_file: str) -> str:
+    """Delta written next to an index: <name>_delta.json for <name>_index.json."""
+    return re.sub(r"_index\.json$", "", index_file) + "_delta.json"
+
+def record_id(path: str) -> str:
+    """Id of a file's index record, derived from its path so every generation of an index keys it the same way."""
+    return xxhash.xxh3_128_hexdigest(path.encode())
+
+def generation(file_path: str):
+    """Generation of a file as 'size:mtime_ns', which changes whenever it is rewritten, or None if it does not exist.
+
+    The one signature of index, journal and state files: compared in memory,
+    and stored as is in deltas, run_state.json and the catalog.
+    """
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+def index_delta(previous: dict, current: dict) -> dict:
+    """Records added, removed and changed between two generations of an index.
+
+    Previous records are re-keyed by record_id, so a generation written with the
+    old random ids still diffs by path instead of appearing wholly replaced.
+    """
+    before = {record_id(record['path']): record for file_id, record in previous.items() if file_id != 'du'}
+    after = {file_id: record for file_id, record in current.items() if file_id != 'du'}
+    return {
+        "added": {file_id: record for file_id, record in after.items() if file_id not in before},
+        "removed": {file_id: record for file_id, record in before.items() if file_id not in after},
+        "changed": {file_id: record for file_id, record in after.items() if file_id in before and before[file_id] != record},
+    }
+
+def write_delta(index_file: str, previous: dict, base, current: dict) -> dict:
+    """Write the delta from the previous generation (base) to the index just written at index_file."""
+    delta = index_delta(previous, current)
+    delta.update(created=datetime.datetime.now().isoformat(), base=base, generation=generation(index_file))
+    write_index(delta_path(index_file), delta)
+    return delta
+
+def load_index(file_path: str) -> dict:
+    """Load an index file, returning an empty dict if it does not exist."""
+    if not os.path.isfile(file_path):
+        log.debug(f"Index - Index file {file_path} not found")
+        return {}
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+def write_index(file_path: str, sum_dict: dict):
+    """Write an index atomically so concurrent readers never see a partial file."""
+    tmp_path = f"{file_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "w") as indexfile:
+        indexfile.write(json.dumps(sum_dict))
+    os.replace(tmp_path, file_path)
+    log.debug(f"Index - Wrote index file: {file_path}")
+
+_WHITESPACE = re.compile(r"[ \t\r\n]*")
+_SEPARATOR = re.compile(r"[ \t\r\n,:]*")
+
+def iter_index(file_path: str, chunk_size: int = 1024 * 1024):
+    """Yield (record id, record) pairs from an index file without loading it whole."""
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r') as f:
+        buf, pos, eof = "", 0, False
+
+        def fill():
+            nonlocal buf, pos, eof
+            data = f.read(chunk_size)
+            eof = not data
+            buf = buf[pos:] + data
+            pos = 0
+
+        def skip(pattern):
+            nonlocal pos
+            while True:
+                pos = pattern.match(buf, pos).end()
+                if pos < len(buf) or eof:
+                    return
+                fill()
+
+        def value():
+            nonlocal pos
+            while True:
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                    # A value ending at the buffer edge may be a truncated number; read on to be sure
+                    if end < len(buf) or eof:
+                        pos = end
+                        return obj
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        fill()
+        skip(_WHITESPACE)
+        if buf[pos:pos + 1] != "{":
+            raise ValueError(f"Index {file_path} is not a JSON object")
+        pos += 1
+        while True:
+            skip(_SEPARATOR)
+            if pos >= len(buf) or buf[pos] == "}":
+                return
+            key = value()
+            skip(_SEPARATOR)
+            yield key, value()
+
+class IndexCache:
+    """Keep loaded indexes resident, reloading a file only when its size or mtime changes."""
+
+    def __init__(self):
+        self.entries = {}  # path -> (signature, data)
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Commands pickle themselves into process pools; workers get an empty cache rather than a copy of every index
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def get(self, file_path: str) -> dict:
+        """Return the index for file_path, loading it only if it changed on disk."""
+        signature = generation(file_path)
+        with self.lock:
+            cached = self.entries.get(file_path)
+            if cached and cached[0] == signature:
+                return cached[1]
+        data = load_index(file_path)
+        with self.lock:
+            self.entries[file_path] = (signature, data)
+        log.debug(f"Index - Loaded {file_path} into cache")
+        return data
+
+    def put(self, file_path: str, data: dict):
+        """Record an index that was just written so it does not need to be parsed again."""
+        with self.lock:
+            self.entries[file_path] = (generation(file_path), data)
+
+class HashArray:
+    """Sorted uint64 array of index hashes: exact membership tests at 8 bytes per file, no records held."""
+
+    def __init__(self, hashes=()):
+        values = []
+        for file_hash in hashes:
+            try:
+                values.append(int(file_hash, 16))
+            except (TypeError, ValueError):
+                continue
+        values.sort()
+        self.values = array('Q', values)
+
+    @classmethod
+    def from_indexes(cls, index_files, algorithms=None, cache=None):
+        """Collect the hashes of every record in the given index files, optionally only those under algorithms.
+
+        With an IndexCache the records come from the resident indexes instead of being parsed again.
+        """
+        def hashes():
+            for index_file in index_files:
+                if not os.path.isfile(index_file):
+                    continue
+                records = cache.get(index_file).items() if cache is not None else iter_index(index_file)
+                for file_id, record in records:
+                    if file_id == 'du' or (algorithms and record_algorithm(record) not in algorithms):
+                        continue
+                    yield record.get('filehash')
+        return cls(hashes())
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, file_hash):
+        try:
+            value = int(file_hash, 16)
+        except (TypeError, ValueError):
+            return False
+        i = bisect_left(self.values, value)
+        return i < len(self.values) and self.values[i] == value
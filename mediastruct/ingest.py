@@ -1,18 +1,30 @@
 import os
 import logging
-import xxhash
 import shutil
 import time
 from datetime import datetime
 from pathlib import Path
+from mediastruct import throttle, layout
+from mediastruct.hashing import HashPolicy, hash_path, same_content
+from mediastruct.index import HashArray
+from mediastruct.catalog import Catalog
 
 log = logging.getLogger(__name__)
 
 class ingest:
-    def __init__(self, source_dir, target_dir, monitor=None):
+    def __init__(self, source_dir, target_dir, monitor=None, duplicates_dir=None, known_indexes=(), catalog_path=None,
+                 hash_policy=None, cache=None, archive_store=None):
         self.source_dir = source_dir
         self.target_dir = target_dir
         self.monitor = monitor
+        # Files already in the media or archive indexes go straight to duplicates_dir
+        self.duplicates_dir = duplicates_dir
+        self.known_indexes = list(known_indexes)
+        # A content-addressed archive answers "already archived?" with one stat, even before it is crawled
+        self.archive_store = archive_store
+        self.catalog_path = catalog_path
+        self.hash_policy = hash_policy if hash_policy is not None else HashPolicy()
+        self.cache = cache
         self._log_progress(f"Initialized ingest with source_dir: {self.source_dir}, target_dir: {self.target_dir}")
 
         # Ensure source directory exists
@@ -39,30 +51,82 @@ class ingest:
         getattr(log, level)(message)
 
     def _hash_file(self, file_path):
-        """Compute the xxhash of a file."""
+        """Compute the hash of a file with the algorithm crawl would index it under."""
         try:
-            with open(file_path, 'rb') as f:
-                hasher = xxhash.xxh64()
-                chunk_size = 1024 * 1024  # 1 MB chunks
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    hasher.update(chunk)
-                return hasher.hexdigest()
+            algorithm = self.hash_policy.algorithm_for(os.path.getsize(file_path))
+            return hash_path(file_path, algorithm, self.hash_policy.workers)[0]
         except Exception as e:
             self._log_progress(f"Failed to hash file {file_path}: {e}", "error")
             return None
 
+    def _load_known_hashes(self):
+        """Build the membership array of media and archive hashes and open the catalog that resolves hits."""
+        if not (self.duplicates_dir and self.known_indexes and self.catalog_path):
+            return None, None
+        start_time = time.time()
+        known = HashArray.from_indexes([index_file for index_file, _ in self.known_indexes], self.hash_policy.algorithms(), self.cache)
+        catalog = Catalog(self.catalog_path)
+        for index_file, rootdir in self.known_indexes:
+            catalog.sync_index(index_file, rootdir)
+        self._log_progress(f"Loaded {len(known)} known hashes in {time.time() - start_time:.2f} seconds")
+        return known, catalog
+
+    def _known_duplicate(self, source_path, file_hash, known, catalog):
+        """Check the archive's blob and the membership array, then confirm a hit by strong digest against those copies."""
+        keepers = []
+        if self.archive_store is not None and self.duplicates_dir:
+            blob_path = self.archive_store.blob_path(file_hash, self.hash_policy.algorithm_for(os.path.getsize(source_path)))
+            if os.path.isfile(blob_path):
+                keepers.append(blob_path)
+        if known is not None and file_hash in known:
+            keepers += [record['path'] for record in catalog.lookup_hashes([file_hash])]
+        if not keepers:
+            return False
+        try:
+            if same_content(source_path, keepers, catalog):
+                return True
+        except OSError as e:
+            self._log_progress(f"Could not compute strong digest for {source_path}: {e}", "error")
+            return False
+        self._log_progress(f"Hash {file_hash} is indexed but no indexed copy has the same content, ingesting {source_path}", "warning")
+        return False
+
+    def _move_duplicate(self, source_path, file_hash, filename):
+        """Move an already archived or indexed file into its shard of duplicates_dir."""
+        dest_path = layout.shard_path(self.duplicates_dir, file_hash, filename)
+        try:
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            throttle.acquire_move(source_path, self.duplicates_dir)
+            shutil.move(source_path, dest_path)
+        except Exception as e:
+            self._log_progress(f"Failed to move duplicate {source_path} to {dest_path}: {e}", "error")
+            return False
+        algorithm = self.hash_policy.algorithm_for(os.path.getsize(dest_path))
+        layout.manifest(self.duplicates_dir).append(dest_path, file_hash, source_path, algorithm)
+        self._log_progress(f"Already indexed, moved to duplicates: {source_path} -> {dest_path}")
+        return True
+
     def process_files(self):
         """Process files in the source directory, renaming and organizing by date."""
         self._log_progress("Starting file processing")
         total_files = sum(len(files) for _, _, files in os.walk(self.source_dir))
-        processed_files = 0
 
         if self.monitor:
             self.monitor.update_progress("ingest", status="Running", processed=0, total=total_files, current=f"Processing files in {self.source_dir}")
 
+        known, catalog = self._load_known_hashes()
+        try:
+            duplicate_files = self._process_tree(known, catalog, total_files)
+        finally:
+            if catalog:
+                catalog.close()
+
+        self._log_progress(f"File processing completed, {duplicate_files} already indexed files moved to {self.duplicates_dir}")
+
+    def _process_tree(self, known, catalog, total_files):
+        """Move each ingested file into its date directory, or to duplicates_dir if it is already indexed."""
+        processed_files = 0
+        duplicate_files = 0
         for root, _, files in os.walk(self.source_dir):
             for filename in files:
                 source_path = os.path.join(root, filename)
@@ -76,6 +140,12 @@ class ingest:
                     self._log_progress(f"Skipping file due to hash failure: {source_path}", "warning")
                     continue
 
+                if self._known_duplicate(source_path, file_hash, known, catalog):
+                    if self._move_duplicate(source_path, file_hash, filename):
+                        duplicate_files += 1
+                        processed_files += 1
+                    continue
+
                 # Get file modification time
                 try:
                     mtime = os.path.getmtime(source_path)
@@ -101,6 +171,7 @@ class ingest:
 
                 # Move the file
                 try:
+                    throttle.acquire_move(source_path, target_subdir)
                     shutil.move(source_path, target_path)
                     self._log_progress(f"Moved file: {source_path} -> {target_path}")
                 except Exception as e:
@@ -111,5 +182,4 @@ class ingest:
                 if self.monitor and total_files > 0:
                     self.monitor.update_progress("ingest", status="Running", processed=processed_files, total=total_files, current=f"Processed file: {filename}")
                 self._log_progress(f"Processed {processed_files}/{total_files} files ({(processed_files/total_files)*100:.1f}%)")
-
-        self._log_progress("File processing completed")
+        return duplicate_files
@@ -0,0 +1,61 @@
+"""Append-only journals of moved files: the sharded directory manifests, read back by validate, and the content store's volume lists."""
+import os
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+class MoveJournal:
+    """JSON-lines journal of (dest path, hash, hash algorithm, size, mtime_ns, source path) for moved files."""
+
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'journal_path': self.journal_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['journal_path'])
+
+    def append(self, dest_path, filehash, source_path=None, hashalg=None, stat_path=None):
+        """Record a completed move, taking size and mtime from the file at its destination (or at stat_path)."""
+        st = os.stat(stat_path or dest_path)
+        entry = {
+            'path': dest_path,
+            'filehash': filehash,
+            'hashalg': hashalg,
+            'filesize': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'source': source_path,
+        }
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            with open(self.journal_path, 'a') as f:
+                f.write(line)
+        return entry
+
+    def load(self) -> dict:
+        """Return the latest journal entry for each destination path."""
+        entries = {}
+        if not os.path.isfile(self.journal_path):
+            return entries
+        with open(self.journal_path, 'r') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.warning(f"Journal - Skipping malformed line {line_number} in {self.journal_path}")
+                    continue
+                entries[entry['path']] = entry
+        return entries
+
+    def rewrite(self, entries):
+        """Replace the journal with the given entries, e.g. after validate has consumed some."""
+        tmp_path = f"{self.journal_path}.tmp"
+        with self.lock:
+            with open(tmp_path, 'w') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp_path, self.journal_path)
@@ -0,0 +1,39 @@
+"""Hash-sharded layout of the duplicates and validated directories."""
+import os
+import re
+import logging
+from mediastruct.journal import MoveJournal
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILE = '.manifest.jsonl'
+SHARD_WIDTH = 2
+SHARD_DEPTH = 2
+_UNSAFE = re.compile(r"[^0-9a-z]")
+
+def shard_path(root, filehash, filename):
+    """Path of a file in a sharded directory: <root>/ab/cd/<hash>_<name> for a hash starting abcd.
+
+    The hash in the name keeps files with the same name but different content
+    apart, so no collision renames are needed.
+    """
+    prefix = _UNSAFE.sub('_', (filehash or '').lower()).ljust(SHARD_WIDTH * SHARD_DEPTH, '_')
+    shards = [prefix[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return os.path.join(root, *shards, f"{filehash}_{filename}")
+
+def original_name(filename, filehash):
+    """Strip the hash prefix shard_path added; names from the old flat layout are returned unchanged."""
+    prefix = f"{filehash}_"
+    return filename[len(prefix):] if filehash and filename.startswith(prefix) else filename
+
+def manifest(root):
+    """Manifest of a sharded directory, mapping each stored file back to the path it came from."""
+    return MoveJournal(os.path.join(root, MANIFEST_FILE))
+
+def walk_files(root):
+    """Yield every stored file under a sharded directory, skipping its manifest."""
+    for dirpath, _, files in os.walk(root):
+        for filename in files:
+            if dirpath == root and filename.startswith(MANIFEST_FILE):
+                continue
+            yield os.path.join(dirpath, filename)
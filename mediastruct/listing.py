@@ -0,0 +1,70 @@
+"""Existence of indexed files from one scandir per parent directory instead of one stat per file.
+
+On NFS every stat is a round trip to the server, while listing a directory
+returns all of its names at once, so checking a million index entries costs
+one listing per directory. Whether an entry is a regular file comes from the
+d_type the listing returns; only symlinks and file systems that report
+DT_UNKNOWN need a stat for it. size() is a stat per file, so it is only
+called where a size check was asked for.
+"""
+import os
+import errno
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+def _list(directory):
+    """{name: DirEntry} of the regular files in directory; empty if it cannot be listed."""
+    files = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        files[entry.name] = entry
+                except OSError:
+                    continue
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            log.warning(f"Listing - Could not list {directory}: {e}")
+    return files
+
+class DirectoryListing:
+    """Regular files of every directory listed so far, each directory listed once for the rest of the run."""
+
+    def __init__(self):
+        self.listings = {}
+
+    def load(self, paths, workers=4):
+        """List the parent directory of every path once; listings run concurrently since each one waits on the server."""
+        directories = list({os.path.dirname(path) for path in paths} - self.listings.keys())
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for directory, files in zip(directories, executor.map(_list, directories)):
+                self.listings[directory] = files
+        return self
+
+    def files(self, directory):
+        if directory not in self.listings:
+            self.listings[directory] = _list(directory)
+        return self.listings[directory]
+
+    def isfile(self, path):
+        directory, name = os.path.split(path)
+        return name in self.files(directory)
+
+    def size(self, path):
+        """Size of the regular file at path, or None if it was not listed; one stat per call, unlike isfile."""
+        directory, name = os.path.split(path)
+        entry = self.files(directory).get(name)
+        if entry is None:
+            return None
+        try:
+            return entry.stat().st_size
+        except OSError:
+            return None
+
+    def discard(self, path):
+        """Forget a file moved away since its directory was listed."""
+        directory, name = os.path.split(path)
+        self.listings.get(directory, {}).pop(name, None)
@@ -0,0 +1,66 @@
+"""Advisory locks on the roots commands hash or move files in, so commands that do not conflict can overlap.
+
+A command takes a shared lock on a root it only reads (crawl hashing media,
+scrub reading the archive) and an exclusive lock on a root it moves files into
+or out of (ingest, the move phase of dedupe, validate, archive). Locks are
+flock()s on files under <datadir>/locks, released when the holder exits, even
+if it crashes.
+"""
+import os
+import re
+import time
+import fcntl
+import logging
+from contextlib import contextmanager, ExitStack
+
+log = logging.getLogger(__name__)
+
+LOCK_DIR = 'locks'
+_UNSAFE = re.compile(r"[^0-9A-Za-z._-]")
+
+def lock_dir(datadir):
+    return os.path.join(datadir, LOCK_DIR)
+
+def lock_path(directory, root):
+    """Lock file of a root: its absolute path with separators flattened, e.g. data_media_media.lock."""
+    name = _UNSAFE.sub('_', os.path.abspath(root).strip('/')) or 'root'
+    return os.path.join(directory, f"{name}.lock")
+
+@contextmanager
+def _flock(path, exclusive, command):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    kind = "exclusive" if exclusive else "shared"
+    try:
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            holder = os.pread(fd, 256, 0).decode(errors='replace').strip() or "another command"
+            print(f"Locks - {command} waiting for {kind} lock {os.path.basename(path)} (held by {holder})")
+            log.info(f"Locks - {command} waiting for {kind} lock {path} (held by {holder})")
+            start_time = time.time()
+            fcntl.flock(fd, mode)
+            log.info(f"Locks - {command} acquired {kind} lock {path} after {time.time() - start_time:.2f} seconds")
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, f"{command} (pid {os.getpid()})\n".encode(), 0)
+        yield
+    finally:
+        os.close(fd)
+
+@contextmanager
+def hold(directory, exclusive=(), shared=(), command="mediastruct"):
+    """Hold exclusive locks on one set of roots and shared locks on another for the duration of the block.
+
+    Locks are always taken in lock-file order, so two commands needing
+    overlapping sets cannot deadlock. With no lock directory nothing is locked.
+    """
+    if not directory:
+        yield
+        return
+    os.makedirs(directory, exist_ok=True)
+    modes = {lock_path(directory, root): False for root in shared if root}
+    modes.update({lock_path(directory, root): True for root in exclusive if root})
+    with ExitStack() as stack:
+        for path in sorted(modes):
+            stack.enter_context(_flock(path, modes[path], command))
+        yield
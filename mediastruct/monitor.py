@@ -17,11 +17,13 @@ class ProgressMonitor:
             "crawl": {"status": "Idle", "progress": "0%", "details": "", "last_updated": 0.0},
             "dedupe": {"status": "Idle", "progress": "0%", "details": "", "last_updated": 0.0},
             "archive": {"status": "Idle", "progress": "0%", "details": "", "last_updated": 0.0},
-            "validate": {"status": "Idle", "progress": "0%", "details": "", "last_updated": 0.0}
+            "validate": {"status": "Idle", "progress": "0%", "details": "", "last_updated": 0.0},
+            "scrub": {"status": "Idle", "progress": "0%", "details": "", "last_updated": 0.0},
+            "replicate": {"status": "Idle", "progress": "0%", "details": "", "last_updated": 0.0}
         }
         self.running = False
         self.screen = None
-        self.lock = threading.Lock()
+        self.lock = threading.RLock()  # update_progress calls update_status with it held
         self.min_display_time = 1.0  # Minimum time (in seconds) to display a status
         log.debug("ProgressMonitor initialized")
 
@@ -0,0 +1,130 @@
+"""Perceptual (dHash) fingerprints of images and grouping of near-duplicates by Hamming distance.
+
+NumPy and Pillow are optional: without them no perceptual hashes are computed
+and only identical hashes are grouped.
+"""
+import os
+import logging
+from itertools import combinations
+
+try:
+    import numpy as np
+    from PIL import Image
+    AVAILABLE = True
+except ImportError:
+    np = Image = None
+    AVAILABLE = False
+
+log = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.gif', '.webp'}
+HASH_SIZE = 8  # 8x8 comparisons, a 64-bit hash
+
+def is_image(file_path):
+    return os.path.splitext(file_path)[1].lower() in IMAGE_EXTENSIONS
+
+def dhash(file_path):
+    """64-bit difference hash as 16 hex digits, or None if the file is not a readable image.
+
+    The image is decoded at reduced size where the format allows it (JPEG draft
+    mode), shrunk to 9x8 grey pixels, and each bit records whether a pixel is
+    brighter than its left neighbour.
+    """
+    if not AVAILABLE or not is_image(file_path):
+        return None
+    try:
+        with Image.open(file_path) as img:
+            img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+            pixels = np.asarray(img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    except Exception as e:
+        log.debug(f"Perceptual - Could not hash image {file_path}: {e}")
+        return None
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return bits.tobytes().hex()
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+BLOCKS = 4
+BLOCK_BITS = 16
+QUERY_BATCH = 65536
+
+def _popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8)).reshape(len(values), -1).sum(axis=1)
+
+def _block_masks(radius):
+    """XOR masks of every block value within radius bits."""
+    masks = [0]
+    for flips in range(1, radius + 1):
+        masks.extend(sum(1 << bit for bit in bits) for bits in combinations(range(BLOCK_BITS), flips))
+    return masks
+
+def close_pairs(values, radius):
+    """Index pairs (i, j), i < j, of 64-bit values within radius bits of each other.
+
+    Multi-index hashing: each value is split into BLOCKS 16-bit blocks, and two
+    values within radius bits must differ by at most radius // BLOCKS bits in
+    some block. For each block the values are sorted by it, and every value is
+    joined against the few block values that close to its own, so only those
+    candidates are compared instead of every pair. Pairs may repeat.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    count = len(values)
+    masks = _block_masks(radius // BLOCKS)
+    pairs = []
+    for block in range(BLOCKS):
+        keys = ((values >> np.uint64(block * BLOCK_BITS)) & np.uint64((1 << BLOCK_BITS) - 1)).astype(np.int64)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        for start in range(0, count, QUERY_BATCH):
+            queries = np.arange(start, min(start + QUERY_BATCH, count))
+            for mask in masks:
+                wanted = keys[queries] ^ mask
+                low = np.searchsorted(sorted_keys, wanted, 'left')
+                matches = np.searchsorted(sorted_keys, wanted, 'right') - low
+                total = int(matches.sum())
+                if not total:
+                    continue
+                left = np.repeat(queries, matches)
+                offsets = np.arange(total) - np.repeat(np.cumsum(matches) - matches, matches)
+                right = order[np.repeat(low, matches) + offsets]
+                keep = left < right
+                left, right = left[keep], right[keep]
+                close = _popcount(values[left] ^ values[right]) <= radius
+                pairs.append(np.stack([left[close], right[close]], axis=1))
+    return np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=np.int64)
+
+def near_duplicate_groups(hashes, max_distance=6):
+    """Group ids whose perceptual hashes lie within max_distance bits of each other.
+
+    hashes maps id -> hex dHash. Returns lists of ids with at least two members;
+    grouping is transitive, so a chain of close images forms one group. Without
+    NumPy only ids with identical hashes are grouped.
+    """
+    by_value = {}
+    for file_id, value in hashes.items():
+        try:
+            by_value.setdefault(int(value, 16), []).append(file_id)
+        except (TypeError, ValueError):
+            continue
+    values = list(by_value)
+    parent = list(range(len(values)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if AVAILABLE and values:
+        for i, j in close_pairs(values, max_distance).tolist():
+            a, b = find(i), find(j)
+            if a != b:
+                parent[a] = b
+
+    groups = {}
+    for i, value in enumerate(values):
+        groups.setdefault(find(i), []).extend(by_value[value])
+    return [ids for ids in groups.values() if len(ids) > 1]
@@ -0,0 +1,139 @@
+"""Run ingest, crawl, dedupe and validate in one process, skipping stages whose inputs are unchanged."""
+import os
+import json
+import time
+import logging
+import xxhash
+from mediastruct import layout
+from mediastruct.index import IndexCache, index_path, generation
+
+log = logging.getLogger(__name__)
+
+class pipeline:
+    """Run the nightly stages against one resident IndexCache.
+
+    crawl hands the indexes it writes straight to dedupe, validate and the next
+    ingest through the cache, so no stage parses an index another stage just
+    wrote. The input signature each stage ran against is kept in run_state.json;
+    a stage (or crawl root) whose inputs match is skipped unless forced.
+    Once the run's budget is spent the remaining stages are skipped, and a stage
+    it cut short is not recorded, so the next run picks it up again.
+    """
+    STATE_FILE = 'run_state.json'
+    METADATA_FILE = '.mediastruct'
+
+    def __init__(self, app, force=False):
+        self.app = app
+        self.force = force
+        self.state_path = os.path.join(app.datadir, self.STATE_FILE)
+        self.state = self._load_state()
+        if self.app.cache is None:
+            self.app.cache = IndexCache()
+        start_time = time.time()
+        self._log_progress(f"Starting run (force: {force})")
+        budget = getattr(app, 'budget', None)
+        for stage in (self.ingest, self.crawl, self.dedupe, self.validate):
+            if budget and budget.expired():
+                self._log_progress(f"Budget spent, skipping {stage.__name__} and later stages until the next run", "warning")
+                break
+            stage()
+        self._log_progress(f"Run completed in {time.time() - start_time:.2f} seconds")
+
+    def _log_progress(self, message, level="info"):
+        """Log progress messages and print to console."""
+        print(f"Run - {message}")
+        getattr(log, level)(message)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def _record(self, key, signature):
+        budget = getattr(self.app, 'budget', None)
+        if budget and budget.expired():
+            return
+        self.state[key] = signature
+        self._save_state()
+
+    def _unchanged(self, key, signature):
+        return not self.force and self.state.get(key) == signature
+
+    def tree_signature(self, root, walker=os.walk):
+        """Order-independent signature of every file's path, size and mtime under root.
+
+        A stat walk is far cheaper than hashing, and the .mediastruct caches crawl
+        writes are left out so a crawl does not invalidate itself.
+        """
+        if not os.path.isdir(root):
+            return None
+        count = total = 0
+        for dirpath, _, files in walker(root):
+            for filename in files:
+                if filename == self.METADATA_FILE or filename.startswith("._"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                count += 1
+                total = (total + xxhash.xxh64_intdigest(f"{path}\0{st.st_size}\0{st.st_mtime_ns}".encode())) & 0xFFFFFFFFFFFFFFFF
+        return f"{count}:{total:016x}"
+
+    @staticmethod
+    def has_files(root):
+        return os.path.isdir(root) and next(layout.walk_files(root), None) is not None
+
+    def ingest(self):
+        if not self.has_files(self.app.ingestdir):
+            self._log_progress("Skipping ingest: nothing in the ingest directory")
+            return
+        self.app.ingest()
+
+    def crawl(self):
+        """Crawl only the roots whose tree changed since the index was last written from it."""
+        signatures = {}
+        for root in self.app.roots():
+            walker = os.walk if root == self.app.ingestdir else self.app.rules.walk
+            signature = self.tree_signature(root, walker)
+            if self._unchanged(f"crawl:{root}", signature) and os.path.isfile(index_path(self.app.datadir, root)):
+                self._log_progress(f"Skipping crawl of {root}: unchanged since its last crawl")
+                continue
+            signatures[root] = signature
+        if not signatures:
+            return
+        self.app.crawl(roots=list(signatures))
+        for root, signature in signatures.items():
+            self._record(f"crawl:{root}", signature)
+
+    def dedupe(self):
+        signature = [generation(path) for path in self.app.data_files()]
+        if self._unchanged("dedupe", signature):
+            self._log_progress("Skipping dedupe: indexes unchanged since the last dedupe")
+            return
+        self.app.dedupe()
+        self._record("dedupe", signature)
+
+    def _validate_signature(self):
+        # The duplicates tree signature covers its manifest too
+        return [generation(path) for path in self.app.data_files()] + [self.tree_signature(self.app.duplicatedir)]
+
+    def validate(self):
+        if not self.has_files(self.app.duplicatedir):
+            self._log_progress("Skipping validate: nothing in the duplicates directory")
+            return
+        if self._unchanged("validate", self._validate_signature()):
+            self._log_progress("Skipping validate: duplicates and indexes unchanged since the last validate")
+            return
+        self.app.validate()
+        # Recorded after the run: validate moves files out, and only later changes should trigger it again
+        self._record("validate", self._validate_signature())
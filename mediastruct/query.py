@@ -0,0 +1,82 @@
+"""Lookups by hash, path, year and size against the catalog's secondary indexes."""
+import os
+import sys
+import json
+import time
+import logging
+from mediastruct.catalog import Catalog
+
+log = logging.getLogger(__name__)
+
+class query:
+    """Answer lookups from the catalog, first syncing any index that changed since it was last read.
+
+    Results are written as JSON lines: one line per requested hash (with the
+    paths holding it, empty if none), one per requested path, and one per record
+    in the year/size range. With a sink, each result is passed to it instead.
+    """
+
+    def __init__(self, catalog_path, indexes, hashes=(), hashes_file=None, paths=(), year_from=None, year_to=None,
+                 min_size=None, max_size=None, output=None, sink=None):
+        self.catalog = Catalog(catalog_path)
+        self.sink = sink
+        self.out = None if sink else open(output, 'w') if output else sys.stdout
+        try:
+            start_time = time.time()
+            for index_file, rootdir in indexes:
+                self.catalog.sync_index(index_file, rootdir)
+            log.info(f"Query - Catalog ready in {time.time() - start_time:.2f} seconds")
+            hashes = list(hashes)
+            if hashes_file:
+                hashes.extend(self.read_hashes(hashes_file))
+            if hashes:
+                self.lookup_hashes(hashes)
+            for path in paths:
+                self.lookup_path(path)
+            if any(value is not None for value in (year_from, year_to, min_size, max_size)):
+                self.range(year_from, year_to, min_size, max_size)
+        finally:
+            self.catalog.close()
+            if self.out not in (None, sys.stdout):
+                self.out.close()
+
+    def _emit(self, result):
+        if self.sink:
+            self.sink(result)
+        else:
+            self.out.write(json.dumps(result) + "\n")
+
+    @staticmethod
+    def parse_hashes(lines):
+        """Hashes from lines of text, one per line; blank lines, comments and anything after the first word are ignored."""
+        return [line.split()[0].lower() for line in lines if line.strip() and not line.startswith('#')]
+
+    @classmethod
+    def read_hashes(cls, hashes_file):
+        """Hashes from a file (or '-' for stdin), one per line."""
+        f = sys.stdin if hashes_file == '-' else open(hashes_file, 'r')
+        try:
+            return cls.parse_hashes(f)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+    def lookup_hashes(self, hashes):
+        start_time = time.time()
+        found = {}
+        for record in self.catalog.lookup_hashes(set(hashes)):
+            found.setdefault(record['filehash'], []).append(record['path'])
+        for file_hash in hashes:
+            self._emit({"filehash": file_hash, "paths": found.get(file_hash, [])})
+        log.info(f"Query - Looked up {len(hashes)} hashes, {len(found)} found, in {time.time() - start_time:.3f} seconds")
+
+    def lookup_path(self, path):
+        record = self.catalog.lookup_path(os.path.abspath(path))
+        self._emit(record if record else {"path": path, "found": False})
+
+    def range(self, year_from, year_to, min_size, max_size):
+        count = 0
+        for record in self.catalog.range_records(year_from, year_to, min_size, max_size):
+            self._emit(record)
+            count += 1
+        log.info(f"Query - Streamed {count} records (year {year_from or '*'}-{year_to or '*'}, size {min_size or '*'}-{max_size or '*'})")
@@ -0,0 +1,303 @@
+"""Mirror a crawled root (the archive by default) to a secondary target from the indexes instead of rescanning both."""
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from mediastruct import throttle, store
+from mediastruct.hashing import hash_path, new_hasher, record_algorithm
+from mediastruct.index import index_name, index_path, iter_index, load_index, write_index
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+def replica_index_path(datadir, target_dir):
+    """Index of what a replication target holds, kept apart from crawl's <name>_index.json files."""
+    return os.path.join(datadir, f"replica_{index_name(target_dir.rstrip('/'))}_index.json")
+
+class replicate:
+    """Bring target_dir in line with source_dir by a hash join of the source index and the target's index.
+
+    The target's index is written by replicate itself after every run, so it is
+    the generation of the source that was last replicated: files whose path and
+    hash match are not touched or even stat()ed, content already on the target
+    under another path is renamed (or copied within the target) rather than sent
+    again, and only missing or changed content is transferred. Every transfer is
+    hashed as it is copied and checked against the recorded hash, and with verify
+    the written copy is read back and checked too. With force, or when there is
+    no target index yet, the target is walked and its files hashed first.
+    """
+    PLAN_FILE = 'replicate_plan.json'
+    STAGING_DIR = '.replicate'
+    COPY_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, source_dir, target_dir, datadir, force=False, delete=False, verify=True, plan_only=False, workers=4, monitor=None, budget=None):
+        self.source_dir = source_dir.rstrip('/')
+        self.target_dir = target_dir.rstrip('/')
+        self.datadir = datadir
+        self.force = force
+        # Target files the source no longer has are only removed with delete, as rsync --delete would
+        self.delete = delete
+        self.verify = verify
+        self.plan_only = plan_only
+        self.workers = max(1, int(workers or 1))
+        self.monitor = monitor
+        self.budget = budget
+        self.source_index = index_path(datadir, self.source_dir)
+        self.target_index = replica_index_path(datadir, self.target_dir)
+        self.staging = os.path.join(self.target_dir, self.STAGING_DIR)
+        self.lock = threading.Lock()
+        self._log_progress(f"Initialized replicate of {self.source_dir} to {self.target_dir} (delete: {delete}, verify: {verify}, plan only: {plan_only})")
+        self.replicate()
+
+    def _log_progress(self, message, level="info"):
+        """Log progress messages and print to console."""
+        print(f"Replicate - {message}")
+        getattr(log, level)(message)
+
+    @staticmethod
+    def _key(record):
+        return record_algorithm(record), record['filehash']
+
+    def _relative(self, path, root):
+        relative = os.path.relpath(path, root)
+        return None if relative.startswith('..') else relative
+
+    def load_source(self):
+        """Source records by path relative to the source root."""
+        if not os.path.isfile(self.source_index):
+            raise FileNotFoundError(f"No index for {self.source_dir} at {self.source_index}; crawl it first")
+        records = {}
+        for file_id, record in iter_index(self.source_index):
+            if file_id == 'du' or not record.get('filehash'):
+                continue
+            relative = self._relative(record['path'], self.source_dir)
+            if relative:
+                records[relative] = dict(record, id=file_id)
+        return records
+
+    def load_target(self, source):
+        """Target records by relative path, from the replica index or, with force or none yet, from a walk of the target."""
+        if not self.force and os.path.isfile(self.target_index):
+            records = {}
+            for file_id, record in load_index(self.target_index).items():
+                if file_id != 'du':
+                    records[os.path.relpath(record['path'], self.target_dir)] = dict(record, id=file_id)
+            return records
+        return self.scan_target(source)
+
+    def scan_target(self, source):
+        """Hash the target files that could hold source content, i.e. whose size matches some source file.
+
+        Each is hashed with the algorithms of the source files of that size, so
+        its key compares directly with theirs; other files are recorded without
+        a hash and only ever deleted.
+        """
+        self._log_progress(f"Building the index of {self.target_dir} from its files")
+        algorithms = {}
+        for record in source.values():
+            algorithms.setdefault(record.get('filesize'), set()).add(record_algorithm(record))
+        wanted = {self._key(record) for record in source.values()}
+        records = {}
+        hashed = 0
+        # Volume manifests of a content-addressed source are copied as they are, not replicated by hash
+        skip = {self.staging} | ({store.BlobStore(self.target_dir).volume_dir} if store.is_store(self.source_dir) else set())
+        for dirpath, dirs, files in os.walk(self.target_dir):
+            dirs[:] = [d for d in dirs if os.path.join(dirpath, d) not in skip]
+            for filename in files:
+                path = os.path.join(dirpath, filename)
+                try:
+                    filesize = os.path.getsize(path)
+                except OSError:
+                    continue
+                record = {'filehash': None, 'path': path, 'filesize': filesize, 'id': None}
+                for algorithm in sorted(algorithms.get(filesize, ())):
+                    file_hash, _ = hash_path(path, algorithm)
+                    hashed += 1
+                    record.update(filehash=file_hash, hashalg=algorithm)
+                    if (algorithm, file_hash) in wanted:
+                        break
+                records[os.path.relpath(path, self.target_dir)] = record
+        self._log_progress(f"Found {len(records)} files in {self.target_dir}, hashed {hashed}")
+        return records
+
+    def plan(self, source, target):
+        """Hash join of source and target records into the actions that make the target match the source.
+
+        Returns keep (already in place), rename (target path -> path), copy
+        (kept target path -> path), transfer (paths sent from the source) and
+        delete (target paths the source does not have).
+        """
+        keep = {rel for rel, record in source.items() if rel in target and target[rel].get('filehash') and self._key(target[rel]) == self._key(record)}
+        kept_by_key = {self._key(source[rel]): rel for rel in keep}
+        # Content on the target at a path that will not keep it can be renamed into place
+        free = {}
+        for rel, record in sorted(target.items()):
+            if rel not in keep and record.get('filehash'):
+                free.setdefault(self._key(record), []).append(rel)
+        rename, copy, transfer = [], [], []
+        for rel in sorted(source):
+            if rel in keep:
+                continue
+            key = self._key(source[rel])
+            if free.get(key):
+                rename.append((free[key].pop(0), rel))
+            elif key in kept_by_key:
+                copy.append((kept_by_key[key], rel))
+            else:
+                transfer.append(rel)
+        renamed = {from_rel for from_rel, _ in rename}
+        delete = sorted(rel for rel in target if rel not in source and rel not in renamed) if self.delete else []
+        return {"keep": sorted(keep), "rename": rename, "copy": copy, "transfer": transfer, "delete": delete}
+
+    def _copy(self, from_path, dest_path, record):
+        """Copy through the staging directory, checking the bytes read against the recorded hash before the copy replaces dest_path."""
+        hashalg = record_algorithm(record)
+        part_path = os.path.join(self.staging, f"{record['filehash']}.{threading.get_ident()}.part")
+        hasher = new_hasher(hashalg)
+        buf = bytearray(self.COPY_BUFFER_SIZE)
+        view = memoryview(buf)
+        with open(from_path, 'rb') as src, open(part_path, 'wb') as dst:
+            while True:
+                n = src.readinto(buf)
+                if not n:
+                    break
+                throttle.acquire(n)
+                hasher.update(view[:n])
+                dst.write(view[:n])
+            dst.flush()
+            os.fsync(dst.fileno())
+        computed = hasher.hexdigest()
+        if computed == record['filehash'] and self.verify:
+            computed, _ = hash_path(part_path, hashalg)
+        if computed != record['filehash']:
+            self._log_progress(f"Verification failed for {from_path} -> {dest_path} (hash {computed}, recorded {record['filehash']}), not replaced", "error")
+            os.remove(part_path)
+            return False
+        shutil.copystat(from_path, part_path)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        os.replace(part_path, dest_path)
+        return True
+
+    def _prune(self, rel):
+        """Remove directories a rename or delete left empty, up to the target root."""
+        directory = os.path.dirname(os.path.join(self.target_dir, rel))
+        while directory != self.target_dir and directory.startswith(self.target_dir + '/'):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                return
+            directory = os.path.dirname(directory)
+
+    def copy_manifests(self):
+        """Copy the volume manifests of a content-addressed source; they are not in its index, which lists only blobs."""
+        source_dir = store.BlobStore(self.source_dir).volume_dir
+        target_dir = store.BlobStore(self.target_dir).create().volume_dir
+        copied = 0
+        for name in os.listdir(source_dir):
+            from_path, dest_path = os.path.join(source_dir, name), os.path.join(target_dir, name)
+            st = os.stat(from_path)
+            try:
+                current = os.stat(dest_path)
+                if (current.st_size, current.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+                    continue
+            except FileNotFoundError:
+                pass
+            shutil.copy2(from_path, dest_path)
+            copied += 1
+        return copied
+
+    def _target_record(self, rel, record):
+        return dict(record, path=os.path.join(self.target_dir, rel))
+
+    def replicate(self):
+        start_time = time.time()
+        source = self.load_source()
+        target = self.load_target(source)
+        actions = self.plan(source, target)
+        self._log_progress(f"{len(actions['keep'])} files in place, {len(actions['rename'])} to rename, {len(actions['copy'])} to copy within the target, "
+                           f"{len(actions['transfer'])} to transfer ({sum(source[rel].get('filesize') or 0 for rel in actions['transfer']) / (1024 ** 3):.2f} GB), {len(actions['delete'])} to delete")
+        if self.plan_only:
+            plan_path = os.path.join(self.datadir, self.PLAN_FILE)
+            with open(plan_path, 'w') as f:
+                json.dump(dict(actions, source=self.source_dir, target=self.target_dir), f, indent=2)
+            self._log_progress(f"Wrote plan to {plan_path}")
+            return
+
+        os.makedirs(self.staging, exist_ok=True)
+        replica = {rel: target[rel] for rel in actions['keep']}
+        # Untouched target files stay in the index so later runs can still rename them into place
+        replica.update({rel: record for rel, record in target.items() if rel not in source and not self.delete})
+
+        # Renames go through the staging directory so swapping two paths cannot overwrite either
+        staged = []
+        for i, (from_rel, to_rel) in enumerate(actions['rename']):
+            staged_path = os.path.join(self.staging, str(i))
+            try:
+                throttle.acquire(0)
+                os.rename(os.path.join(self.target_dir, from_rel), staged_path)
+            except OSError as e:
+                self._log_progress(f"Failed to stage {from_rel} for renaming, transferring {to_rel} instead: {e}", "warning")
+                actions['transfer'].append(to_rel)
+                continue
+            replica.pop(from_rel, None)
+            staged.append((staged_path, to_rel))
+        for staged_path, to_rel in staged:
+            dest_path = os.path.join(self.target_dir, to_rel)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            os.replace(staged_path, dest_path)
+            replica[to_rel] = self._target_record(to_rel, source[to_rel])
+        for from_rel, _ in actions['rename']:
+            self._prune(from_rel)
+
+        copied = failed = deferred = 0
+        work = [(os.path.join(self.target_dir, from_rel), to_rel) for from_rel, to_rel in actions['copy']]
+        work += [(os.path.join(self.source_dir, rel), rel) for rel in actions['transfer']]
+
+        def run(item):
+            nonlocal copied, failed, deferred
+            from_path, rel = item
+            if self.budget and self.budget.expired():
+                with self.lock:
+                    deferred += 1
+                return
+            try:
+                ok = self._copy(from_path, os.path.join(self.target_dir, rel), source[rel])
+            except OSError as e:
+                self._log_progress(f"Failed to copy {from_path}: {e}", "error")
+                ok = False
+            with self.lock:
+                if ok:
+                    copied += 1
+                    replica[rel] = self._target_record(rel, source[rel])
+                else:
+                    failed += 1
+                if self.monitor:
+                    self.monitor.update_progress("replicate", status="Running", processed=copied + failed, total=len(work), current=rel)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(run, work))
+
+        deleted = 0
+        for rel in actions['delete']:
+            try:
+                os.remove(os.path.join(self.target_dir, rel))
+                self._prune(rel)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self._log_progress(f"Failed to delete {rel}: {e}", "error")
+                replica[rel] = target[rel]
+        try:
+            os.rmdir(self.staging)
+        except OSError:
+            pass
+
+        if store.is_store(self.source_dir):
+            self._log_progress(f"Copied {self.copy_manifests()} changed volume manifests")
+        write_index(self.target_index, {record.pop('id', None) or rel: record for rel, record in replica.items()})
+        if deferred:
+            self._log_progress(f"Budget spent, {deferred} copies left for the next replicate", "warning")
+        self._log_progress(f"Replicated in {time.time() - start_time:.2f} seconds: {len(staged)} renamed, {copied} copied and verified, {failed} failed, {deleted} deleted; wrote {self.target_index}")
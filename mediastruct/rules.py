@@ -0,0 +1,148 @@
+"""Compiled include/exclude rules used to prune directory walks."""
+import os
+import re
+import logging
+from pathlib import Path
+from mediastruct.store import BLOB_DIR, VOLUME_DIR
+
+log = logging.getLogger(__name__)
+
+# Defaults reproduce the layout crawl used to hardcode; the CLI derives them from [Paths] with default_patterns()
+DEFAULT_INCLUDE = [
+    r"re:/data/archive/\d+",
+    r"re:/data/media/media/\d{4}",
+]
+DEFAULT_EXCLUDE = [
+    "/data/media/duplicates",
+    "/data/media/validated",
+    "/data/media/ingest",
+    "/data/archive/blobs",
+    "/data/archive/volumes",
+]
+
+def default_patterns(archive_dir, media_dir, skip_dirs=()):
+    """(include, exclude) patterns for an archive and media root: numbered archive volumes and
+    media year directories are targets; skip_dirs and the content store's blobs and volumes are pruned."""
+    archive_dir = PathRules._normalize(archive_dir)
+    media_dir = PathRules._normalize(media_dir)
+    include = [f"re:{re.escape(archive_dir)}/\\d+", f"re:{re.escape(media_dir)}/\\d{{4}}"]
+    exclude = [PathRules._normalize(path) for path in skip_dirs]
+    exclude += [os.path.join(archive_dir, BLOB_DIR), os.path.join(archive_dir, VOLUME_DIR)]
+    return include, exclude
+
+def _split_patterns(value):
+    """Split a config value into patterns, one per line or comma separated."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = re.split(r"[\n,]", value)
+    return [pattern.strip() for pattern in value if pattern and pattern.strip()]
+
+def _glob_to_regex(pattern: str) -> str:
+    """Translate a path glob into a regex; '*' stays inside one path component, '**' spans several."""
+    if pattern.startswith("re:"):
+        return pattern[3:]
+    pattern = pattern.rstrip("/") or "/"
+    i, out = 0, []
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                out.append(f"[{body}]")
+                i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+class PathRules:
+    """Classify directories as excluded, included (a target to index) or neither with a single compiled regex."""
+
+    def __init__(self, include=None, exclude=None):
+        self.include = _split_patterns(DEFAULT_INCLUDE if include is None else include)
+        self.exclude = _split_patterns(DEFAULT_EXCLUDE if exclude is None else exclude)
+        # An excluded pattern also matches everything below it, so a walk that starts
+        # inside an excluded tree is rejected as well
+        exclude_re = "|".join(f"(?:{_glob_to_regex(p)})(?:/.*)?" for p in self.exclude) or "(?!)"
+        include_re = "|".join(f"(?:{_glob_to_regex(p)})" for p in self.include) or "(?!)"
+        # Exclude comes first in the alternation so it always wins over include
+        self.matcher = re.compile(f"^(?:(?P<exclude>{exclude_re})|(?P<include>{include_re}))$")
+        log.debug(f"Rules - Compiled {len(self.include)} include and {len(self.exclude)} exclude patterns")
+
+    @classmethod
+    def from_config(cls, config, section="Crawl"):
+        """Build rules from the include/exclude keys of a config section, falling back to the defaults."""
+        if config is None or not config.has_section(section):
+            return cls()
+        include = config.get(section, "include", fallback=None)
+        exclude = config.get(section, "exclude", fallback=None)
+        return cls(include=include, exclude=exclude)
+
+    @staticmethod
+    def _normalize(path) -> str:
+        path_str = Path(path).as_posix()
+        return path_str.rstrip("/") or "/"
+
+    def classify(self, path):
+        """Return 'exclude', 'include' or None for a directory path."""
+        match = self.matcher.match(self._normalize(path))
+        return match.lastgroup if match else None
+
+    def is_excluded(self, path) -> bool:
+        return self.classify(path) == "exclude"
+
+    def is_target(self, path) -> bool:
+        return self.classify(path) == "include"
+
+    def target_for(self, file_path):
+        """Return the target directory that contains file_path, or None if it is excluded or outside any target."""
+        parent = Path(file_path).parent
+        for directory in (parent, *parent.parents):
+            kind = self.classify(directory)
+            if kind == "exclude":
+                return None
+            if kind == "include":
+                return self._normalize(directory)
+        return None
+
+    def targets(self, rootdir):
+        """Yield target directories under rootdir.
+
+        Excluded subtrees are pruned before they are listed and targets are not
+        descended into, since their contents are indexed as a whole.
+        """
+        for path, dirs, _ in os.walk(rootdir):
+            path_str = self._normalize(path)
+            kind = self.classify(path_str)
+            if kind == "exclude":
+                log.debug(f"Rules - Pruning excluded directory: {path_str}")
+                dirs[:] = []
+                continue
+            if kind == "include":
+                dirs[:] = []
+                yield path_str
+                continue
+            dirs[:] = [d for d in dirs if not self.is_excluded(os.path.join(path_str, d))]
+
+    def walk(self, rootdir):
+        """os.walk over rootdir with excluded subtrees pruned."""
+        for path, dirs, files in os.walk(rootdir):
+            if self.is_excluded(path):
+                dirs[:] = []
+                continue
+            dirs[:] = [d for d in dirs if not self.is_excluded(os.path.join(path, d))]
+            yield path, dirs, files
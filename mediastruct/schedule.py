@@ -0,0 +1,78 @@
+"""Schedule crawls of several roots concurrently, grouped by the device they live on."""
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from mediastruct import crawl, locks
+
+log = logging.getLogger(__name__)
+
+class schedule:
+    """Crawl roots on separate devices in parallel while capping the work on each device.
+
+    Roots sharing an st_dev are crawled at most device_concurrency at a time so a
+    spinning disk is not hit by competing random reads; each root's hashing pool is
+    limited to device_workers processes (by default an equal share of the cores).
+    Every root still writes its own <name>_index.json.
+    """
+
+    def __init__(self, roots, force, datadir, monitor=None, rules=None, device_concurrency=1, device_workers=None, cache=None, hash_policy=None, lock_dir=None, catalog_path=None, budget=None,
+                 media_dir=None, ingest_dir=None):
+        self.roots = roots
+        self.media_dir = media_dir
+        self.ingest_dir = ingest_dir
+        self.catalog_path = catalog_path
+        self.budget = budget
+        self.lock_dir = lock_dir
+        self.hash_policy = hash_policy
+        self.cache = cache
+        self.force = force
+        self.datadir = datadir
+        self.monitor = monitor
+        self.rules = rules
+        self.device_concurrency = max(1, int(device_concurrency or 1))
+        self.groups = self.group_by_device(roots)
+        cpu_count = os.cpu_count() or 4
+        self.device_workers = int(device_workers or 0) or max(1, cpu_count // max(1, len(self.groups)))
+        self._log_progress(f"Scheduling {len(roots)} roots across {len(self.groups)} devices (roots per device: {self.device_concurrency}, workers per root: {self.device_workers})")
+        self.run()
+
+    def _log_progress(self, message, level="info"):
+        """Log progress messages and print to console."""
+        print(f"Schedule - {message}")
+        getattr(log, level)(message)
+
+    @staticmethod
+    def group_by_device(roots):
+        """Group roots by st_dev, keeping the configured order within each group."""
+        groups = {}
+        for root in roots:
+            try:
+                device = os.stat(root).st_dev
+            except OSError:
+                # Missing roots still go through crawl so their (empty) index is handled as before
+                device = None
+            groups.setdefault(device, []).append(root)
+        return groups
+
+    def _crawl_root(self, root, semaphore):
+        """Crawl one root while holding a slot on its device and a shared lock on the root."""
+        with semaphore, locks.hold(self.lock_dir, shared=[root], command="crawl"):
+            self._log_progress(f"Crawling {root}")
+            crawl.crawl(force=self.force, rootdir=root, datadir=self.datadir, monitor=self.monitor, rules=self.rules, max_workers=self.device_workers, cache=self.cache, hash_policy=self.hash_policy, catalog_path=self.catalog_path, budget=self.budget,
+                        media_dir=self.media_dir, ingest_dir=self.ingest_dir)
+            return root
+
+    def run(self):
+        """Crawl every root, one thread per root gated by a per-device semaphore."""
+        semaphores = {device: threading.BoundedSemaphore(self.device_concurrency) for device in self.groups}
+        jobs = [(root, semaphores[device]) for device, roots in self.groups.items() for root in roots]
+        with ThreadPoolExecutor(max_workers=len(jobs) or 1) as executor:
+            futures = {executor.submit(self._crawl_root, root, semaphore): root for root, semaphore in jobs}
+            for future in as_completed(futures):
+                root = futures[future]
+                try:
+                    future.result()
+                    self._log_progress(f"Finished crawling {root}")
+                except Exception as e:
+                    self._log_progress(f"Crawl of {root} failed: {e}", "error")
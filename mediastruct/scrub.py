@@ -0,0 +1,115 @@
+"""Rolling verification of archive content against its recorded hashes."""
+import os
+import json
+import time
+import logging
+import datetime
+from mediastruct.hashing import hash_path, FLAT_ALGORITHM
+from mediastruct.catalog import Catalog
+from mediastruct.index import index_path
+from mediastruct.utils import mount_point
+
+log = logging.getLogger(__name__)
+
+class scrub:
+    """Rehash archive files in least-recently-verified order until a byte or time budget is spent.
+
+    Each run picks up where the verification schedule left off, so a full pass over
+    the archive is spread across many short runs.
+    """
+    REPORT_FILE = 'scrub_report.json'
+
+    def __init__(self, archive_dir, datadir, catalog_path, byte_budget=None, time_budget=None, monitor=None, rebaseline=False, paths=None):
+        self.archive_dir = archive_dir
+        self.datadir = datadir
+        self.byte_budget = byte_budget
+        self.time_budget = time_budget
+        self.monitor = monitor
+        self.catalog = Catalog(catalog_path)
+        self._log_progress(f"Initialized scrub of {archive_dir} (byte budget: {byte_budget or 'none'}, time budget: {time_budget or 'none'}s)")
+        try:
+            self.catalog.sync_index(index_path(datadir, archive_dir), archive_dir)
+            if rebaseline:
+                # Only on request: a hash that changed under a verified file is otherwise reported, not accepted
+                reset = self.catalog.rebaseline(archive_dir, paths)
+                self._log_progress(f"Rebaselined {reset} files, their indexed hashes are verified next", "warning")
+            self.scrub_files()
+        finally:
+            self.catalog.close()
+
+    def _log_progress(self, message, level="info"):
+        """Log progress messages and print to console."""
+        print(f"Scrub - {message}")
+        getattr(log, level)(message)
+
+    def _budget_left(self, bytes_done, filesize, start_time):
+        if self.time_budget and time.time() - start_time >= self.time_budget:
+            return False
+        # Always verify at least one file so an oversized file cannot stall the schedule
+        if self.byte_budget and bytes_done and bytes_done + filesize > self.byte_budget:
+            return False
+        return True
+
+    def scrub_files(self):
+        start_time = time.time()
+        bytes_done = verified = mismatched = missing = 0
+        cursor = None
+        exhausted = False
+        if self.monitor:
+            self.monitor.update_progress("scrub", status="Running", processed=0, total=self.byte_budget or 0, current=f"Scrubbing {self.archive_dir}")
+        while not exhausted:
+            rows = self.catalog.least_recently_verified(self.archive_dir, after=cursor, before=start_time)
+            if not rows:
+                break
+            for path, filehash, filesize, last_verified, hashalg in rows:
+                cursor = (last_verified, path)
+                hashalg = hashalg or FLAT_ALGORITHM
+                if not self._budget_left(bytes_done, filesize or 0, start_time):
+                    exhausted = True
+                    break
+                if not os.path.isfile(path):
+                    self._log_progress(f"Missing archive file: {path}", "error")
+                    self.catalog.mark_verified(path, "missing", filehash=filehash, hashalg=hashalg)
+                    missing += 1
+                    continue
+                try:
+                    computed, _ = hash_path(path, hashalg)
+                except OSError as e:
+                    self._log_progress(f"Failed to hash {path}: {e}", "error")
+                    computed = None
+                bytes_done += filesize or 0
+                if computed == filehash:
+                    self.catalog.mark_verified(path, "ok", filehash=filehash, hashalg=hashalg)
+                    verified += 1
+                else:
+                    self._log_progress(f"Hash mismatch for {path}: recorded {filehash}, computed {computed}", "error")
+                    self.catalog.mark_verified(path, "mismatch", filehash=filehash, hashalg=hashalg)
+                    mismatched += 1
+                if self.monitor:
+                    self.monitor.update_progress("scrub", status="Running", processed=bytes_done, total=self.byte_budget or bytes_done, current=path)
+
+        elapsed = time.time() - start_time
+        rate = bytes_done / elapsed / (1024 ** 2) if elapsed > 0 else 0
+        self._log_progress(f"Verified {verified} files ({bytes_done / (1024 ** 3):.2f} GB in {elapsed:.1f}s, {rate:.1f} MB/s): {mismatched} mismatches, {missing} missing")
+        if bytes_done:
+            self.catalog.record_throughput(mount_point(self.archive_dir), 'hash', bytes_done, verified + mismatched, elapsed)
+        self.write_report(elapsed, bytes_done, verified)
+        if self.monitor:
+            self.monitor.update_progress("scrub", status="Completed", processed=100, total=100, current="Scrub finished")
+
+    def write_report(self, elapsed, bytes_done, verified):
+        """Write every outstanding mismatch and missing file, not only this run's, to scrub_report.json."""
+        oldest = self.catalog.least_recently_verified(self.archive_dir, limit=1)
+        report = {
+            "finished": datetime.datetime.now().isoformat(),
+            "elapsed": elapsed,
+            "bytes_verified": bytes_done,
+            "files_verified": verified,
+            "oldest_verification": oldest[0][3] if oldest else None,
+            "mismatches": [row[0] for row in self.catalog.with_status(self.archive_dir, "mismatch")],
+            "missing": [row[0] for row in self.catalog.with_status(self.archive_dir, "missing")],
+        }
+        report_path = os.path.join(self.datadir, self.REPORT_FILE)
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        self._log_progress(f"Wrote report to {report_path}")
@@ -0,0 +1,120 @@
+"""Long-running mediastruct service answering commands over a local UNIX socket."""
+import os
+import copy
+import json
+import time
+import socket
+import argparse
+import logging
+import threading
+import socketserver
+from mediastruct import throttle, query
+from mediastruct.budget import Budget
+
+log = logging.getLogger(__name__)
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _Handler(socketserver.StreamRequestHandler):
+    """One JSON request line in, one JSON response line out."""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            response = self.server.service.handle(request)
+        except Exception as e:
+            log.error(f"Service - Request failed: {e}")
+            response = {"ok": False, "error": str(e)}
+        self.wfile.write((json.dumps(response) + "\n").encode())
+
+class service:
+    """Keep the configured mediastruct instance, its config and its indexes resident between commands.
+
+    Mutating commands run one at a time; queries go through the same catalog
+    lookups as the query command and do not wait for them.
+    """
+    COMMANDS = ('ingest', 'crawl', 'dedupe', 'validate', 'query')
+
+    def __init__(self, app, socket_path):
+        self.app = app
+        self.socket_path = socket_path
+        self.lock = threading.Lock()
+        self._log_progress(f"Initialized service on {self.socket_path}")
+        self.run()
+
+    def _log_progress(self, message, level="info"):
+        """Log progress messages and print to console."""
+        print(f"Service - {message}")
+        getattr(log, level)(message)
+
+    def _request_app(self, request: dict):
+        """The resident instance with this request's options, sharing its config and index cache but not its args."""
+        app = copy.copy(self.app)
+        app.args = argparse.Namespace(**dict(vars(self.app.args), force=bool(request.get('force', False)),
+                                             deadline=request.get('deadline'), budget=request.get('budget')))
+        app.budget = Budget.from_options(deadline=app.args.deadline, budget=app.args.budget)
+        return app
+
+    def handle(self, request: dict) -> dict:
+        """Dispatch a single request to the resident mediastruct instance."""
+        command = request.get('command')
+        if command not in self.COMMANDS:
+            return {"ok": False, "error": f"Unknown command: {command}"}
+        start_time = time.time()
+        if command == 'query':
+            return {"ok": True, "command": command, "results": self.query(request), "elapsed": time.time() - start_time}
+        with self.lock:
+            app = self._request_app(request)
+            self._log_progress(f"Running {command}" + (f", budget {app.budget}" if app.budget else ""))
+            throttle.configure(self.app.config, command)
+            getattr(app, command)()
+        elapsed = time.time() - start_time
+        self._log_progress(f"Completed {command} in {elapsed:.2f} seconds")
+        return {"ok": True, "command": command, "elapsed": elapsed}
+
+    def query(self, request: dict) -> list:
+        """Answer a query request with the results the query command would print, one per line.
+
+        hash_lines carries a hashes file the client read, parsed as query --hashes-file would.
+        """
+        hashes = list(request.get('hashes') or ([request['hash']] if request.get('hash') else []))
+        hashes += query.query.parse_hashes(request.get('hash_lines') or [])
+        paths = list(request.get('paths') or ([request['path']] if request.get('path') else []))
+        results = []
+        query.query(sink=results.append, **self.app.query_options(hashes, None, paths, request.get('year'), request.get('size')))
+        return results
+
+    def _check_stale_socket(self):
+        """Remove a socket file left behind by a previous run, refusing to start if a service is still listening."""
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except OSError:
+            os.remove(self.socket_path)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(f"A mediastruct service is already listening on {self.socket_path}")
+
+    def run(self):
+        """Serve requests until interrupted."""
+        self._check_stale_socket()
+        os.makedirs(os.path.dirname(self.socket_path) or '.', exist_ok=True)
+        server = _Server(self.socket_path, _Handler)
+        server.service = self
+        os.chmod(self.socket_path, 0o600)
+        self._log_progress(f"Listening on {self.socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self._log_progress("Interrupted, shutting down")
+        finally:
+            server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
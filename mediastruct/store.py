@@ -0,0 +1,79 @@
+"""Content-addressed archive layout: each distinct content stored once under its hash, volumes as path -> hash manifests.
+
+    <archive>/blobs/<hashalg>/ab/cd/<hash>     one blob per distinct content
+    <archive>/volumes/<volume>.jsonl           one line per archived file: its path in the volume and its hash
+
+Whether the archive already holds some content is a single stat of its blob
+path, so a file can be checked against the archive before the archive has
+been crawled.
+"""
+import os
+import re
+import logging
+from mediastruct import layout
+from mediastruct.journal import MoveJournal
+from mediastruct.hashing import FLAT_ALGORITHM
+
+log = logging.getLogger(__name__)
+
+BLOB_DIR = 'blobs'
+VOLUME_DIR = 'volumes'
+_VOLUME = re.compile(r"^(\d+)\.jsonl$")
+
+def is_store(root):
+    """True if root holds a content-addressed archive."""
+    return bool(root) and os.path.isdir(os.path.join(root, BLOB_DIR))
+
+class BlobStore:
+    """Blobs and volume manifests of a content-addressed archive rooted at root."""
+
+    def __init__(self, root):
+        self.root = root.rstrip('/')
+        self.blob_dir = os.path.join(self.root, BLOB_DIR)
+        self.volume_dir = os.path.join(self.root, VOLUME_DIR)
+
+    def create(self):
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.volume_dir, exist_ok=True)
+        return self
+
+    def blob_path(self, filehash, hashalg=None):
+        """<root>/blobs/<hashalg>/ab/cd/<hash>; the algorithm keeps hashes of different algorithms apart."""
+        shard_dir = os.path.dirname(layout.shard_path(os.path.join(self.blob_dir, hashalg or FLAT_ALGORITHM), filehash, ''))
+        return os.path.join(shard_dir, filehash)
+
+    def has(self, filehash, hashalg=None):
+        return os.path.isfile(self.blob_path(filehash, hashalg))
+
+    def manifest(self, volume):
+        return MoveJournal(os.path.join(self.volume_dir, f"{volume}.jsonl"))
+
+    def volumes(self):
+        """Volume numbers with a manifest, in order."""
+        if not os.path.isdir(self.volume_dir):
+            return []
+        return sorted(int(match.group(1)) for match in map(_VOLUME.match, os.listdir(self.volume_dir)) if match)
+
+    def add(self, volume, path, filehash, hashalg=None, source_path=None):
+        """Record that a volume holds filehash at path (relative to the volume); the blob must already be stored."""
+        return self.manifest(volume).append(path, filehash, source_path, hashalg, stat_path=self.blob_path(filehash, hashalg))
+
+    def entries(self):
+        """(volume, manifest entry) for every archived path, volume by volume."""
+        for volume in self.volumes():
+            for entry in self.manifest(volume).load().values():
+                yield volume, entry
+
+    def blobs(self):
+        """(blob path, hash, hash algorithm) of every blob the volumes reference, each once; missing blobs are logged."""
+        seen = set()
+        for volume, entry in self.entries():
+            key = (entry.get('hashalg') or FLAT_ALGORITHM, entry['filehash'])
+            if key in seen:
+                continue
+            seen.add(key)
+            blob_path = self.blob_path(entry['filehash'], key[0])
+            if not os.path.isfile(blob_path):
+                log.error(f"Store - Volume {volume} references missing blob {blob_path} for {entry['path']}")
+                continue
+            yield blob_path, entry['filehash'], key[0]
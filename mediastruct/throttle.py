@@ -0,0 +1,162 @@
+"""Shared I/O rate limiting and I/O priority for hashing and moving files."""
+import os
+import re
+import time
+import logging
+import datetime
+import multiprocessing
+import psutil
+from mediastruct.utils import parse_size
+
+log = logging.getLogger(__name__)
+
+# Start method of the worker pools limiters are shared with; the bucket's shared state is created from the same
+# context, since state created for one start method cannot be handed to processes started by another
+CONTEXT = multiprocessing.get_context()
+
+class ThrottlePolicy:
+    """Bytes/s and IOPS limits for one command, optionally varying by time of day.
+
+    Config keys in [Throttle] are '<command>' or '<command>@HHMM-HHMM' (windows may
+    wrap midnight) with a value of '<bytes/s> [iops]'; 'default' applies to commands
+    without their own entry and 0 means unlimited.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules  # [(window or None, bytes_per_sec, iops)], windowed rules first
+
+    @classmethod
+    def from_config(cls, config, command, section='Throttle'):
+        if config is None or not config.has_section(section):
+            return cls([])
+        rules = []
+        for key, value in config.items(section):
+            name, _, window = key.partition('@')
+            if name not in (command, 'default'):
+                continue
+            parts = value.split()
+            bytes_per_sec = parse_size(parts[0]) if parts else None
+            iops = int(parts[1]) if len(parts) > 1 and int(parts[1]) > 0 else None
+            rules.append((cls._parse_window(window) if window else None, name == command, bytes_per_sec, iops))
+        # Windowed rules beat plain ones, and the command's own rules beat 'default'
+        rules.sort(key=lambda rule: (rule[0] is None, not rule[1]))
+        return cls([(window, bytes_per_sec, iops) for window, _, bytes_per_sec, iops in rules])
+
+    @staticmethod
+    def _parse_window(window):
+        match = re.match(r"^(\d{2})(\d{2})-(\d{2})(\d{2})$", window)
+        if not match:
+            raise ValueError(f"Invalid throttle window: {window} (expected HHMM-HHMM)")
+        h1, m1, h2, m2 = (int(g) for g in match.groups())
+        return (h1 * 60 + m1, h2 * 60 + m2)
+
+    @staticmethod
+    def _in_window(window, minute):
+        start, end = window
+        return start <= minute < end if start <= end else minute >= start or minute < end
+
+    def limits(self, now=None):
+        """Return (bytes_per_sec, iops) in force at now; None means unlimited."""
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for window, bytes_per_sec, iops in self.rules:
+            if window is None or self._in_window(window, minute):
+                return bytes_per_sec, iops
+        return None, None
+
+class TokenBucket:
+    """Token bucket over bytes and I/O operations, shared with the workers of pools created from CONTEXT.
+
+    Callers take what they need and sleep off any debt, so large reads are not
+    starved and the long-run rate converges on the limit.
+    """
+    BURST_SECONDS = 1.0
+    POLICY_REFRESH = 10.0
+
+    def __init__(self, policy):
+        self.policy = policy
+        # tokens for bytes, tokens for ops, last refill, bytes/s, iops, last policy check
+        self.state = CONTEXT.Array('d', [0.0, 0.0, time.monotonic(), 0.0, 0.0, 0.0])
+        self._refresh_policy(self.state, time.monotonic())
+
+    def _refresh_policy(self, state, now):
+        bytes_per_sec, iops = self.policy.limits()
+        state[3] = float(bytes_per_sec or 0)
+        state[4] = float(iops or 0)
+        state[5] = now
+
+    def acquire(self, nbytes=0, ops=1):
+        state = self.state
+        with state.get_lock():
+            now = time.monotonic()
+            if now - state[5] >= self.POLICY_REFRESH:
+                self._refresh_policy(state, now)
+            elapsed = now - state[2]
+            state[2] = now
+            wait = 0.0
+            for tokens, rate, amount in ((0, state[3], nbytes), (1, state[4], ops)):
+                if rate <= 0:
+                    continue
+                state[tokens] = min(rate * self.BURST_SECONDS, state[tokens] + elapsed * rate) - amount
+                if state[tokens] < 0:
+                    wait = max(wait, -state[tokens] / rate)
+        if wait > 0:
+            time.sleep(wait)
+
+_limiter = None
+
+def install(limiter):
+    """Make limiter the one acquire() draws from in this process (also used as a pool initializer)."""
+    global _limiter
+    _limiter = limiter
+
+def current():
+    return _limiter
+
+def acquire(nbytes=0, ops=1):
+    """Wait until nbytes and ops fit within the configured limits; a no-op when unthrottled."""
+    if _limiter is not None:
+        _limiter.acquire(nbytes, ops)
+
+def set_io_priority(priority):
+    """Set this process's I/O scheduling class: 'idle', 'besteffort' (lowest level) or 'normal'."""
+    if not priority or priority == 'normal':
+        return
+    try:
+        process = psutil.Process()
+        if priority == 'idle':
+            process.ionice(psutil.IOPRIO_CLASS_IDLE)
+        elif priority == 'besteffort':
+            process.ionice(psutil.IOPRIO_CLASS_BE, value=7)
+        else:
+            raise ValueError(f"Unknown I/O priority: {priority}")
+        log.info(f"Throttle - I/O priority set to {priority}")
+    except (AttributeError, psutil.Error, OSError) as e:
+        log.warning(f"Throttle - Could not set I/O priority {priority}: {e}")
+
+def acquire_move(source_path, dest_dir):
+    """Charge a move: a rename is one operation, a move across devices also costs the file's bytes."""
+    if _limiter is None:
+        return
+    try:
+        st = os.stat(source_path)
+        nbytes = 0 if st.st_dev == os.stat(dest_dir).st_dev else st.st_size
+    except OSError:
+        nbytes = 0
+    _limiter.acquire(nbytes, ops=1)
+
+def configure(config, command, section='Throttle'):
+    """Install the limiter and I/O priority configured for command; threads inherit both, pool workers through install()."""
+    policy = ThrottlePolicy.from_config(config, command, section)
+    priority = None
+    if config is not None and config.has_section(section):
+        priority = config.get(section, f'ionice@{command}', fallback=None) or config.get(section, 'ionice', fallback=None)
+    set_io_priority(priority)
+    if not policy.rules:
+        install(None)
+        return None
+    limiter = TokenBucket(policy)
+    install(limiter)
+    bytes_per_sec, iops = policy.limits()
+    log.info(f"Throttle - {command} limited to {bytes_per_sec or 'unlimited'} bytes/s, {iops or 'unlimited'} IOPS")
+    return limiter
@@ -8,11 +8,33 @@ import logging
 log = logging.getLogger(__name__)
 log.info('Launching the Utils Class')
 
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4, 'P': 1024**5}
+
+def parse_size(value):
+    """Parse a byte count such as '750G' or '1.5T' (binary units); empty or 0 means no limit (None)."""
+    if value is None or not str(value).strip():
+        return None
+    match = re.match(r"^\s*([\d.]+)\s*([KMGTP]?)i?B?\s*$", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {value}")
+    size = int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+    return size or None
+
+def mount_point(path):
+    """Mount point holding path (or its nearest existing parent), which names a device stably across reboots."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
 class utils:
 
-    def getFolderSize(self,start_path = '.'):
+    def getFolderSize(self,start_path = '.', rules=None):
         total_size = 0
-        for dirpath, dirnames, filenames in os.walk(start_path):
+        walker = rules.walk(start_path) if rules is not None else os.walk(start_path)
+        for dirpath, dirnames, filenames in walker:
             for f in filenames:
                 fp = os.path.join(dirpath, f)
                 total_size += os.path.getsize(fp)
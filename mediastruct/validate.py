@@ -1,21 +1,29 @@
 import os
-import time
 import logging
 import json
-import xxhash
+import random
 import shutil
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from mediastruct import throttle
+from mediastruct.hashing import HashPolicy, hash_path, record_algorithm
+from mediastruct import layout
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 log = logging.getLogger(__name__)
 
 class validate:
-    def __init__(self, data_files, duplicates_dir, archive_dir, ingest_dir, monitor=None):
+    def __init__(self, data_files, duplicates_dir, archive_dir, ingest_dir, monitor=None, cache=None, sample_rate=0.0, hash_policy=None, validated_dir="/data/media/validated", budget=None):
         self.data_files = data_files
+        # Rehashing stops once the budget is spent; unvalidated files stay in duplicates for the next run
+        self.budget = budget
+        self.hash_policy = hash_policy if hash_policy is not None else HashPolicy()
+        self.cache = cache
+        # Fraction of manifest-confirmed files that are rehashed anyway as a spot check
+        self.sample_rate = sample_rate
         self.duplicates_dir = duplicates_dir
         self.archive_dir = archive_dir
         self.ingest_dir = ingest_dir
-        self.validated_dir = "/data/media/validated"  # Hardcoded for now, can be made configurable
+        self.validated_dir = validated_dir
         self.monitor = monitor
         self.max_threads = os.cpu_count() or 4
         self._log_progress(f"Initialized validate with data_files: {self.data_files}, duplicates_dir: {self.duplicates_dir}, archive_dir: {self.archive_dir}, ingest_dir: {self.ingest_dir}, validated_dir: {self.validated_dir}")
@@ -27,43 +35,47 @@ class validate:
         getattr(log, level)(message)
 
     def _load_index_files(self):
-        """Load hashes from index files for validation, creating a hash-to-file mapping."""
-        hash_to_files = {}
+        """Load the set of (algorithm, hash) keys present in the index files; hashes only match under the same algorithm."""
+        indexed_hashes = set()
         for index_file in self.data_files:
             if not os.path.isfile(index_file):
                 self._log_progress(f"Index file {index_file} not found, skipping", "warning")
                 continue
             try:
-                with open(index_file, 'r') as f:
-                    index_data = json.load(f)
+                if self.cache is not None:
+                    index_data = self.cache.get(index_file)
+                else:
+                    with open(index_file, 'r') as f:
+                        index_data = json.load(f)
                 for file_id, data in index_data.items():
                     if file_id == 'du':
                         continue
-                    file_path = data.get('path', '')
                     file_hash = data.get('filehash', '')
-                    if file_path and file_hash:
-                        hash_to_files.setdefault(file_hash, []).append(Path(file_path).as_posix())
+                    if file_hash:
+                        indexed_hashes.add((record_algorithm(data), file_hash))
                 self._log_progress(f"Loaded {len(index_data)} entries from {index_file}")
             except Exception as e:
                 self._log_progress(f"Failed to load index file {index_file}: {e}", "error")
-        return hash_to_files
+        return indexed_hashes
 
-    def _hash_file(self, file_path):
-        """Compute the xxhash of a file."""
+    def _hash_file(self, file_path, algorithm=None):
+        """Compute the (algorithm, hash) of a file with the algorithm it was recorded under, or the one crawl would pick."""
         try:
-            with open(file_path, 'rb') as f:
-                hasher = xxhash.xxh64()
-                chunk_size = 1024 * 1024  # 1 MB chunks
-                while True:
-                    chunk = f.read(chunk_size)
-                    if not chunk:
-                        break
-                    hasher.update(chunk)
-                return hasher.hexdigest()
+            algorithm = algorithm or self.hash_policy.algorithm_for(os.path.getsize(file_path))
+            return algorithm, hash_path(file_path, algorithm, self.hash_policy.workers)[0]
         except Exception as e:
             self._log_progress(f"Failed to hash file {file_path}: {e}", "error")
             return None
 
+    @staticmethod
+    def _matches_manifest(file_path, entry):
+        """Check a file's size and mtime against the manifest entry written when dedupe or ingest moved it."""
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return False
+        return st.st_size == entry.get('filesize') and st.st_mtime_ns == entry.get('mtime_ns')
+
     def validate_files(self):
         """Validate files in the duplicates directory and move valid ones to validated_dir."""
         self._log_progress("Starting validation")
@@ -81,22 +93,26 @@ class validate:
             self._log_progress(f"Failed to create validated directory {self.validated_dir}: {e}", "error")
             return
 
-        # Load hashes from index files
-        hash_to_files = self._load_index_files()
+        # Load hashes from index files, and the duplicates manifest: the one record of each move into the
+        # duplicates directory, with the hash, size and mtime it had and where it came from
+        indexed_hashes = self._load_index_files()
+        duplicates_manifest = layout.manifest(self.duplicates_dir)
+        validated_manifest = layout.manifest(self.validated_dir)
+        manifest_entries = duplicates_manifest.load()
+        self._log_progress(f"Loaded {len(manifest_entries)} manifest entries")
 
         # Collect all files in the duplicates directory
         file_paths = []
-        for root, _, files in os.walk(self.duplicates_dir):
-            for filename in files:
-                file_path = os.path.join(root, filename)
-                if not os.path.isfile(file_path):
-                    self._log_progress(f"Skipping non-file: {file_path}", "warning")
-                    continue
-                file_paths.append(file_path)
+        for file_path in layout.walk_files(self.duplicates_dir):
+            if not os.path.isfile(file_path):
+                self._log_progress(f"Skipping non-file: {file_path}", "warning")
+                continue
+            file_paths.append(file_path)
 
         total_files = len(file_paths)
         validated_files = 0
         failed_files = 0
+        confirmed_by_manifest = 0
 
         if total_files == 0:
             self._log_progress(f"No files found in {self.duplicates_dir}, skipping validation", "info")
@@ -105,47 +121,84 @@ class validate:
         if self.monitor:
             self.monitor.update_progress("validate", status="Running", processed=0, total=total_files, current=f"Validating files in {self.duplicates_dir}")
 
-        # Validate files in parallel using ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
-            futures = {executor.submit(self._hash_file, file_path): file_path for file_path in file_paths}
-            for future in as_completed(futures):
-                file_path = futures[future]
-                computed_hash = future.result()
-                if computed_hash is None:
-                    failed_files += 1
-                    continue
-
-                # Check if the computed hash exists in the index
-                if computed_hash in hash_to_files:
-                    # File is a valid duplicate if its hash matches an entry in the index
-                    indexed_paths = hash_to_files[computed_hash]
-                    self._log_progress(f"File {file_path} validated successfully (hash matches: {computed_hash}, original paths: {indexed_paths})")
-
-                    # Move the validated file to validated_dir
-                    filename = os.path.basename(file_path)
-                    dest_path = os.path.join(self.validated_dir, filename)
-                    if os.path.isfile(dest_path):
-                        base, ext = os.path.splitext(filename)
-                        millis = int(round(time.time() * 1000))
-                        new_filename = f"{base}.{millis}{ext}"
-                        dest_path = os.path.join(self.validated_dir, new_filename)
-                        self._log_progress(f"Destination path {dest_path} already exists, renamed to: {new_filename}")
-
-                    try:
-                        shutil.move(file_path, dest_path)
-                        self._log_progress(f"Moved validated file: {file_path} -> {dest_path}")
-                    except Exception as e:
-                        self._log_progress(f"Failed to move validated file {file_path} to {dest_path}: {e}", "error")
-                        failed_files += 1
-                        continue
-
+        # Files whose size and mtime still match their manifest entry are confirmed without reading them
+        to_hash = []
+        confirmed = []
+        for file_path in file_paths:
+            entry = manifest_entries.get(file_path)
+            if entry and entry.get('filehash') and self._matches_manifest(file_path, entry) and random.random() >= self.sample_rate:
+                confirmed.append((file_path, (record_algorithm(entry), entry['filehash'])))
+            else:
+                to_hash.append(file_path)
+        confirmed_by_manifest = len(confirmed)
+        # Largest first, so a run cut short by its budget still clears the most space
+        to_hash.sort(key=lambda file_path: os.path.getsize(file_path) if os.path.exists(file_path) else 0, reverse=True)
+        self._log_progress(f"{confirmed_by_manifest} files confirmed from the manifest, {len(to_hash)} to rehash")
+
+        def results():
+            yield from confirmed
+            # Submitted a few at a time so nothing new starts once the budget is spent
+            pending = iter(to_hash)
+            with ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+                futures = {}
+                while True:
+                    while len(futures) < self.max_threads * 2 and not (self.budget and self.budget.expired()):
+                        file_path = next(pending, None)
+                        if file_path is None:
+                            break
+                        futures[executor.submit(self._hash_file, file_path, (manifest_entries.get(file_path) or {}).get('hashalg'))] = file_path
+                    if not futures:
+                        return
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        yield futures.pop(future), future.result()
+
+        validated_paths = set()
+        processed = 0
+        for file_path, hash_key in results():
+            if self.budget and self.budget.expired():
+                self._log_progress(f"Budget spent, {total_files - processed} files left in {self.duplicates_dir} for the next validate", "warning")
+                break
+            processed += 1
+            if hash_key is None:
+                failed_files += 1
+                continue
+            hashalg, computed_hash = hash_key
+
+            entry = manifest_entries.get(file_path)
+            if entry and entry.get('filehash') and computed_hash != entry['filehash']:
+                self._log_progress(f"File {file_path} does not match the hash recorded when it was moved (computed: {computed_hash}, manifest: {entry['filehash']})", "error")
+                failed_files += 1
+            elif hash_key in indexed_hashes:
+                # File is a valid duplicate if its hash matches an entry in the index under the same algorithm
+                self._log_progress(f"File {file_path} validated successfully ({hashalg} hash matches: {computed_hash})")
+
+                # Move the validated file into its shard of validated_dir
+                filename = layout.original_name(os.path.basename(file_path), computed_hash)
+                dest_path = layout.shard_path(self.validated_dir, computed_hash, filename)
+                source = (entry or {}).get('source') or file_path
+
+                try:
+                    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                    throttle.acquire_move(file_path, self.validated_dir)
+                    shutil.move(file_path, dest_path)
+                    validated_manifest.append(dest_path, computed_hash, source, hashalg)
+                    self._log_progress(f"Moved validated file: {file_path} -> {dest_path}")
+                    validated_paths.add(file_path)
                     validated_files += 1
-                else:
-                    self._log_progress(f"File {file_path} hash not found in index files (computed: {computed_hash})", "error")
+                except Exception as e:
+                    self._log_progress(f"Failed to move validated file {file_path} to {dest_path}: {e}", "error")
                     failed_files += 1
+            else:
+                self._log_progress(f"File {file_path} hash not found in index files (computed {hashalg}: {computed_hash})", "error")
+                failed_files += 1
+
+            if self.monitor and total_files > 0:
+                self.monitor.update_progress("validate", status="Running", processed=validated_files + failed_files, total=total_files, current=f"Processed file: {os.path.basename(file_path)}")
+            self._log_progress(f"Processed {validated_files + failed_files}/{total_files} files ({((validated_files + failed_files)/total_files)*100:.1f}%)")
 
-                if self.monitor and total_files > 0:
-                    self.monitor.update_progress("validate", status="Running", processed=validated_files + failed_files, total=total_files, current=f"Processed file: {os.path.basename(file_path)}")
-                self._log_progress(f"Processed {validated_files + failed_files}/{total_files} files ({((validated_files + failed_files)/total_files)*100:.1f}%)")
+        # Drop manifest entries for files that have left the duplicates directory
+        if validated_paths:
+            duplicates_manifest.rewrite(entry for path, entry in manifest_entries.items() if path not in validated_paths)
 
-        self._log_progress(f"Validation completed: {validated_files} files validated and moved to {self.validated_dir}, {failed_files} files failed and remain in {self.duplicates_dir}")
+        self._log_progress(f"Validation completed: {validated_files} files validated and moved to {self.validated_dir} ({confirmed_by_manifest} confirmed from the manifest without rehashing), {failed_files} files failed and remain in {self.duplicates_dir}")
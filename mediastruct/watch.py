@@ -0,0 +1,432 @@
+"""Watch the configured roots and keep the indexes fresh as files arrive."""
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import datetime
+import yaml
+from pathlib import Path
+from mediastruct import crawl, locks
+from mediastruct.rules import PathRules
+from mediastruct.index import index_path, load_index, write_index, write_delta, generation, record_id
+
+log = logging.getLogger(__name__)
+
+# inotify constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+class InotifySource:
+    """Report changed and deleted paths under a set of directory trees using Linux inotify."""
+
+    def __init__(self, walkers):
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1 failed: {os.strerror(err)}")
+        self.walkers = walkers
+        self.watches = {}
+        for root, walker in walkers:
+            self.add_tree(root, walker)
+        log.info(f"Watch - inotify watching {len(self.watches)} directories")
+
+    def _walker_for(self, path):
+        matches = [(root, walker) for root, walker in self.walkers if path == root or path.startswith(root.rstrip("/") + "/")]
+        return max(matches, key=lambda m: len(m[0]))[1] if matches else None
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_add_watch failed for {path}: {os.strerror(err)}")
+        self.watches[wd] = path
+
+    def add_tree(self, root, walker=None):
+        """Watch every directory under root, returning the files already present."""
+        walker = walker or self._walker_for(root) or os.walk
+        files = []
+        for dirpath, _, filenames in walker(root):
+            self.add_watch(dirpath)
+            files.extend(os.path.join(dirpath, f) for f in filenames)
+        return files
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds and return a list of (path, kind) events."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, name_len = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(buf[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                log.warning("Watch - inotify queue overflowed, rescanning")
+                events.append((None, "rescan"))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    walker = self._walker_for(path)
+                    if walker is None:
+                        continue
+                    try:
+                        events.extend((f, "changed") for f in self.add_tree(path, walker))
+                    except OSError as e:
+                        log.error(f"Watch - Failed to watch new directory {path}: {e}")
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    events.append((path, "deleted_dir"))
+                continue
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                events.append((path, "deleted"))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ATTRIB):
+                events.append((path, "changed"))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class PollSource:
+    """Fallback change detection that compares periodic stat snapshots of the watched trees."""
+
+    def __init__(self, walkers, interval):
+        self.walkers = walkers
+        self.interval = interval
+        self.snapshot = self._scan()
+        self.last_scan = time.monotonic()
+        log.info(f"Watch - Polling {len(self.snapshot)} files every {interval}s")
+
+    def _scan(self):
+        snapshot = {}
+        for root, walker in self.walkers:
+            for dirpath, _, filenames in walker(root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout):
+        wait = self.interval - (time.monotonic() - self.last_scan)
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            return []
+        current = self._scan()
+        self.last_scan = time.monotonic()
+        events = [(path, "changed") for path, sig in current.items() if self.snapshot.get(path) != sig]
+        events.extend((path, "deleted") for path in self.snapshot.keys() - current.keys())
+        self.snapshot = current
+        return events
+
+    def close(self):
+        pass
+
+class watch:
+    """Hash files as they settle, update indexes and hash caches in place and queue debounced ingest/dedupe runs."""
+    METADATA_FILE = crawl.crawl.METADATA_FILE
+
+    def __init__(self, roots, ingest_dir, datadir, rules=None, on_ingest=None, on_dedupe=None,
+                 settle=5.0, debounce=30.0, flush_delay=2.0, poll_interval=10.0, use_inotify=True, monitor=None, hash_policy=None, lock_dir=None):
+        self.roots = [r for r in roots if os.path.isdir(r)]
+        self.ingest_dir = ingest_dir
+        # Flushes lock the roots they write like any other command, and rebase onto an index rewritten meanwhile
+        self.lock_dir = lock_dir
+        self.datadir = datadir
+        self.rules = rules if rules is not None else PathRules()
+        self.hash_policy = hash_policy
+        self.on_ingest = on_ingest
+        self.on_dedupe = on_dedupe
+        self.settle = settle
+        self.debounce = debounce
+        self.flush_delay = flush_delay
+        self.monitor = monitor
+        self.pending = {}       # path -> (event time, (size, mtime_ns))
+        self.jobs = {}          # job name -> due time
+        self.dirty_caches = {}  # target dir -> {relative path: cache entry or None}
+        self.last_change = None
+        self.running = False
+        self._load_indexes()
+
+        walkers = [(root, os.walk if root == ingest_dir else self.rules.walk) for root in self.roots]
+        self.source = None
+        if use_inotify:
+            try:
+                self.source = InotifySource(walkers)
+            except (OSError, AttributeError) as e:
+                self._log_progress(f"inotify unavailable ({e}), falling back to polling", "warning")
+        if self.source is None:
+            self.source = PollSource(walkers, poll_interval)
+        self.run()
+
+    def _log_progress(self, message, level="info"):
+        """Log progress messages and print to console."""
+        print(f"Watch - {message}")
+        getattr(log, level)(message)
+
+    def _load_indexes(self):
+        """Keep each root's index resident with a path -> record id lookup."""
+        self.indexes = {}
+        for root in self.roots:
+            if root == self.ingest_dir:
+                continue
+            file_path = index_path(self.datadir, root)
+            seen = generation(file_path)
+            try:
+                data = load_index(file_path)
+            except Exception as e:
+                self._log_progress(f"Failed to load index {file_path}, starting empty: {e}", "error")
+                data = {}
+            by_path = {record['path']: file_id for file_id, record in data.items() if file_id != 'du'}
+            # changes: path -> record (None once removed) since the last flush, replayed if the index is rewritten underneath
+            self.indexes[root] = {"file": file_path, "data": data, "by_path": by_path, "dirty": False, "generation": seen, "changes": {}}
+            self._log_progress(f"Loaded {len(by_path)} records from {file_path}")
+
+    def _root_for(self, path):
+        matches = [root for root in self.roots if path.startswith(root.rstrip("/") + "/")]
+        return max(matches, key=len) if matches else None
+
+    def _touch(self):
+        self.last_change = time.monotonic()
+
+    def _schedule(self, job):
+        self.jobs[job] = time.monotonic() + self.debounce
+        log.debug(f"Watch - Scheduled {job} in {self.debounce}s")
+
+    def _on_event(self, path, kind, now):
+        if kind == "rescan":
+            self._rescan()
+        elif kind == "deleted":
+            self.pending.pop(path, None)
+            self._remove(path)
+        elif kind == "deleted_dir":
+            prefix = path.rstrip("/") + "/"
+            for pending_path in [p for p in self.pending if p.startswith(prefix)]:
+                del self.pending[pending_path]
+            for index in self.indexes.values():
+                for file_path in [p for p in index["by_path"] if p.startswith(prefix)]:
+                    self._remove(file_path)
+        else:
+            if os.path.basename(path) == self.METADATA_FILE or os.path.basename(path).startswith("._"):
+                return
+            try:
+                st = os.stat(path)
+            except OSError:
+                return
+            self.pending[path] = (now, (st.st_size, st.st_mtime_ns))
+
+    def _rescan(self):
+        """Queue every file whose size differs from its index record after lost events."""
+        for root in self.roots:
+            walker = os.walk if root == self.ingest_dir else self.rules.walk
+            index = self.indexes.get(root)
+            for dirpath, _, filenames in walker(root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    file_id = index["by_path"].get(path) if index else None
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    if file_id is None or index["data"][file_id].get('filesize') != st.st_size:
+                        self.pending[path] = (time.monotonic(), (st.st_size, st.st_mtime_ns))
+
+    def _settle_pending(self, now):
+        """Process files whose size and mtime have not changed for the settle period."""
+        for path, (seen, sig) in list(self.pending.items()):
+            if now - seen < self.settle:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != sig:
+                self.pending[path] = (now, current)
+                continue
+            del self.pending[path]
+            self._process(path)
+
+    def _process(self, path):
+        root = self._root_for(path)
+        if root is None:
+            return
+        if root == self.ingest_dir:
+            self._schedule("ingest")
+            return
+        target = self.rules.target_for(path)
+        if target is None:
+            log.debug(f"Watch - Ignoring file outside any target directory: {path}")
+            return
+        _, file_hash, extra = crawl.hash_file(path, self.hash_policy)
+        if not file_hash:
+            return
+        try:
+            record = crawl.build_record(path, file_hash, extra)
+        except FileNotFoundError:
+            return
+        index = self.indexes[root]
+        file_id = index["by_path"].get(path) or record_id(path)
+        index["data"][file_id] = record
+        index["by_path"][path] = file_id
+        index["changes"][path] = record
+        index["dirty"] = True
+        self.dirty_caches.setdefault(target, {})[os.path.relpath(path, target)] = crawl.cache_entry(file_hash, extra)
+        self._touch()
+        self._schedule("dedupe")
+        self._log_progress(f"Indexed {path} ({file_hash})")
+
+    def _remove(self, path):
+        root = self._root_for(path)
+        index = self.indexes.get(root)
+        if index is None or path not in index["by_path"]:
+            return
+        file_id = index["by_path"].pop(path)
+        index["data"].pop(file_id, None)
+        index["changes"][path] = None
+        index["dirty"] = True
+        target = self.rules.target_for(path)
+        if target:
+            self.dirty_caches.setdefault(target, {})[os.path.relpath(path, target)] = None
+        self._touch()
+        log.debug(f"Watch - Removed {path} from index")
+
+    def _rebase(self, index, current):
+        """Replay the changes since the last flush onto the generation another command wrote."""
+        data = dict(current)
+        by_path = {record['path']: file_id for file_id, record in data.items() if file_id != 'du'}
+        for path, record in index["changes"].items():
+            file_id = by_path.pop(path, None)
+            if file_id is not None:
+                data.pop(file_id, None)
+            if record is not None:
+                file_id = record_id(path)
+                data[file_id] = record
+                by_path[path] = file_id
+        index["data"] = data
+        index["by_path"] = by_path
+
+    def _write_index(self, index):
+        """Write a dirty index and its delta, rebased first if it was rewritten since watch last read or wrote it."""
+        base = generation(index["file"])
+        previous = load_index(index["file"]) if base else {}
+        if base != index["generation"]:
+            self._log_progress(f"{index['file']} was rewritten by another command, replaying {len(index['changes'])} changes onto it", "warning")
+            self._rebase(index, previous)
+        write_index(index["file"], index["data"])
+        delta = write_delta(index["file"], previous, base, index["data"])
+        index["generation"] = delta["generation"]
+        index["changes"] = {}
+        index["dirty"] = False
+
+    def flush(self):
+        """Write dirty indexes and .mediastruct hash caches under exclusive locks on their roots."""
+        roots = {root for root, index in self.indexes.items() if index["dirty"]}
+        roots.update(filter(None, map(self._root_for, self.dirty_caches)))
+        if not roots:
+            self.last_change = None
+            return
+        with locks.hold(self.lock_dir, exclusive=sorted(roots), command="watch"):
+            self._flush()
+        self.last_change = None
+
+    def _flush(self):
+        for target, changes in self.dirty_caches.items():
+            metadata_path = Path(target) / self.METADATA_FILE
+            metadata = None
+            if metadata_path.exists():
+                try:
+                    with metadata_path.open("r") as f:
+                        metadata = yaml.safe_load(f)
+                except yaml.YAMLError as e:
+                    self._log_progress(f"Failed to read metadata file {metadata_path}, rewriting: {e}", "error")
+            if not metadata or 'files' not in metadata:
+                # Watch only saw some of the target's files, so a cache it creates is partial: the next
+                # crawl reuses these hashes and hashes the rest instead of trusting it as complete
+                metadata = {"timestamp": datetime.datetime.now().isoformat(), "files": {}, "partial": True, "stale": {}}
+            for relative_path, entry in changes.items():
+                if entry is None:
+                    metadata["files"].pop(relative_path, None)
+                    metadata.get("stale", {}).pop(relative_path, None)
+                else:
+                    metadata["files"][relative_path] = entry
+            try:
+                with metadata_path.open("w") as f:
+                    yaml.dump(metadata, f, default_flow_style=False)
+            except Exception as e:
+                self._log_progress(f"Failed to write metadata file {metadata_path}: {e}", "error")
+        self.dirty_caches = {}
+        for index in self.indexes.values():
+            if index["dirty"]:
+                try:
+                    self._write_index(index)
+                except Exception as e:
+                    self._log_progress(f"Failed to write index file {index['file']}: {e}", "error")
+
+    def _run_due_jobs(self, now):
+        for job, due in sorted(self.jobs.items(), key=lambda item: item[1]):
+            if due > now:
+                continue
+            del self.jobs[job]
+            callback = self.on_ingest if job == "ingest" else self.on_dedupe
+            if callback is None:
+                continue
+            # Downstream commands read the index files, so they must be current first
+            self.flush()
+            self._log_progress(f"Running debounced {job}")
+            try:
+                callback()
+            except Exception as e:
+                self._log_progress(f"Debounced {job} failed: {e}", "error")
+
+    def run(self):
+        """Main event loop; runs until interrupted."""
+        self.running = True
+        self._log_progress(f"Watching {', '.join(self.roots)}")
+        try:
+            while self.running:
+                events = self.source.poll(timeout=1.0)
+                now = time.monotonic()
+                for path, kind in events:
+                    self._on_event(path, kind, now)
+                self._settle_pending(now)
+                if self.last_change is not None and now - self.last_change >= self.flush_delay:
+                    self.flush()
+                self._run_due_jobs(now)
+        except KeyboardInterrupt:
+            self._log_progress("Interrupted, flushing state")
+        finally:
+            self.flush()
+            self.source.close()
+            self.running = False
@@ -1,5 +1,3 @@
 #!/bin/bash
 cd ../
-python mediastruct ingest
-python mediastruct crawl
-python mediastruct dedupe
+python mediastruct run
@@ -38,6 +38,7 @@ setup(
     entry_points={
         'console_scripts': [
             'mediastruct = mediastruct.__main__:main',
+            'mediastruct-client = mediastruct.client:main',
         ],
     },
     install_requires=[
@@ -46,5 +47,8 @@ setup(
         'timeout-decorator>=0.5.0',
         'psutil>=6.0.0',
     ],
+    extras_require={
+        'perceptual': ['numpy>=1.21', 'Pillow>=9.0'],
+    },
     python_requires='>=3.6',
 )
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Let `py.test tests` import the package from the checkout without installing it
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,21 @@
+import argparse
+import pytest
+from mediastruct.budget import Budget, deadline_option, duration_option
+
+def parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--deadline', type=deadline_option)
+    parser.add_argument('--budget', type=duration_option)
+    return parser
+
+@pytest.mark.parametrize('argv', [['--budget', '2x'], ['--budget', ''], ['--deadline', '25:99'], ['--deadline', 'tonight']])
+def test_malformed_limits_are_usage_errors(argv, capsys):
+    with pytest.raises(SystemExit) as exit:
+        parser().parse_args(argv)
+    assert exit.value.code == 2
+    assert f"argument {argv[0]}: Invalid" in capsys.readouterr().err
+
+def test_valid_limits_are_kept_as_given():
+    args = parser().parse_args(['--budget', '2h30m', '--deadline', '06:00'])
+    assert (args.budget, args.deadline) == ('2h30m', '06:00')
+    assert Budget.from_options(deadline=args.deadline, budget=args.budget).remaining() <= 9000
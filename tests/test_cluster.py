@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import subprocess
+import pytest
+from mediastruct import crawl, cluster
+from mediastruct.index import index_path
+from mediastruct.rules import PathRules
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def records(datadir, root):
+    with open(index_path(str(datadir), str(root))) as f:
+        index = json.load(f)
+    return {file_id: (record['path'], record['filehash'], record['filesize']) for file_id, record in index.items() if file_id != 'du'}
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'archive'
+    for volume, names in (('01', 'ab'), ('02', 'cd'), ('03', 'ef'), ('04', 'g')):
+        (root / volume / 'sub').mkdir(parents=True)
+        for name in names:
+            (root / volume / name).write_bytes(name.encode() * 1000)
+            (root / volume / 'sub' / name).write_bytes(name.encode() * 10)
+    return root
+
+def start_worker(port, root, include):
+    """A worker process serving root on a loopback port, once it accepts connections."""
+    rules = "PathRules(include=[sys.argv[2] + '/*'], exclude=[])" if include else "None"
+    code = ("import sys; from mediastruct import cluster; from mediastruct.rules import PathRules; "
+            f"cluster.worker(('127.0.0.1', int(sys.argv[1])), [sys.argv[2]], rules={rules})")
+    process = subprocess.Popen([sys.executable, '-c', code, str(port), str(root)], cwd=REPO,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise
+            time.sleep(0.1)
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+@pytest.fixture
+def workers(tree):
+    """Two worker processes on loopback ports, serving the tree's root."""
+    addresses = [('127.0.0.1', free_port()) for _ in range(2)]
+    processes = []
+    try:
+        for _, port in addresses:
+            processes.append(start_worker(port, tree, include=True))
+        yield addresses
+    finally:
+        stop(processes)
+
+def rules_for(root):
+    return PathRules(include=[f"{root}/*"], exclude=[])
+
+def test_distributed_crawl_matches_local_crawl(tree, workers, tmp_path, capsys):
+    crawl.crawl(True, str(tree), str(tmp_path / 'local'), rules=rules_for(tree))
+    cluster.cluster(True, str(tree), str(tmp_path / 'distributed'), workers=workers, slots=2, rules=rules_for(tree))
+    output = capsys.readouterr().out
+    assert output.count("Merged") == 4 and "hashing it locally" not in output
+    local = records(tmp_path / 'local', tree)
+    assert len(local) == 14
+    assert records(tmp_path / 'distributed', tree) == local
+
+def test_unreachable_worker_falls_back_to_local_hashing(tree, workers, tmp_path):
+    crawl.crawl(True, str(tree), str(tmp_path / 'local'), rules=rules_for(tree))
+    dead = ('127.0.0.1', free_port())
+    cluster.cluster(True, str(tree), str(tmp_path / 'fallback'), workers=[dead], rules=rules_for(tree))
+    cluster.cluster(True, str(tree), str(tmp_path / 'mixed'), workers=[workers[0], dead], rules=rules_for(tree))
+    local = records(tmp_path / 'local', tree)
+    assert records(tmp_path / 'fallback', tree) == local
+    assert records(tmp_path / 'mixed', tree) == local
+
+def test_refused_target_is_hashed_locally(tree, tmp_path):
+    # A worker refuses targets outside its roots; the coordinator hashes them itself
+    other = tmp_path / 'other'
+    other.mkdir()
+    port = free_port()
+    process = start_worker(port, other, include=False)
+    try:
+        crawl.crawl(True, str(tree), str(tmp_path / 'local'), rules=rules_for(tree))
+        cluster.cluster(True, str(tree), str(tmp_path / 'refused'), workers=[('127.0.0.1', port)], rules=rules_for(tree))
+    finally:
+        stop([process])
+    assert records(tmp_path / 'refused', tree) == records(tmp_path / 'local', tree)
+
+def test_worker_without_token_only_listens_on_loopback(tmp_path):
+    with pytest.raises(ValueError):
+        cluster.worker(('0.0.0.0', free_port()), [str(tmp_path)])
+    assert cluster.default_listen() == f"127.0.0.1:{cluster.DEFAULT_PORT}"
+    assert cluster.default_listen('secret') == f"0.0.0.0:{cluster.DEFAULT_PORT}"
+
+def test_stalled_worker_falls_back_to_local_hashing(tree, tmp_path):
+    crawl.crawl(True, str(tree), str(tmp_path / 'local'), rules=rules_for(tree))
+    # Connections complete from the listen backlog, but nothing ever answers them
+    with socket.socket() as stalled:
+        stalled.bind(('127.0.0.1', 0))
+        stalled.listen()
+        start = time.time()
+        cluster.cluster(True, str(tree), str(tmp_path / 'stalled'), workers=[stalled.getsockname()], timeout=1, rules=rules_for(tree))
+    assert time.time() - start < 30
+    assert records(tmp_path / 'stalled', tree) == records(tmp_path / 'local', tree)
+
+def test_heartbeats_keep_a_slow_target_alive(tree, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(cluster, 'HEARTBEAT', 0.1)
+
+    class slow:
+        def records(self, request):
+            time.sleep(1)
+            crawler = crawl.crawl(force=True, rootdir=request['target'], datadir=None, rules=rules_for(tree), run=False)
+            return crawler.target_records(request['target'])
+
+    server = cluster._Server(('127.0.0.1', 0), cluster._Handler)
+    server.worker = slow()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        cluster.cluster(True, str(tree), str(tmp_path / 'slow'), workers=[server.server_address], timeout=0.5, rules=rules_for(tree))
+    finally:
+        server.shutdown()
+        server.server_close()
+    output = capsys.readouterr().out
+    assert output.count("Merged") == 4 and "hashing it locally" not in output
+    crawl.crawl(True, str(tree), str(tmp_path / 'local'), rules=rules_for(tree))
+    assert records(tmp_path / 'slow', tree) == records(tmp_path / 'local', tree)
@@ -0,0 +1,114 @@
+import os
+import json
+import pytest
+from contextlib import contextmanager
+from mediastruct import dedupe, validate, layout
+
+@pytest.fixture
+def roots(tmp_path):
+    # dedupe tells media from archive files by path, so the tree mirrors /data/media and /data/archive
+    base = tmp_path / 'data'
+    for name in ('media', 'archive', 'ingest'):
+        (base / name).mkdir(parents=True)
+    return base
+
+def write_index(path, files):
+    """Write an index of {name: (file path, content, extra record fields)} and create the files."""
+    index = {'du': 0}
+    for name, (file_path, content, extra) in files.items():
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(content)
+        index[name] = dict({'filehash': extra.pop('filehash', name), 'path': str(file_path), 'filesize': len(content), 'year': 2020}, **extra)
+    with open(path, 'w') as f:
+        json.dump(index, f)
+    return str(path)
+
+def stored(root):
+    return sorted(os.path.basename(path) for path in layout.walk_files(str(root))) if os.path.isdir(root) else []
+
+def test_near_duplicates_within_distance_of_the_keeper_are_moved_for_review(roots, tmp_path):
+    media = roots / 'media' / '2020'
+    # keep~near is 4 bits, near~far 4 bits, but keep~far 8: far joins the group only through near
+    index = write_index(tmp_path / 'media_index.json', {
+        'keep': (media / 'keep.jpg', b'k' * 300, {'dhash': '0000000000000000'}),
+        'near': (media / 'near.jpg', b'n' * 200, {'dhash': '000000000000000f'}),
+        'far': (media / 'far.jpg', b'f' * 100, {'dhash': '00000000000000ff'}),
+    })
+    report = tmp_path / 'near_duplicates.json'
+    review = roots / 'media' / 'near_duplicates'
+    duplicates = roots / 'media' / 'duplicates'
+    dedupe.dedupe([index], str(duplicates), str(roots / 'archive'), str(roots / 'ingest'),
+                  near_duplicates=str(report), near_action='move', near_distance=6, near_duplicates_dir=str(review))
+    with open(report) as f:
+        groups = json.load(f)
+    assert [group['keep'] for group in groups] == [str(media / 'keep.jpg')]
+    assert {entry['path']: (entry['distance'], entry['moved']) for entry in groups[0]['similar']} == {
+        str(media / 'far.jpg'): (8, False), str(media / 'near.jpg'): (4, True)}
+    assert os.path.exists(media / 'far.jpg') and not os.path.exists(media / 'near.jpg')
+    assert stored(review) == ['near_near.jpg']
+    assert layout.manifest(str(review)).load()[layout.shard_path(str(review), 'near', 'near.jpg')]['source'] == str(media / 'near.jpg')
+    # Nothing lands where validate would confirm it against the near-duplicate's own index record
+    assert stored(duplicates) == []
+    validate.validate([index], str(duplicates), str(roots / 'archive'), str(roots / 'ingest'), validated_dir=str(roots / 'media' / 'validated'))
+    assert stored(roots / 'media' / 'validated') == []
+    assert stored(review) == ['near_near.jpg']
+
+def test_moving_near_duplicates_needs_a_review_directory(roots, tmp_path):
+    index = write_index(tmp_path / 'media_index.json', {})
+    with pytest.raises(ValueError):
+        dedupe.dedupe([index], str(roots / 'media' / 'duplicates'), str(roots / 'archive'), str(roots / 'ingest'),
+                      near_duplicates=str(tmp_path / 'near.json'), near_action='move')
+
+def test_copies_are_moved_to_duplicates_and_the_archive_is_never_touched(roots, tmp_path):
+    archive, media = roots / 'archive' / '01', roots / 'media'
+    files = {
+        'kept': (archive / 'a.jpg', b'a' * 1000, {'filehash': 'aaaa'}),
+        'copy': (media / '2020' / 'a.jpg', b'a' * 1000, {'filehash': 'aaaa'}),
+        # Same fast hash, different bytes: a collision the strong digest must catch
+        'collision': (media / '2020' / 'c.jpg', b'c' * 1000, {'filehash': 'aaaa'}),
+        'first': (media / '2020' / 'x.jpg', b'x' * 1000, {'filehash': 'bbbb'}),
+        'second': (media / '2021' / 'x.jpg', b'x' * 1000, {'filehash': 'bbbb'}),
+        # An archived copy of the same content is a keeper, never a candidate
+        'archived twice': (roots / 'archive' / '02' / 'a.jpg', b'a' * 1000, {'filehash': 'aaaa'}),
+        'unique': (media / '2020' / 'u.jpg', b'u' * 1000, {'filehash': 'cccc'}),
+    }
+    index = write_index(tmp_path / 'index.json', files)
+    duplicates = roots / 'media' / 'duplicates'
+    dedupe.dedupe([index], str(duplicates), str(roots / 'archive'), str(roots / 'ingest'))
+    assert stored(duplicates) == ['aaaa_a.jpg', 'bbbb_x.jpg']
+    for name in ('kept', 'collision', 'first', 'archived twice', 'unique'):
+        assert os.path.exists(files[name][0]), name
+    for name in ('copy', 'second'):
+        assert not os.path.exists(files[name][0]), name
+    manifest = layout.manifest(str(duplicates)).load()
+    assert sorted(entry['source'] for entry in manifest.values()) == [str(files['copy'][0]), str(files['second'][0])]
+
+    # validate confirms both from the manifest and moves them on
+    validated = roots / 'media' / 'validated'
+    validate.validate([index], str(duplicates), str(roots / 'archive'), str(roots / 'ingest'), validated_dir=str(validated))
+    assert stored(validated) == ['aaaa_a.jpg', 'bbbb_x.jpg']
+    assert stored(duplicates) == [] and layout.manifest(str(duplicates)).load() == {}
+
+class Rewrites:
+    """A move lock that rewrites an index as it is taken, like a crawl finishing while dedupe was planning."""
+
+    def __init__(self, index):
+        self.index = index
+
+    @contextmanager
+    def __call__(self):
+        with open(self.index, 'a') as f:
+            f.write(' ')
+        yield
+
+def test_nothing_moves_when_an_index_is_rewritten_before_the_move_locks(roots, tmp_path):
+    media = roots / 'media'
+    index = write_index(tmp_path / 'index.json', {
+        'first': (media / '2020' / 'x.jpg', b'x' * 1000, {'filehash': 'bbbb'}),
+        'second': (media / '2021' / 'x.jpg', b'x' * 1000, {'filehash': 'bbbb'}),
+    })
+    duplicates = roots / 'media' / 'duplicates'
+    dedupe.dedupe([index], str(duplicates), str(roots / 'archive'), str(roots / 'ingest'), move_lock=Rewrites(index))
+    assert stored(duplicates) == []
+    assert os.path.exists(media / '2021' / 'x.jpg')
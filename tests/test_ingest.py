@@ -0,0 +1,44 @@
+import os
+import json
+from datetime import datetime
+from mediastruct import crawl, ingest, layout
+from mediastruct.index import index_path
+from mediastruct.rules import PathRules
+
+def test_new_files_are_filed_by_date_and_known_ones_moved_to_duplicates(tmp_path):
+    media, source, duplicates, datadir = (tmp_path / name for name in ('media', 'ingest', 'duplicates', 'data'))
+    (media / '2020').mkdir(parents=True)
+    (media / '2020' / 'old.jpg').write_bytes(b'o' * 4000)
+    crawl.crawl(True, str(media), str(datadir), rules=PathRules(include=[f"{media}/*"], exclude=[]))
+    source.mkdir()
+    (source / 'again.jpg').write_bytes(b'o' * 4000)
+    (source / 'new.jpg').write_bytes(b'n' * 4000)
+    os.utime(source / 'new.jpg', (1592222400, 1592222400))
+
+    ingest.ingest(str(source), str(media), duplicates_dir=str(duplicates), known_indexes=[(index_path(str(datadir), str(media)), str(media))],
+                  catalog_path=str(datadir / 'catalog.db'))
+
+    assert os.listdir(source) == []
+    assert os.path.exists(media / '2020' / 'old.jpg')
+    date = datetime.fromtimestamp(1592222400)
+    filed = os.listdir(media / date.strftime('%Y') / date.strftime('%m'))
+    assert len(filed) == 1 and filed[0].startswith(date.strftime('%Y%m%d_%H%M%S_')) and filed[0].endswith('.jpg')
+    (dest, entry), = layout.manifest(str(duplicates)).load().items()
+    assert os.path.basename(dest).endswith('_again.jpg') and os.path.isfile(dest)
+    assert entry['source'] == str(source / 'again.jpg')
+
+def test_an_indexed_hash_with_other_content_is_ingested(tmp_path, monkeypatch):
+    media, source, duplicates, datadir = (tmp_path / name for name in ('media', 'ingest', 'duplicates', 'data'))
+    (media / '2020').mkdir(parents=True)
+    (media / '2020' / 'old.jpg').write_bytes(b'o' * 4000)
+    crawl.crawl(True, str(media), str(datadir), rules=PathRules(include=[f"{media}/*"], exclude=[]))
+    source.mkdir()
+    (source / 'other.jpg').write_bytes(b'x' * 4000)
+    with open(index_path(str(datadir), str(media))) as f:
+        indexed_hash, = (record['filehash'] for key, record in json.load(f).items() if key != 'du')
+    # The new file hashes like the indexed one, as in a fast-hash collision; the strong digest must tell them apart
+    monkeypatch.setattr(ingest.ingest, '_hash_file', lambda self, path: indexed_hash)
+    ingest.ingest(str(source), str(media), duplicates_dir=str(duplicates), known_indexes=[(index_path(str(datadir), str(media)), str(media))],
+                  catalog_path=str(datadir / 'catalog.db'))
+    assert not os.path.isdir(duplicates) or layout.manifest(str(duplicates)).load() == {}
+    assert os.listdir(source) == []
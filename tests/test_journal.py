@@ -0,0 +1,30 @@
+from mediastruct.journal import MoveJournal
+
+def test_load_keeps_the_latest_entry_per_path(tmp_path):
+    for name in ('a', 'b'):
+        (tmp_path / name).write_bytes(name.encode() * 10)
+    journal = MoveJournal(str(tmp_path / 'moves.jsonl'))
+    journal.append(str(tmp_path / 'a'), 'old', '/src/a', 'xxh64')
+    journal.append(str(tmp_path / 'b'), 'bbbb', '/src/b', 'xxh3')
+    journal.append(str(tmp_path / 'a'), 'new', '/src/a2', 'xxh64')
+    # A line cut short by a crash is skipped, not fatal
+    with open(tmp_path / 'moves.jsonl', 'a') as f:
+        f.write('{"path": "/trunc')
+    entries = journal.load()
+    assert sorted(entries) == [str(tmp_path / 'a'), str(tmp_path / 'b')]
+    assert (entries[str(tmp_path / 'a')]['filehash'], entries[str(tmp_path / 'a')]['source']) == ('new', '/src/a2')
+    assert entries[str(tmp_path / 'b')]['hashalg'] == 'xxh3'
+    assert entries[str(tmp_path / 'b')]['filesize'] == 10
+
+def test_rewrite_replaces_every_entry(tmp_path):
+    (tmp_path / 'a').write_bytes(b'a')
+    journal = MoveJournal(str(tmp_path / 'moves.jsonl'))
+    kept = journal.append(str(tmp_path / 'a'), 'aaaa', '/src/a')
+    journal.append(str(tmp_path / 'a'), 'aaaa', '/src/a')
+    journal.rewrite([dict(kept, path='/moved/a')])
+    assert list(journal.load()) == ['/moved/a']
+    journal.rewrite([])
+    assert journal.load() == {}
+
+def test_missing_journal_loads_empty(tmp_path):
+    assert MoveJournal(str(tmp_path / 'none.jsonl')).load() == {}
@@ -0,0 +1,41 @@
+import threading
+from mediastruct import locks
+
+def test_shared_locks_overlap(tmp_path):
+    with locks.hold(str(tmp_path), shared=['/data/media'], command='crawl'):
+        with locks.hold(str(tmp_path), shared=['/data/media'], command='scrub'):
+            pass
+
+def test_exclusive_lock_waits_for_readers_and_names_its_holder(tmp_path):
+    directory = str(tmp_path)
+    held, release, acquired = threading.Event(), threading.Event(), threading.Event()
+
+    def reader():
+        with locks.hold(directory, shared=['/data/media'], command='crawl'):
+            held.set()
+            release.wait(5)
+
+    def mover():
+        with locks.hold(directory, exclusive=['/data/media'], command='dedupe'):
+            acquired.set()
+
+    threads = [threading.Thread(target=reader)]
+    threads[0].start()
+    assert held.wait(5)
+    with open(locks.lock_path(directory, '/data/media')) as f:
+        assert f.read().startswith('crawl (pid ')
+    threads.append(threading.Thread(target=mover))
+    threads[1].start()
+    # flock() conflicts between separate opens of the file, so the mover blocks even in this process
+    assert not acquired.wait(0.3)
+    release.set()
+    assert acquired.wait(5)
+    for thread in threads:
+        thread.join(5)
+    with open(locks.lock_path(directory, '/data/media')) as f:
+        assert f.read().startswith('dedupe (pid ')
+
+def test_no_lock_directory_locks_nothing(tmp_path):
+    with locks.hold(None, exclusive=['/data/media']):
+        with locks.hold(None, exclusive=['/data/media']):
+            pass
@@ -0,0 +1,8 @@
+from mediastruct.monitor import ProgressMonitor
+
+def test_replicate_progress_is_shown():
+    monitor = ProgressMonitor()
+    monitor.update_progress("replicate", status="Running", processed=3, total=4, current="Copied 3/4 files")
+    assert monitor.statuses["replicate"]["status"] == "Running"
+    assert monitor.statuses["replicate"]["progress"] == "75.0%"
+    assert monitor.statuses["replicate"]["details"] == "Copied 3/4 files"
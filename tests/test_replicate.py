@@ -0,0 +1,115 @@
+import os
+import json
+import pytest
+from mediastruct import crawl, replicate
+from mediastruct.index import load_index
+from mediastruct.rules import PathRules
+
+FILES = {'01/a.jpg': b'a' * 3000, '01/b.jpg': b'b' * 3000, '01/sub/c.mov': b'c' * 5000, '02/d.jpg': b'd' * 100}
+
+@pytest.fixture
+def dirs(tmp_path):
+    source, target, datadir = tmp_path / 'archive', tmp_path / 'replica', tmp_path / 'data'
+    for rel, content in FILES.items():
+        path = source / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    target.mkdir()
+    index(source, datadir)
+    return source, target, datadir
+
+def index(source, datadir):
+    crawl.crawl(True, str(source), str(datadir), rules=PathRules(include=[f"{source}/*"], exclude=[]))
+
+def run(source, target, datadir, **kwargs):
+    replicate.replicate(str(source), str(target), str(datadir), **kwargs)
+
+def contents(root):
+    found = {}
+    for dirpath, dirs, files in os.walk(root):
+        for filename in files:
+            if filename != '.mediastruct':
+                path = os.path.join(dirpath, filename)
+                with open(path, 'rb') as f:
+                    found[os.path.relpath(path, root)] = f.read()
+    return found
+
+def plan(source, target, datadir):
+    run(source, target, datadir, plan_only=True)
+    with open(os.path.join(datadir, replicate.replicate.PLAN_FILE)) as f:
+        return json.load(f)
+
+def test_new_files_are_copied_and_indexed(dirs):
+    source, target, datadir = dirs
+    run(source, target, datadir)
+    assert contents(target) == FILES
+    replica = load_index(replicate.replica_index_path(str(datadir), str(target)))
+    assert sorted(os.path.relpath(record['path'], target) for record in replica.values()) == sorted(FILES)
+    assert not os.path.exists(target / replicate.replicate.STAGING_DIR)
+
+def test_matching_files_are_skipped(dirs, capsys):
+    source, target, datadir = dirs
+    run(source, target, datadir)
+    before = {rel: os.stat(target / rel).st_mtime_ns for rel in FILES}
+    capsys.readouterr()
+    run(source, target, datadir)
+    assert f"{len(FILES)} files in place, 0 to rename, 0 to copy within the target, 0 to transfer" in capsys.readouterr().out
+    assert {rel: os.stat(target / rel).st_mtime_ns for rel in FILES} == before
+
+def test_existing_target_content_is_found_by_scan(dirs):
+    source, target, datadir = dirs
+    # A target populated before replicate ever ran, one file under another name
+    (target / '01').mkdir()
+    (target / '01' / 'a.jpg').write_bytes(FILES['01/a.jpg'])
+    (target / 'old.jpg').write_bytes(FILES['02/d.jpg'])
+    actions = plan(source, target, datadir)
+    assert actions['keep'] == ['01/a.jpg']
+    assert actions['rename'] == [['old.jpg', '02/d.jpg']]
+    assert actions['transfer'] == ['01/b.jpg', '01/sub/c.mov']
+
+def test_moves_and_swaps_are_applied_as_staged_renames(dirs, capsys):
+    source, target, datadir = dirs
+    run(source, target, datadir)
+    # Swap two files and move a third on the source, then reindex it
+    os.rename(source / '01' / 'a.jpg', source / 'tmp')
+    os.rename(source / '01' / 'b.jpg', source / '01' / 'a.jpg')
+    os.rename(source / 'tmp', source / '01' / 'b.jpg')
+    os.rename(source / '01' / 'sub' / 'c.mov', source / '02' / 'c.mov')
+    index(source, datadir)
+    capsys.readouterr()
+    run(source, target, datadir, delete=True)
+    output = capsys.readouterr().out
+    assert "3 renamed, 0 copied and verified" in output
+    assert contents(target) == contents(source)
+    assert not os.path.exists(target / '01' / 'sub')
+
+def test_duplicate_content_is_copied_within_the_target(dirs):
+    source, target, datadir = dirs
+    run(source, target, datadir)
+    (source / '02' / 'd2.jpg').write_bytes(FILES['02/d.jpg'])
+    index(source, datadir)
+    actions = plan(source, target, datadir)
+    assert actions['copy'] == [['02/d.jpg', '02/d2.jpg']]
+    assert actions['transfer'] == []
+    run(source, target, datadir)
+    assert (target / '02' / 'd2.jpg').read_bytes() == FILES['02/d.jpg']
+
+def test_copy_that_does_not_match_the_recorded_hash_is_refused(dirs):
+    source, target, datadir = dirs
+    # Changed after the crawl: same size, different content
+    (source / '01' / 'b.jpg').write_bytes(b'x' * 3000)
+    run(source, target, datadir)
+    assert not (target / '01' / 'b.jpg').exists()
+    assert (target / '01' / 'a.jpg').read_bytes() == FILES['01/a.jpg']
+    replica = load_index(replicate.replica_index_path(str(datadir), str(target)))
+    assert str(target / '01' / 'b.jpg') not in {record['path'] for record in replica.values()}
+    assert not os.path.exists(target / replicate.replicate.STAGING_DIR)
+
+def test_copy_that_fails_read_back_verification_is_refused(dirs, monkeypatch):
+    source, target, datadir = dirs
+    # The bytes read matched, but the written copy reads back differently
+    monkeypatch.setattr(replicate, 'hash_path', lambda path, algorithm, workers=None: ('0' * 16, None))
+    run(source, target, datadir)
+    assert contents(target) == {}
+    run(source, target, datadir, verify=False)
+    assert contents(target) == FILES
@@ -0,0 +1,18 @@
+from mediastruct.rules import PathRules, default_patterns
+
+def test_default_patterns_follow_the_configured_paths(tmp_path):
+    archive, media = tmp_path / 'vault', tmp_path / 'photos'
+    for path in ('vault/01/x', 'vault/02', 'vault/blobs/xxh64/ab', 'vault/volumes', 'photos/2019/01', 'photos/dupes/2019', 'photos/misc'):
+        (tmp_path / path).mkdir(parents=True)
+    rules = PathRules(*default_patterns(str(archive) + '/', str(media), [str(media / 'dupes')]))
+    assert sorted(rules.targets(str(archive))) == [str(archive / '01'), str(archive / '02')]
+    assert sorted(rules.targets(str(media))) == [str(media / '2019')]
+    assert rules.is_excluded(archive / 'blobs' / 'xxh64' / 'ab')
+    assert rules.is_excluded(archive / 'volumes')
+    assert rules.target_for(media / 'dupes' / '2019' / 'a.jpg') is None
+    assert rules.target_for(media / '2019' / '01' / 'a.jpg') == str(media / '2019')
+
+def test_default_patterns_match_the_builtin_defaults():
+    include, exclude = default_patterns('/data/archive', '/data/media/media', ['/data/media/duplicates', '/data/media/validated', '/data/media/ingest'])
+    assert PathRules(include, exclude).include == PathRules().include
+    assert sorted(PathRules(include, exclude).exclude) == sorted(PathRules().exclude)
@@ -0,0 +1,37 @@
+import json
+import pytest
+from mediastruct import crawl, scrub
+from mediastruct.rules import PathRules
+
+@pytest.fixture
+def vault(tmp_path):
+    root = tmp_path / 'archive'
+    (root / '01').mkdir(parents=True)
+    (root / '01' / 'a.jpg').write_bytes(b'a' * 4000)
+    (root / '01' / 'b.jpg').write_bytes(b'b' * 4000)
+    return root
+
+def index(root, datadir):
+    crawl.crawl(True, str(root), str(datadir), rules=PathRules(include=[f"{root}/*"], exclude=[]))
+
+def run(root, datadir, **kwargs):
+    scrub.scrub(str(root), str(datadir), str(datadir / 'catalog.db'), **kwargs)
+    with open(datadir / scrub.scrub.REPORT_FILE) as f:
+        return json.load(f)
+
+def test_mismatch_survives_a_recrawl_until_rebaselined(vault, tmp_path):
+    datadir = tmp_path / 'data'
+    index(vault, datadir)
+    assert run(vault, datadir)['mismatches'] == []
+    # Bit rot: same size, different content, then a forced crawl indexes the rotted hash
+    rotted = str(vault / '01' / 'a.jpg')
+    with open(rotted, 'r+b') as f:
+        f.write(b'x')
+    assert run(vault, datadir)['mismatches'] == [rotted]
+    index(vault, datadir)
+    report = run(vault, datadir)
+    assert report['mismatches'] == [rotted] and report['files_verified'] == 1
+    # Accepting the new content is explicit, and limited to the paths given
+    report = run(vault, datadir, rebaseline=True, paths=[rotted])
+    assert report['mismatches'] == [] and report['files_verified'] == 2
+    assert run(vault, datadir)['mismatches'] == []
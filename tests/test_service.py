@@ -0,0 +1,55 @@
+import os
+import json
+import datetime
+import pytest
+from mediastruct import crawl, service, query
+from mediastruct.__main__ import mediastruct
+from mediastruct.rules import PathRules
+
+class app:
+    """The parts of the CLI instance a service query uses."""
+    query_options = mediastruct.query_options
+    _range = staticmethod(mediastruct._range)
+
+    def __init__(self, datadir, root):
+        self.datadir = str(datadir)
+        self.root = str(root)
+
+    def roots(self):
+        return [self.root]
+
+    def catalog_path(self):
+        return f"{self.datadir}/catalog.db"
+
+@pytest.fixture
+def resident(tmp_path):
+    root = tmp_path / 'media'
+    for year, names in (('2018', 'ab'), ('2019', 'cd')):
+        (root / year).mkdir(parents=True)
+        for name in names:
+            path = root / year / f"{name}.jpg"
+            path.write_bytes(name.encode() * (1000 if name in 'ac' else 5000))
+            # crawl takes the year from the mtime
+            taken = datetime.datetime(int(year), 6, 1).timestamp()
+            os.utime(path, (taken, taken))
+    crawl.crawl(True, str(root), str(tmp_path / 'data'), rules=PathRules(include=[f"{root}/*"], exclude=[]))
+    instance = service.service.__new__(service.service)
+    instance.app = app(tmp_path / 'data', root)
+    return instance, root, tmp_path
+
+def cli(instance, tmp_path, **options):
+    output = tmp_path / 'out.jsonl'
+    query.query(output=str(output), **instance.app.query_options(**options))
+    with open(output) as f:
+        return [json.loads(line) for line in f]
+
+def test_service_queries_match_the_query_command(resident):
+    instance, root, tmp_path = resident
+    known = cli(instance, tmp_path, year='2019')[0]['filehash']
+    (tmp_path / 'hashes.txt').write_text(f"# card\n{known.upper()} IMG_0001.jpg\n0000000000000000\n")
+    expected = cli(instance, tmp_path, hashes=[known], hashes_file=str(tmp_path / 'hashes.txt'), paths=[str(root / '2018' / 'a.jpg')], year='2018-', size='2K-')
+    results = instance.query({"command": "query", "hashes": [known], "hash_lines": (tmp_path / 'hashes.txt').read_text().splitlines(),
+                              "paths": [str(root / '2018' / 'a.jpg')], "year": '2018-', "size": '2K-'})
+    assert results == expected
+    assert [result.get('paths') for result in results[:3]] == [[str(root / '2019' / 'c.jpg')]] * 2 + [[]]
+    assert [result['path'] for result in results[4:]] == [str(root / '2018' / 'b.jpg'), str(root / '2019' / 'd.jpg')]
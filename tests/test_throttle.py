@@ -0,0 +1,33 @@
+import json
+import multiprocessing
+import configparser
+import pytest
+from mediastruct import crawl, throttle
+from mediastruct.index import index_path
+from mediastruct.rules import PathRules
+
+def records(datadir, root):
+    with open(index_path(str(datadir), str(root))) as f:
+        return {record['path']: record['filehash'] for file_id, record in json.load(f).items() if file_id != 'du'}
+
+@pytest.mark.parametrize('method', [m for m in ('fork', 'spawn', 'forkserver') if m in multiprocessing.get_all_start_methods()])
+def test_crawl_workers_share_the_bucket_under_every_start_method(tmp_path, monkeypatch, method):
+    root = tmp_path / 'media'
+    (root / '2020').mkdir(parents=True)
+    for name in 'abc':
+        (root / '2020' / f"{name}.jpg").write_bytes(name.encode() * 50000)
+    rules = PathRules(include=[f"{root}/*"], exclude=[])
+    crawl.crawl(True, str(root), str(tmp_path / 'plain'), rules=rules)
+
+    monkeypatch.setattr(throttle, 'CONTEXT', multiprocessing.get_context(method))
+    config = configparser.ConfigParser()
+    config['Throttle'] = {'crawl': '1G 100000'}
+    limiter = throttle.configure(config, 'crawl')
+    try:
+        refilled = limiter.state[2]
+        crawl.crawl(True, str(root), str(tmp_path / 'throttled'), rules=rules)
+        # Only the pool workers draw from the bucket here, so its refill time moves only if they share it
+        assert limiter.state[2] > refilled
+    finally:
+        throttle.install(None)
+    assert records(tmp_path / 'throttled', root) == records(tmp_path / 'plain', root)
@@ -0,0 +1,85 @@
+import os
+import json
+import pytest
+from mediastruct import validate, layout
+from mediastruct.hashing import HashPolicy, hash_path
+
+CONTENT = b'v' * 5000
+
+@pytest.fixture
+def dirs(tmp_path):
+    duplicates, validated = tmp_path / 'duplicates', tmp_path / 'validated'
+    duplicates.mkdir()
+    return duplicates, validated, tmp_path
+
+def write_index(path, records):
+    with open(path, 'w') as f:
+        json.dump(dict({'du': 0}, **{str(i): record for i, record in enumerate(records)}), f)
+    return str(path)
+
+def store(duplicates, filehash, name='IMG_0001.jpg', content=CONTENT):
+    path = layout.shard_path(str(duplicates), filehash, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+def run(duplicates, validated, data_files, **kwargs):
+    validate.validate(data_files, str(duplicates), '/nonexistent/archive', '/nonexistent/ingest', validated_dir=str(validated), **kwargs)
+    return sorted(os.path.relpath(path, validated) for path in layout.walk_files(str(validated))) if os.path.isdir(validated) else []
+
+@pytest.mark.parametrize('indexed_as, validated', [('xxh64', False), ('xxh3', True)])
+def test_digest_only_confirms_against_records_of_the_same_algorithm(dirs, indexed_as, validated):
+    duplicates, validated_dir, tmp_path = dirs
+    path = store(duplicates, 'pending')
+    digest = hash_path(path, 'xxh3')[0]
+    # The same hex digest, recorded for other content under another algorithm, is no confirmation
+    index = write_index(tmp_path / 'media_index.json', [{'filehash': digest, 'hashalg': indexed_as, 'path': '/data/media/2020/IMG_0001.jpg', 'filesize': len(CONTENT)}])
+    moved = run(duplicates, validated_dir, [index], hash_policy=HashPolicy(algorithm='xxh3'))
+    assert bool(moved) == validated
+    assert os.path.exists(path) != validated
+
+def moved(duplicates, filehash, source, name='IMG_0001.jpg', content=CONTENT):
+    """A file dedupe moved into the duplicates directory, recorded in its manifest."""
+    path = store(duplicates, filehash, name, content)
+    layout.manifest(str(duplicates)).append(path, filehash, source, 'xxh64')
+    return path
+
+def test_manifest_entry_confirms_a_file_without_rehashing(dirs, monkeypatch):
+    duplicates, validated_dir, tmp_path = dirs
+    digest = 'f00dfeedf00dfeed'
+    path = moved(duplicates, digest, '/data/media/2020/IMG_0001.jpg')
+    index = write_index(tmp_path / 'media_index.json', [{'filehash': digest, 'path': '/data/archive/01/IMG_0001.jpg', 'filesize': len(CONTENT)}])
+    monkeypatch.setattr(validate, 'hash_path', lambda *args: pytest.fail("a manifest-confirmed file was rehashed"))
+    assert run(duplicates, validated_dir, [index], sample_rate=0.0) == [os.path.relpath(layout.shard_path(str(validated_dir), digest, 'IMG_0001.jpg'), validated_dir)]
+    assert layout.manifest(str(duplicates)).load() == {}
+    entry, = layout.manifest(str(validated_dir)).load().values()
+    assert (entry['source'], entry['hashalg']) == ('/data/media/2020/IMG_0001.jpg', 'xxh64')
+    assert not os.path.exists(path)
+
+def test_sampled_files_are_rehashed_anyway(dirs, monkeypatch):
+    duplicates, validated_dir, tmp_path = dirs
+    path = store(duplicates, 'pending')
+    digest = hash_path(path, 'xxh64')[0]
+    os.remove(path)
+    moved(duplicates, digest, '/data/media/2020/IMG_0001.jpg')
+    index = write_index(tmp_path / 'media_index.json', [{'filehash': digest, 'path': '/data/archive/01/IMG_0001.jpg', 'filesize': len(CONTENT)}])
+    hashed = []
+    monkeypatch.setattr(validate, 'hash_path', lambda path, *args: hashed.append(path) or hash_path(path, *args))
+    assert len(run(duplicates, validated_dir, [index], sample_rate=1.0)) == 1
+    assert len(hashed) == 1
+
+def test_file_changed_since_it_was_moved_stays_in_duplicates(dirs):
+    duplicates, validated_dir, tmp_path = dirs
+    path = store(duplicates, 'pending')
+    digest = hash_path(path, 'xxh64')[0]
+    os.remove(path)
+    path = moved(duplicates, digest, '/data/media/2020/IMG_0001.jpg')
+    # Same size, different bytes: the stat no longer matches, and the rehash does not match the manifest
+    with open(path, 'r+b') as f:
+        f.write(b'x')
+    os.utime(path, ns=(0, 0))
+    index = write_index(tmp_path / 'media_index.json', [{'filehash': digest, 'path': '/data/archive/01/IMG_0001.jpg', 'filesize': len(CONTENT)}])
+    assert run(duplicates, validated_dir, [index], sample_rate=0.0) == []
+    assert os.path.exists(path)
+    assert list(layout.manifest(str(duplicates)).load()) == [path]